@@ -0,0 +1,164 @@
+"""
+Local stand-in for the xAI chat completions API, for offline benchmarks.
+
+Speaks enough of the OpenAI-compatible protocol for the openai SDK: POST
+/v1/chat/completions with or without "stream": true. Replies are filler text
+of a configurable size, delivered after a configurable latency, so benchmark
+timings measure the app rather than the network or the model.
+
+    python benchmarks/fake_xai_server.py --port 8799 --latency-ms 300 --response-chars 1500
+    XAI_BASE_URL=http://127.0.0.1:8799/v1 XAI_API_KEY=xai-fake streamlit run xai_health_dialogue.py
+"""
+import argparse
+import json
+import logging
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FILLER = ("Stay hydrated, keep moving, sleep well and check in tomorrow with how you feel. "
+          "Recommendation: take a ten minute walk after lunch. ")
+
+
+def filler_text(chars):
+    repeats = chars // len(FILLER) + 1
+    return (FILLER * repeats)[:chars]
+
+
+class FakeXAIHandler(BaseHTTPRequestHandler):
+    """Answers chat completions using the settings and stats dicts attached to its server."""
+
+    server_version = "FakeXAI/1.0"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logging.debug(f"fake xAI: {format % args}")
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [{"id": "grok-2-latest", "object": "model"}]})
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            self._send_json(400, {"error": {"message": "Request body is not JSON"}})
+            return
+
+        settings = self.server.settings
+        with self.server.stats_lock:
+            self.server.stats["requests"] += 1
+        prompt_chars = sum(len(str(m.get("content") or "")) for m in request.get("messages", []))
+        content = filler_text(settings["response_chars"])
+        usage = {
+            "prompt_tokens": prompt_chars // 4,
+            "completion_tokens": len(content) // 4,
+            "total_tokens": (prompt_chars + len(content)) // 4,
+        }
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        model = request.get("model", "grok-2-latest")
+
+        if request.get("stream"):
+            self._stream(completion_id, model, content, usage, settings)
+            return
+
+        time.sleep(settings["latency_ms"] / 1000)
+        self._send_json(200, {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                         "finish_reason": "stop"}],
+            "usage": usage,
+        })
+
+    def _stream(self, completion_id, model, content, usage, settings):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def event(delta, finish_reason=None, extra=None):
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": model, "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            chunk.update(extra or {})
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        # latency is the time to first token; the rest of the reply trickles in per chunk
+        time.sleep(settings["latency_ms"] / 1000)
+        event({"role": "assistant", "content": ""})
+        chunk_chars = max(settings["chunk_chars"], 1)
+        for start in range(0, len(content), chunk_chars):
+            event({"content": content[start:start + chunk_chars]})
+            if settings["chunk_delay_ms"]:
+                time.sleep(settings["chunk_delay_ms"] / 1000)
+        event({}, finish_reason="stop", extra={"usage": usage})
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def start_fake_server(host="127.0.0.1", port=0, latency_ms=0, response_chars=800,
+                      chunk_chars=20, chunk_delay_ms=0):
+    """
+    Starts the fake server on a background thread.
+
+    Args:
+        host (str): Interface to bind.
+        port (int): Port to bind; 0 picks a free one.
+        latency_ms (float): Delay before a response, or before the first streamed token.
+        response_chars (int): Length of every reply.
+        chunk_chars (int): Characters per streamed chunk.
+        chunk_delay_ms (float): Delay between streamed chunks.
+
+    Returns:
+        tuple: (server, base URL to use as XAI_BASE_URL). Call server.shutdown() to stop it.
+    """
+    server = ThreadingHTTPServer((host, port), FakeXAIHandler)
+    server.daemon_threads = True
+    server.settings = {"latency_ms": latency_ms, "response_chars": response_chars,
+                       "chunk_chars": chunk_chars, "chunk_delay_ms": chunk_delay_ms}
+    server.stats = {"requests": 0}
+    server.stats_lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, name="fake-xai-server", daemon=True).start()
+    base_url = f"http://{server.server_address[0]}:{server.server_address[1]}/v1"
+    logging.info(f"Fake xAI server listening on {base_url}")
+    return server, base_url
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve a fake OpenAI-compatible xAI API for benchmarks.')
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8799)
+    parser.add_argument('--latency-ms', type=float, default=0, help='Delay before each reply or first token')
+    parser.add_argument('--response-chars', type=int, default=800, help='Length of every reply')
+    parser.add_argument('--chunk-chars', type=int, default=20, help='Characters per streamed chunk')
+    parser.add_argument('--chunk-delay-ms', type=float, default=0, help='Delay between streamed chunks')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server, base_url = start_fake_server(args.host, args.port, args.latency_ms, args.response_chars,
+                                         args.chunk_chars, args.chunk_delay_ms)
+    print(f"XAI_BASE_URL={base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,121 @@
+"""
+Measures the cold import cost of the core package and the Streamlit front end.
+
+Each module is imported in a fresh interpreter, the way a new Streamlit worker
+or a CLI run would pay for it, and the median wall time over several runs is
+reported. Modules whose dependencies are not installed are reported as errors
+rather than aborting the run.
+
+    python benchmarks/import_time.py --runs 5 --output benchmarks/import_time.json
+    python benchmarks/import_time.py --max-ms 300 health_coach.storage
+"""
+import argparse
+import json
+import logging
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+DEFAULT_MODULES = [
+    "health_coach",
+    "health_coach.storage",
+    "health_coach.context_builder",
+    "health_coach.maintenance",
+    "xai_utilities",
+    "xai_health_dialogue",
+]
+
+# Times only the import, not interpreter start-up, from inside the child process.
+IMPORT_SNIPPET = "import time, importlib; t = time.perf_counter(); importlib.import_module({module!r}); print(time.perf_counter() - t)"
+
+
+def time_import(module, runs=5):
+    """
+    Imports a module in fresh interpreters and times it.
+
+    Args:
+        module (str): Dotted module name, importable from the repository root.
+        runs (int): Number of fresh interpreters to start.
+
+    Returns:
+        dict: Median and max import time in milliseconds, plus the
+            interpreter's total wall time, or an error message.
+    """
+    import_ms = []
+    process_ms = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET.format(module=module)],
+                                cwd=REPO_DIR, capture_output=True, text=True)
+        elapsed = (time.perf_counter() - started) * 1000
+        if result.returncode != 0:
+            last_line = (result.stderr.strip().splitlines() or ["unknown error"])[-1]
+            return {"module": module, "error": last_line}
+        import_ms.append(float(result.stdout.strip().splitlines()[-1]) * 1000)
+        process_ms.append(elapsed)
+    return {
+        "module": module,
+        "runs": runs,
+        "import_ms_median": round(statistics.median(import_ms), 2),
+        "import_ms_max": round(max(import_ms), 2),
+        "process_ms_median": round(statistics.median(process_ms), 2),
+    }
+
+
+def heaviest_imports(module, limit=10):
+    """
+    Returns the slowest imports pulled in by a module according to -X importtime.
+
+    Args:
+        module (str): Dotted module name.
+        limit (int): Number of entries to return.
+
+    Returns:
+        list: (cumulative microseconds, imported module name) pairs.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=REPO_DIR, capture_output=True, text=True)
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        entries.append((int(cumulative), name.strip()))
+    return sorted(entries, reverse=True)[:limit]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure cold import time of the app's modules.")
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES, help="Modules to import")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters per module")
+    parser.add_argument("--output", type=str, help="Write the results to this JSON file")
+    parser.add_argument("--max-ms", type=float,
+                        help="Exit with status 1 if any module's median import time exceeds this")
+    parser.add_argument("--top", type=int, default=0, help="Also list the N slowest nested imports")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    results = []
+    for module in args.modules:
+        timing = time_import(module, args.runs)
+        if args.top and "error" not in timing:
+            timing["heaviest_imports"] = heaviest_imports(module, args.top)
+        logging.info(f"{module}: {timing.get('import_ms_median', timing.get('error'))}")
+        results.append(timing)
+
+    report = {"python": sys.version.split()[0], "results": results}
+    print(json.dumps(report, indent=2))
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    if args.max_ms is not None:
+        too_slow = [r["module"] for r in results if r.get("import_ms_median", 0) > args.max_ms]
+        if too_slow:
+            logging.error(f"Import time above {args.max_ms} ms: {', '.join(too_slow)}")
+            sys.exit(1)
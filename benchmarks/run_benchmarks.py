@@ -0,0 +1,288 @@
+"""
+Offline performance benchmarks for the health coach.
+
+Everything runs against benchmarks/fake_xai_server.py on localhost and a
+throwaway data directory, so no API key, network or real user data is needed:
+
+- dialogue: the user_provides_health_update path without the UI, i.e. context
+  building (including summaries), a streamed dialogue completion and the
+  write-through save, timed per round with time to first token.
+- morph: GiveMeTheLatest.morph_prompts batches at several batch sizes.
+- storage: save, incremental save, load, cached load and history paging at
+  history sizes from 10 to 100k messages for each storage backend.
+
+Results are written as JSON so runs can be compared over time:
+
+    python benchmarks/run_benchmarks.py --output benchmarks/results/latest.json
+    python benchmarks/run_benchmarks.py --only storage --sizes 10 1000 100000
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from fake_xai_server import start_fake_server  # noqa: E402
+
+DEFAULT_SIZES = [10, 100, 1000, 10000, 100000]
+BENCHMARKS = ["dialogue", "morph", "storage"]
+SYSTEM_MESSAGE = "You are a friendly, evidence-based health coach."
+
+
+def summarize(samples):
+    """Reduces a list of durations in seconds to summary statistics in milliseconds."""
+    if not samples:
+        return {"n": 0}
+    ms = sorted(s * 1000 for s in samples)
+    return {
+        "n": len(ms),
+        "min_ms": round(ms[0], 3),
+        "median_ms": round(statistics.median(ms), 3),
+        "p95_ms": round(ms[min(len(ms) - 1, int(len(ms) * 0.95))], 3),
+        "max_ms": round(ms[-1], 3),
+        "mean_ms": round(statistics.fmean(ms), 3),
+    }
+
+
+def make_conversation(size, content_chars=200):
+    """Builds a synthetic conversation of alternating user and assistant messages."""
+    body = ("I walked 6000 steps, slept 7 hours and had oatmeal for breakfast. " * 10)[:content_chars]
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"{i}: {body}",
+         "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(1700000000 + i * 60))}
+        for i in range(size)
+    ]
+
+
+def configure_environment(base_url, work_dir):
+    """
+    Points the core package at the fake server and a scratch directory.
+
+    Must run before health_coach is imported, because its modules read their
+    settings from the environment at import time.
+    """
+    os.environ["XAI_BASE_URL"] = base_url
+    if not os.environ.get("XAI_API_KEY", "").startswith("xai-"):
+        os.environ["XAI_API_KEY"] = "xai-benchmark"
+    os.environ["XAI_HEALTH_DIR"] = str(work_dir)
+    os.environ["XAI_HEALTH_DB_PATH"] = str(work_dir / "xai_health.sqlite3")
+    # cached completions would measure the cache, not the round trip
+    os.environ["LLM_CACHE_ENABLED"] = "false"
+    os.environ["LLM_CACHE_PATH"] = str(work_dir / "llm_cache.sqlite3")
+
+
+def bench_dialogue(work_dir, rounds, history_size):
+    """Times health-update round trips: build context, stream the reply, save."""
+    import openai  # noqa: F401
+    from health_coach.context_builder import build_context, make_llm_summarizer
+    from health_coach.storage import FileStorage
+    from health_coach.user_state import UserStateCache
+    from health_coach.xai_client import chat_completion
+
+    storage = FileStorage(work_dir / "dialogue_users", work_dir)
+    cache = UserStateCache(storage=storage)
+    user_id = "bench_dialogue"
+    storage.save_conversation(user_id, make_conversation(history_size), {"user_id": user_id})
+    user_dir = storage.user_dir(user_id)
+    summarizer = make_llm_summarizer()
+
+    context_samples, ttft_samples, total_samples = [], [], []
+    for round_number in range(rounds):
+        started = time.perf_counter()
+        conversation, authentication = cache.load(user_id)
+        conversation.append({"role": "user", "content": f"Update {round_number}: slept 6 hours, walked 4000 steps.",
+                             "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")})
+        messages = build_context(SYSTEM_MESSAGE, conversation, user_dir, summarizer)
+        context_built = time.perf_counter()
+
+        first_token_at = None
+        chunks = []
+        for chunk in chat_completion("dialogue", messages, stream=True):
+            if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                chunks.append(chunk.choices[0].delta.content)
+        conversation.append({"role": "assistant", "content": "".join(chunks),
+                             "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")})
+        cache.save(user_id, conversation, authentication)
+        finished = time.perf_counter()
+
+        context_samples.append(context_built - started)
+        ttft_samples.append((first_token_at or finished) - context_built)
+        total_samples.append(finished - started)
+
+    return {
+        "history_size": history_size,
+        "rounds": rounds,
+        # the first round also summarizes the pre-existing history
+        "first_round_ms": round(total_samples[0] * 1000, 3),
+        "context_build": summarize(context_samples),
+        "time_to_first_token": summarize(ttft_samples),
+        "round_trip": summarize(total_samples),
+    }
+
+
+def bench_morph(batch_sizes, max_concurrency, repeats):
+    """Times GiveMeTheLatest.morph_prompts for each batch size."""
+    # morph errors are swallowed per prompt, so check for the SDK up front
+    import openai  # noqa: F401
+    from health_coach.topics import GiveMeTheLatest
+
+    give_me_the_latest = GiveMeTheLatest(max_concurrency=max_concurrency)
+    results = []
+    for batch_size in batch_sizes:
+        samples = []
+        for repeat in range(repeats):
+            prompts = [f"Benchmark topic {repeat}-{i}: sleep and recovery" for i in range(batch_size)]
+            started = time.perf_counter()
+            # morph_single_prompt prints every reply; keep stdout for the report
+            with contextlib.redirect_stdout(io.StringIO()):
+                links = give_me_the_latest.morph_prompts(prompts, "Optimize this prompt.", create_link=True)
+            samples.append(time.perf_counter() - started)
+            # a single prompt comes back as a bare result
+            links = links if isinstance(links, list) else [links]
+            failed = sum(1 for link in links if not link)
+            if failed:
+                logging.warning(f"{failed} of {batch_size} morphs failed")
+        timing = summarize(samples)
+        timing["per_prompt_ms"] = round(timing["median_ms"] / batch_size, 3)
+        results.append({"batch_size": batch_size, "max_concurrency": max_concurrency, **timing})
+    return results
+
+
+def bench_storage(work_dir, sizes, backends, repeats, page_size=20):
+    """Times conversation persistence for each backend and history size."""
+    from health_coach.storage import FileStorage, SQLiteStorage
+    from health_coach.user_state import UserStateCache
+
+    results = []
+    for backend in backends:
+        for size in sizes:
+            backend_dir = work_dir / f"storage_{backend}_{size}"
+            if backend == "sqlite":
+                storage = SQLiteStorage(backend_dir / "bench.sqlite3")
+            else:
+                storage = FileStorage(backend_dir / "userdata", backend_dir)
+            user_id = "bench_storage"
+            conversation = make_conversation(size)
+            authentication = {"user_id": user_id}
+
+            started = time.perf_counter()
+            storage.save_conversation(user_id, conversation, authentication)
+            initial_save = time.perf_counter() - started
+
+            append_samples, load_samples, page_samples = [], [], []
+            for repeat in range(repeats):
+                conversation = conversation + make_conversation(2)
+                started = time.perf_counter()
+                storage.save_conversation(user_id, conversation, authentication)
+                append_samples.append(time.perf_counter() - started)
+
+                started = time.perf_counter()
+                loaded, _ = storage.load_conversation(user_id)
+                load_samples.append(time.perf_counter() - started)
+                if len(loaded) != len(conversation):
+                    raise RuntimeError(f"{backend} loaded {len(loaded)} of {len(conversation)} messages")
+
+                started = time.perf_counter()
+                storage.history_page(user_id, repeat, page_size)
+                page_samples.append(time.perf_counter() - started)
+
+            cache = UserStateCache(storage=storage, check_interval=0)
+            cache.load(user_id)
+            cached_samples = []
+            for _ in range(repeats):
+                started = time.perf_counter()
+                cache.load(user_id)
+                cached_samples.append(time.perf_counter() - started)
+
+            results.append({
+                "backend": backend,
+                "messages": size,
+                "initial_save_ms": round(initial_save * 1000, 3),
+                "incremental_save": summarize(append_samples),
+                "load": summarize(load_samples),
+                "cached_load": summarize(cached_samples),
+                "history_page": summarize(page_samples),
+            })
+            logging.info(f"storage {backend} {size}: load median {results[-1]['load']['median_ms']} ms")
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    server, base_url = start_fake_server(latency_ms=args.latency_ms, response_chars=args.response_chars,
+                                         chunk_chars=args.chunk_chars, chunk_delay_ms=args.chunk_delay_ms)
+    report = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_revision": git_revision(),
+        "python": sys.version.split()[0],
+        "settings": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": {},
+        "errors": {},
+    }
+    with tempfile.TemporaryDirectory(prefix="xai_health_bench_") as tmp:
+        work_dir = Path(tmp)
+        configure_environment(base_url, work_dir)
+        benchmarks = {
+            "dialogue": lambda: [bench_dialogue(work_dir, args.rounds, size) for size in args.dialogue_history],
+            "morph": lambda: bench_morph(args.batch_sizes, args.max_concurrency, args.repeats),
+            "storage": lambda: bench_storage(work_dir, args.sizes, args.backends, args.repeats),
+        }
+        for name in args.only or BENCHMARKS:
+            logging.info(f"Running {name} benchmark")
+            try:
+                report["results"][name] = benchmarks[name]()
+            except ImportError as e:
+                # e.g. openai missing: report it and keep going with the rest
+                logging.error(f"Skipping {name} benchmark: {str(e)}")
+                report["errors"][name] = str(e)
+    report["fake_server_requests"] = server.stats["requests"]
+    server.shutdown()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run offline benchmarks against a local fake xAI server.')
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, help='Benchmarks to run (default: all)')
+    parser.add_argument('--output', type=str, help='Write the JSON report to this file')
+    parser.add_argument('--sizes', nargs='+', type=int, default=DEFAULT_SIZES, help='History sizes for storage')
+    parser.add_argument('--backends', nargs='+', choices=['files', 'sqlite'], default=['files', 'sqlite'])
+    parser.add_argument('--repeats', type=int, default=5, help='Timed repetitions per measurement')
+    parser.add_argument('--rounds', type=int, default=10, help='Dialogue round trips per history size')
+    parser.add_argument('--dialogue-history', nargs='+', type=int, default=[10, 1000],
+                        help='Existing history sizes for the dialogue benchmark')
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 8, 32], help='Morph batch sizes')
+    parser.add_argument('--max-concurrency', type=int, default=4, help='Concurrent morph requests')
+    parser.add_argument('--latency-ms', type=float, default=50, help='Fake server latency / time to first token')
+    parser.add_argument('--response-chars', type=int, default=800, help='Fake reply length')
+    parser.add_argument('--chunk-chars', type=int, default=20, help='Characters per streamed chunk')
+    parser.add_argument('--chunk-delay-ms', type=float, default=0, help='Delay between streamed chunks')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    report = run(args)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    sys.exit(1 if report["errors"] else 0)
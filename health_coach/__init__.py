@@ -0,0 +1,10 @@
+"""
+Core of the xAI health coach: storage, context assembly, caching and API access.
+
+Nothing in this package imports Streamlit, and optional integrations (openai,
+stripe, tweepy) are imported only when first used, so the CLIs and the
+Streamlit front end in xai_health_dialogue.py start quickly.
+"""
+
+# loads .env before any submodule reads its settings from the environment
+from . import config  # noqa: F401
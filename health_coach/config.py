@@ -0,0 +1,18 @@
+import os
+from pathlib import Path
+
+try:
+    from dotenv import load_dotenv
+except ImportError:
+    load_dotenv = None
+
+# The repository root, which holds userdata/, cache/ and resources/.
+APP_DIR = Path(__file__).resolve().parent.parent
+
+# Imported by the package __init__, so .env settings are in place before any
+# core module reads its configuration from the environment.
+if load_dotenv is not None:
+    load_dotenv()
+
+USERS_DIR = APP_DIR / "userdata"
+XAI_HEALTH_DIR = os.getenv("XAI_HEALTH_DIR") or str(APP_DIR)
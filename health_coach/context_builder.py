@@ -0,0 +1,310 @@
+import json
+import logging
+import os
+from pathlib import Path
+
+from .conversation_store import CONTEXT_SUMMARIES_FILENAME
+from .locking import atomic_write_json
+from .recall_index import get_recall_index
+from .xai_client import chat_completion
+
+# Rough budget for everything sent with a health update, system prompt included.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "8000"))
+# Newest messages that are always sent verbatim (a user update and its reply are two).
+CONTEXT_VERBATIM_TURNS = int(os.getenv("CONTEXT_VERBATIM_TURNS", "8"))
+# Older messages are folded into a new summary segment once this many accumulate.
+CONTEXT_SUMMARY_BATCH = int(os.getenv("CONTEXT_SUMMARY_BATCH", "6"))
+# New segments summarized while building one request; a longer backlog (e.g. an
+# imported history) is left to later requests and the background "summaries" job,
+# which does CONTEXT_SUMMARY_JOB_BATCHES per run; a user's health update can wait
+# behind one run, so keep that small.
+CONTEXT_SUMMARY_MAX_BATCHES = int(os.getenv("CONTEXT_SUMMARY_MAX_BATCHES", "2"))
+CONTEXT_SUMMARY_JOB_BATCHES = int(os.getenv("CONTEXT_SUMMARY_JOB_BATCHES", "1"))
+# Share of the budget the summaries may use before the oldest segments are merged.
+CONTEXT_SUMMARY_SHARE = float(os.getenv("CONTEXT_SUMMARY_SHARE", "0.25"))
+# Past exchanges recalled by relevance to the newest update, and the share of the
+# budget held back for them; CONTEXT_RECALL_TOP_K=0 turns recall off.
+CONTEXT_RECALL_TOP_K = int(os.getenv("CONTEXT_RECALL_TOP_K", "3"))
+CONTEXT_RECALL_SHARE = float(os.getenv("CONTEXT_RECALL_SHARE", "0.2"))
+
+MESSAGE_TOKEN_OVERHEAD = 4
+
+SUMMARIZER_INSTRUCTION = (
+    "You maintain a running record of a health coaching conversation. Summarize the messages below "
+    "in a few sentences, keeping concrete facts about the user's health, habits, injuries, goals and "
+    "the coach's open recommendations. Return plain text only."
+)
+
+
+def estimate_tokens(text):
+    """Cheap token estimate (about four characters per token) that needs no tokenizer."""
+    return len(text or "") // 4 + 1
+
+
+def estimate_message_tokens(message):
+    return estimate_tokens(message.get("content")) + MESSAGE_TOKEN_OVERHEAD
+
+
+def make_llm_summarizer(call_site="summary"):
+    """
+    Returns a summarizer callable backed by the shared xAI client.
+
+    The callable takes the messages of one conversation segment and returns a
+    short plain-text summary of them.
+    """
+    def summarize(messages):
+        transcript = "\n".join(
+            f"[{m.get('timestamp', '')}] {m['role']}: {m.get('content', '')}" for m in messages
+        )
+        response = chat_completion(call_site, [
+            {"role": "system", "content": SUMMARIZER_INSTRUCTION},
+            {"role": "user", "content": transcript},
+        ])
+        return response.choices[0].message.content
+    return summarize
+
+
+class ConversationSummaries:
+    """
+    Rolling summaries of the older part of a conversation, stored as
+    conversation_summaries.json next to the user's conversation log.
+
+    Each segment records the half-open message range [start, end) it covers.
+    Segments are appended as the conversation grows and the oldest two are
+    merged whenever the summaries outgrow their share of the token budget.
+    """
+
+    def __init__(self, user_dir):
+        self.path = Path(user_dir) / CONTEXT_SUMMARIES_FILENAME
+        self.segments = self._load()
+
+    def _load(self):
+        if not self.path.exists():
+            return []
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f).get("segments", [])
+        except (json.JSONDecodeError, AttributeError):
+            logging.error(f"Corrupted conversation summaries in {self.path}, rebuilding")
+            return []
+
+    def save(self):
+        atomic_write_json(self.path, {"segments": self.segments})
+
+    @property
+    def summarized_through(self):
+        return self.segments[-1]["end"] if self.segments else 0
+
+    def tokens(self):
+        return sum(estimate_tokens(segment["summary"]) for segment in self.segments)
+
+    def backlog(self, older_count):
+        """Number of full batches in [summarized_through, older_count) still to be summarized."""
+        return max(older_count - self.summarized_through, 0) // CONTEXT_SUMMARY_BATCH
+
+    def update(self, conversation, older_count, summarizer, summary_budget, max_batches=None):
+        """
+        Folds up to max_batches batches of messages [summarized_through, older_count)
+        into new segments.
+
+        The file is saved after every segment and merge, so a failing summarizer
+        call only loses that one call and the next update resumes from there.
+
+        Args:
+            conversation (list): The full conversation.
+            older_count (int): Number of leading messages outside the verbatim window.
+            summarizer (callable): Maps a list of messages to a summary string.
+            summary_budget (int): Token allowance for all segments together.
+            max_batches (int): Defaults to CONTEXT_SUMMARY_MAX_BATCHES.
+
+        Returns:
+            bool: True if the stored summaries changed.
+        """
+        max_batches = CONTEXT_SUMMARY_MAX_BATCHES if max_batches is None else max_batches
+        changed = False
+        if self.summarized_through > len(conversation):
+            # history was truncated underneath us; start over
+            self.segments = []
+            self.save()
+            changed = True
+
+        batches = 0
+        while batches < max_batches and self.backlog(older_count):
+            start = self.summarized_through
+            end = start + CONTEXT_SUMMARY_BATCH
+            summary = summarizer(conversation[start:end])
+            self.segments.append({
+                "start": start,
+                "end": end,
+                "summary": summary,
+                "first_timestamp": conversation[start].get("timestamp"),
+                "last_timestamp": conversation[end - 1].get("timestamp"),
+            })
+            self.save()
+            batches += 1
+            changed = True
+
+        while len(self.segments) > 1 and self.tokens() > summary_budget:
+            first, second = self.segments[0], self.segments[1]
+            merged = summarizer([
+                {"role": "system", "content": first["summary"], "timestamp": first.get("first_timestamp")},
+                {"role": "system", "content": second["summary"], "timestamp": second.get("last_timestamp")},
+            ])
+            self.segments[:2] = [{
+                "start": first["start"],
+                "end": second["end"],
+                "summary": merged,
+                "first_timestamp": first.get("first_timestamp"),
+                "last_timestamp": second.get("last_timestamp"),
+            }]
+            self.save()
+            changed = True
+        return changed
+
+    def as_message(self):
+        if not self.segments:
+            return None
+        lines = ["Summary of earlier conversation with this user, oldest first:"]
+        for segment in self.segments:
+            period = f"{segment.get('first_timestamp') or '?'} to {segment.get('last_timestamp') or '?'}"
+            lines.append(f"- ({period}) {segment['summary']}")
+        return {"role": "system", "content": "\n".join(lines)}
+
+
+def summary_backlog(conversation, user_dir, verbatim_turns=None):
+    """Number of summary batches build_context has not caught up on for a user."""
+    verbatim_turns = verbatim_turns if verbatim_turns is not None else CONTEXT_VERBATIM_TURNS
+    return ConversationSummaries(user_dir).backlog(max(len(conversation) - verbatim_turns, 0))
+
+
+def backfill_summaries(conversation, user_dir, summarizer, max_batches=None, token_budget=None,
+                       verbatim_turns=None):
+    """
+    Works through part of a user's summary backlog outside the request path.
+
+    Returns:
+        int: Batches still left afterwards.
+    """
+    token_budget = token_budget or CONTEXT_TOKEN_BUDGET
+    verbatim_turns = verbatim_turns if verbatim_turns is not None else CONTEXT_VERBATIM_TURNS
+    max_batches = CONTEXT_SUMMARY_JOB_BATCHES if max_batches is None else max_batches
+    older_count = max(len(conversation) - verbatim_turns, 0)
+    summaries = ConversationSummaries(user_dir)
+    summaries.update(conversation, older_count, summarizer, int(token_budget * CONTEXT_SUMMARY_SHARE), max_batches)
+    return summaries.backlog(older_count)
+
+
+def recall_message(conversation, user_dir, before, token_budget, top_k=None):
+    """
+    Finds the past exchanges most relevant to the newest user message.
+
+    Args:
+        conversation (list): The full conversation, newest message last.
+        user_dir (Path): Directory holding the user's recall index.
+        before (int): Position of the first message already sent verbatim; only
+            exchanges ending before it are recalled.
+        token_budget (int): Tokens the recalled exchanges may use.
+        top_k (int): Maximum exchanges; defaults to CONTEXT_RECALL_TOP_K.
+
+    Returns:
+        dict: A system message quoting the exchanges oldest first, or None.
+    """
+    top_k = CONTEXT_RECALL_TOP_K if top_k is None else top_k
+    if top_k <= 0 or not conversation or conversation[-1].get("role") != "user":
+        return None
+    index = get_recall_index(user_dir)
+    index.update(conversation)
+    chosen = []
+    remaining = token_budget
+    for _, start, end in index.search(conversation[-1].get("content"), top_k, before=before):
+        exchange = conversation[start:end]
+        cost = sum(estimate_message_tokens(m) for m in exchange)
+        if cost <= remaining:
+            chosen.append((start, exchange))
+            remaining -= cost
+    if not chosen:
+        return None
+    lines = ["Earlier exchanges with this user that may be relevant to the current update:"]
+    for _, exchange in sorted(chosen, key=lambda item: item[0]):
+        for message in exchange:
+            lines.append(f"[{message.get('timestamp') or '?'}] {message['role']}: {message.get('content')}")
+    return {"role": "system", "content": "\n".join(lines)}
+
+
+def build_context(system_message, conversation, user_dir, summarizer,
+                  token_budget=None, verbatim_turns=None):
+    """
+    Assembles the messages for a chat completion within a token budget.
+
+    The newest verbatim_turns messages are sent as-is, older messages are
+    represented by rolling summaries, and messages that are older than the
+    verbatim window but not yet summarized are sent as-is while they fit.
+    Up to CONTEXT_RECALL_TOP_K older exchanges that match the newest update
+    are quoted in full, so details a summary dropped can still be recalled.
+
+    Args:
+        system_message (str): The coach system prompt.
+        conversation (list): The full conversation, newest message last.
+        user_dir (Path): Directory holding the user's conversation files.
+        summarizer (callable): Maps a list of messages to a summary string.
+        token_budget (int): Total token allowance; defaults to CONTEXT_TOKEN_BUDGET.
+        verbatim_turns (int): Newest messages kept verbatim; defaults to CONTEXT_VERBATIM_TURNS.
+
+    Returns:
+        list: Messages with only role and content keys, ready for the API.
+    """
+    token_budget = token_budget or CONTEXT_TOKEN_BUDGET
+    verbatim_turns = verbatim_turns if verbatim_turns is not None else CONTEXT_VERBATIM_TURNS
+
+    older_count = max(len(conversation) - verbatim_turns, 0)
+    summaries = ConversationSummaries(user_dir)
+    try:
+        summaries.update(conversation, older_count, summarizer, int(token_budget * CONTEXT_SUMMARY_SHARE))
+    except Exception as e:
+        # a failed summary only costs context, never the health update itself
+        logging.error(f"Error updating conversation summaries: {str(e)}")
+
+    system = {"role": "system", "content": system_message}
+    remaining = token_budget - estimate_message_tokens(system)
+
+    summary_message = summaries.as_message()
+    if summary_message:
+        summary_tokens = estimate_message_tokens(summary_message)
+        if summary_tokens <= remaining:
+            remaining -= summary_tokens
+        else:
+            summary_message = None
+
+    # held back from the verbatim messages for recalled exchanges
+    recall_reserve = int(token_budget * CONTEXT_RECALL_SHARE) if CONTEXT_RECALL_TOP_K > 0 else 0
+    remaining -= recall_reserve
+
+    # newest first, so the most recent messages win whatever budget is left
+    start = min(summaries.summarized_through, older_count)
+    selected = []
+    for message in reversed(conversation[start:]):
+        cost = estimate_message_tokens(message)
+        if cost > remaining and selected:
+            break
+        selected.append({"role": message["role"], "content": message["content"]})
+        remaining -= cost
+    selected.reverse()
+
+    recalled = None
+    try:
+        recalled = recall_message(conversation, user_dir, len(conversation) - len(selected),
+                                  remaining + recall_reserve)
+    except Exception as e:
+        # like summaries, recall only ever adds context
+        logging.error(f"Error recalling earlier exchanges: {str(e)}")
+
+    dropped = len(conversation) - start - len(selected)
+    if dropped:
+        logging.info(f"Context budget of {token_budget} tokens dropped {dropped} unsummarized messages")
+
+    messages = [system]
+    if summary_message:
+        messages.append(summary_message)
+    if recalled:
+        messages.append(recalled)
+    return messages + selected
@@ -0,0 +1,318 @@
+import argparse
+import json
+import logging
+import os
+import threading
+from bisect import insort
+from pathlib import Path
+
+from .config import USERS_DIR
+from .locking import ConflictError, atomic_write_json, message_fingerprint, user_lock
+
+CONVERSATION_LOG_FILENAME = "conversation.jsonl"
+SESSION_META_FILENAME = "session_meta.json"
+LEGACY_SESSION_FILENAME = "session_state.json"
+CONTEXT_SUMMARIES_FILENAME = "conversation_summaries.json"
+RECALL_INDEX_FILENAME = "recall_index.jsonl"
+HEALTH_METRICS_FILENAME = "health_metrics.bin"
+HEALTH_METRICS_META_FILENAME = "health_metrics_meta.json"
+HEALTH_TRENDS_FILENAME = "health_trends.json"
+RECOMMENDATIONS_FILENAME = "recommendations.jsonl"
+
+# "jsonl" appends each message to conversation.jsonl; "json" keeps the original
+# behaviour of rewriting session_state.json on every save.
+SESSION_STORAGE_MODE = os.getenv("SESSION_STORAGE_MODE", "jsonl")
+
+
+def read_legacy_session_file(session_file):
+    """
+    Reads a session_state.json file in either of its historical layouts.
+
+    Args:
+        session_file (Path): Path to the legacy session_state.json.
+
+    Returns:
+        tuple: (conversation list, authentication dict).
+    """
+    with open(session_file, "r", encoding="utf-8") as f:
+        state_data = json.load(f)
+    if isinstance(state_data, list):
+        # oldest layout: a bare list of messages with no auth block
+        return state_data, {}
+    if isinstance(state_data, dict):
+        return state_data.get("conversation", []), state_data.get("authentication", {}) or {}
+    return [], {}
+
+
+class ConversationLog:
+    """
+    Append-only conversation storage for a single user directory.
+
+    Each user/assistant message is one JSON line in conversation.jsonl, and the
+    small auth/metadata block lives in session_meta.json, so a save only writes
+    the new messages plus a few hundred bytes regardless of history length.
+    """
+
+    def __init__(self, user_dir):
+        self.user_dir = Path(user_dir)
+        self.log_path = self.user_dir / CONVERSATION_LOG_FILENAME
+        self.meta_path = self.user_dir / SESSION_META_FILENAME
+        self.legacy_path = self.user_dir / LEGACY_SESSION_FILENAME
+
+    def exists(self):
+        return self.log_path.exists()
+
+    def load_meta(self):
+        if not self.meta_path.exists():
+            return {"message_count": 0, "authentication": {}}
+        try:
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except json.JSONDecodeError:
+            logging.error(f"Corrupted session metadata in {self.meta_path}, rebuilding")
+            meta = {}
+        meta.setdefault("message_count", 0)
+        meta.setdefault("authentication", {})
+        return meta
+
+    def save_meta(self, meta):
+        atomic_write_json(self.meta_path, meta)
+
+    def read_messages(self):
+        """Returns every valid message in the log, skipping torn or corrupt lines."""
+        messages = []
+        if not self.log_path.exists():
+            return messages
+        with open(self.log_path, "r", encoding="utf-8") as f:
+            for line_number, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    messages.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logging.warning(f"Skipping unreadable line {line_number} in {self.log_path}")
+        return messages
+
+    def append(self, messages, meta=None):
+        """
+        Appends messages to the log and bumps the stored message count.
+
+        Args:
+            messages (list): Message dicts with role, content and timestamp.
+            meta (dict): Already-loaded metadata, to avoid reading it twice.
+        """
+        meta = meta if meta is not None else self.load_meta()
+        if messages:
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                for message in messages:
+                    f.write(json.dumps(message, ensure_ascii=False) + "\n")
+        meta["message_count"] = meta.get("message_count", 0) + len(messages)
+        if messages:
+            meta["tail"] = message_fingerprint(messages[-1])
+        self.save_meta(meta)
+        return meta
+
+    def sync(self, conversation, authentication=None):
+        """
+        Persists whatever part of an in-memory conversation is not yet on disk.
+
+        Callers must hold the user's lock (see locking.user_lock).
+
+        Args:
+            conversation (list): Full conversation as held in the session.
+            authentication (dict): Auth block to store alongside the log.
+
+        Raises:
+            ConflictError: The stored log has messages this conversation does not
+                start with, i.e. another session saved since it was loaded.
+        """
+        meta = self.load_meta()
+        count = meta["message_count"]
+        tail = meta.get("tail")
+        if len(conversation) < count or (tail and count and message_fingerprint(conversation[count - 1]) != tail):
+            raise ConflictError(f"{self.log_path} has {count} messages that this conversation does not start with")
+        new_messages = conversation[count:]
+        if authentication is not None and authentication != meta.get("authentication"):
+            meta["authentication"] = authentication
+        elif not new_messages:
+            return meta
+        return self.append(new_messages, meta)
+
+    def load(self):
+        """
+        Loads the conversation and auth block, migrating a legacy
+        session_state.json into the log the first time it is seen.
+
+        Returns:
+            tuple: (conversation list, authentication dict).
+        """
+        if not self.log_path.exists() and self.legacy_path.exists():
+            with user_lock(self.user_dir.name):
+                if not self.log_path.exists():
+                    conversation, auth_data = read_legacy_session_file(self.legacy_path)
+                    self.append(conversation, {"message_count": 0, "authentication": auth_data})
+                    logging.info(f"Migrated {len(conversation)} messages from {self.legacy_path} to {self.log_path}")
+                    return conversation, auth_data
+
+        meta = self.load_meta()
+        conversation = self.read_messages()
+        if meta["message_count"] != len(conversation):
+            # usually a writer between appending and updating the metadata; only
+            # repair (trusting the log) when the mismatch survives taking the lock,
+            # i.e. a writer crashed there
+            with user_lock(self.user_dir.name):
+                meta = self.load_meta()
+                conversation = self.read_messages()
+                if meta["message_count"] != len(conversation):
+                    logging.warning(f"Session metadata count {meta['message_count']} does not match "
+                                    f"{len(conversation)} logged messages in {self.log_path}, repairing")
+                    meta["message_count"] = len(conversation)
+                    meta["tail"] = message_fingerprint(conversation[-1]) if conversation else None
+                    self.save_meta(meta)
+        return conversation, meta.get("authentication", {})
+
+    def compact(self):
+        """
+        Rewrites the log keeping only valid records and reconciles the metadata.
+
+        A migrated session_state.json is left in place, so switching back to
+        SESSION_STORAGE_MODE=json still finds the user's history.
+
+        Returns:
+            dict: Counts of kept and dropped lines.
+        """
+        if not self.log_path.exists():
+            self.load()
+        with open(self.log_path, "r", encoding="utf-8") as f:
+            total_lines = sum(1 for line in f if line.strip())
+        messages = self.read_messages()
+
+        tmp_path = self.log_path.with_suffix(".jsonl.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for message in messages:
+                f.write(json.dumps(message, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.log_path)
+
+        meta = self.load_meta()
+        meta["message_count"] = len(messages)
+        meta["tail"] = message_fingerprint(messages[-1]) if messages else None
+        self.save_meta(meta)
+
+        stats = {"kept": len(messages), "dropped": total_lines - len(messages)}
+        logging.info(f"Compacted {self.log_path}: {stats}")
+        return stats
+
+
+class ConversationIndex:
+    """
+    Byte offsets and timestamps of every message in a conversation log.
+
+    The index is built with one scan of the log and then extended from the last
+    indexed byte as messages are appended, so paging through history reads only
+    the lines on the requested page. Timestamps are kept as their
+    "%Y-%m-%d %H:%M:%S" strings, which sort chronologically without parsing.
+    """
+
+    def __init__(self, log_path):
+        self.log_path = Path(log_path)
+        self.inode = None
+        self.indexed_size = 0
+        # (timestamp, offset) pairs kept in chronological order
+        self.entries = []
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        try:
+            stat = os.stat(self.log_path)
+        except FileNotFoundError:
+            self.inode, self.indexed_size, self.entries = None, 0, []
+            return
+        if stat.st_ino != self.inode or stat.st_size < self.indexed_size:
+            # compaction replaced the file; start again
+            self.inode, self.indexed_size, self.entries = stat.st_ino, 0, []
+        if stat.st_size == self.indexed_size:
+            return
+        with open(self.log_path, "rb") as f:
+            f.seek(self.indexed_size)
+            offset = self.indexed_size
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # a write in progress; index it on the next refresh
+                    break
+                try:
+                    timestamp = json.loads(line).get("timestamp", "")
+                except (json.JSONDecodeError, AttributeError):
+                    timestamp = None
+                if timestamp is not None:
+                    insort(self.entries, (timestamp, offset))
+                offset += len(line)
+        self.indexed_size = offset
+
+    def page(self, page_number, page_size):
+        """
+        Returns one page of messages, newest first, and the total message count.
+
+        Args:
+            page_number (int): Zero-based page, where page 0 holds the newest messages.
+            page_size (int): Messages per page.
+
+        Returns:
+            tuple: (list of message dicts, total number of messages).
+        """
+        with self._lock:
+            self.refresh()
+            total = len(self.entries)
+            end = total - page_number * page_size
+            start = max(end - page_size, 0)
+            wanted = self.entries[start:end] if end > 0 else []
+        messages = []
+        with open(self.log_path, "rb") as f:
+            for _, offset in reversed(wanted):
+                f.seek(offset)
+                messages.append(json.loads(f.readline()))
+        return messages, total
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_conversation_index(user_dir):
+    """Returns the process-wide index for a user's conversation log."""
+    log_path = str(Path(user_dir) / CONVERSATION_LOG_FILENAME)
+    with _indexes_lock:
+        index = _indexes.get(log_path)
+        if index is None:
+            index = ConversationIndex(log_path)
+            _indexes[log_path] = index
+        return index
+
+
+def compact_all(users_dir):
+    """
+    Compacts the conversation log of every user directory under users_dir.
+
+    In json mode only existing logs are compacted; session_state.json is never
+    touched.
+    """
+    jsonl_mode = SESSION_STORAGE_MODE == "jsonl"
+    results = {}
+    for user_dir in Path(users_dir).iterdir():
+        if not user_dir.is_dir():
+            continue
+        log = ConversationLog(user_dir)
+        if log.exists() or jsonl_mode and log.legacy_path.exists():
+            with user_lock(user_dir.name):
+                results[user_dir.name] = log.compact()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compact append-only conversation logs.')
+    parser.add_argument('--users_dir', type=str, default=str(USERS_DIR),
+                        help='Directory containing one subdirectory per user')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    for user, stats in compact_all(args.users_dir).items():
+        print(user, stats)
@@ -0,0 +1,233 @@
+import argparse
+import logging
+import os
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from .config import XAI_HEALTH_DIR
+from .storage import get_storage
+
+ENTITLEMENTS_DB_PATH = os.getenv("ENTITLEMENTS_DB_PATH", os.path.join(XAI_HEALTH_DIR, "entitlements.sqlite3"))
+# Seconds a subscription status is trusted before Stripe is asked again.
+ENTITLEMENT_TTL = int(os.getenv("ENTITLEMENT_TTL", "900"))
+# Network timeout for Stripe calls made on the request path.
+STRIPE_TIMEOUT = float(os.getenv("STRIPE_TIMEOUT", "3"))
+# Point at a local Stripe stand-in such as stripe-mock (http://localhost:12111) for testing.
+STRIPE_API_BASE = os.getenv("STRIPE_API_BASE")
+STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
+
+ACTIVE_SUBSCRIPTION_STATUSES = ("active", "trialing")
+SUBSCRIPTION_EVENTS = (
+    "customer.subscription.created",
+    "customer.subscription.updated",
+    "customer.subscription.deleted",
+    "customer.subscription.paused",
+    "customer.subscription.resumed",
+)
+
+
+def configure_stripe(stripe_api, api_key=None):
+    """Applies the key, optional local API base and a short timeout to the stripe module."""
+    if api_key:
+        stripe_api.api_key = api_key
+    if STRIPE_API_BASE:
+        stripe_api.api_base = STRIPE_API_BASE
+    http_client_class = getattr(stripe_api, "RequestsClient", None)
+    if http_client_class is None and hasattr(stripe_api, "http_client"):
+        http_client_class = stripe_api.http_client.RequestsClient
+    if http_client_class is not None and not getattr(stripe_api, "_entitlements_configured", False):
+        stripe_api.default_http_client = http_client_class(timeout=STRIPE_TIMEOUT)
+        stripe_api._entitlements_configured = True
+
+
+class EntitlementStore:
+    """
+    Local cache of each user's Stripe customer ID and subscription status.
+
+    Reruns are answered from SQLite while the cached status is younger than the
+    TTL; webhook events keep it current between refreshes, and a stale status is
+    served when Stripe is slow or unreachable.
+    """
+
+    def __init__(self, path=None, ttl=None, storage=None):
+        self.path = Path(path or ENTITLEMENTS_DB_PATH)
+        self.ttl = ENTITLEMENT_TTL if ttl is None else ttl
+        self.storage = storage or get_storage()
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS entitlements (
+                user_id TEXT PRIMARY KEY NOT NULL,
+                customer_id TEXT,
+                status TEXT,
+                active INTEGER NOT NULL DEFAULT 0,
+                checked_at REAL NOT NULL DEFAULT 0,
+                source TEXT
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entitlements_customer ON entitlements (customer_id)")
+        self._conn.commit()
+
+    def get(self, user_id):
+        if not user_id:
+            return None
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM entitlements WHERE user_id = ?", (user_id,)).fetchone()
+        return dict(row) if row else None
+
+    def record(self, user_id, customer_id, status, source):
+        if not user_id:
+            return None
+        active = int(status in ACTIVE_SUBSCRIPTION_STATUSES)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO entitlements (user_id, customer_id, status, active, checked_at, source) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET customer_id = excluded.customer_id, status = excluded.status, "
+                "active = excluded.active, checked_at = excluded.checked_at, source = excluded.source",
+                (user_id, customer_id, status, active, time.time(), source),
+            )
+            self._conn.commit()
+        return self.get(user_id)
+
+    def is_fresh(self, entitlement):
+        return entitlement is not None and entitlement["status"] is not None \
+            and time.time() - entitlement["checked_at"] < self.ttl
+
+    def get_or_create_customer_id(self, user_id, stripe_api, entitlement=None):
+        if entitlement and entitlement.get("customer_id"):
+            return entitlement["customer_id"]
+        customer_id = self.storage.load_customer_id(user_id)
+        if customer_id:
+            return customer_id
+        customer = stripe_api.Customer.create(email=f"{user_id}@example.com")
+        customer_id = customer["id"]
+        self.storage.save_customer_id(user_id, customer_id)
+        return customer_id
+
+    def check(self, user_id, api_key=None, stripe_api=None, force=False):
+        """
+        Returns the user's entitlement, asking Stripe only when the cached one is stale.
+
+        Args:
+            user_id (str): The user to check.
+            api_key (str): Stripe secret key.
+            stripe_api: The stripe module or a stand-in with the same interface.
+            force (bool): Ignore the TTL and refresh from Stripe.
+
+        Returns:
+            dict: Row with customer_id, status, active, checked_at and source, or
+                None without a user_id (nobody logged in), in which case Stripe is not called.
+
+        Raises:
+            Exception: Whatever Stripe raised, if there is no cached status to fall back on.
+        """
+        if not user_id:
+            return None
+        entitlement = self.get(user_id)
+        if not force and self.is_fresh(entitlement):
+            return entitlement
+
+        if stripe_api is None:
+            import stripe as stripe_api
+        configure_stripe(stripe_api, api_key)
+        try:
+            customer_id = self.get_or_create_customer_id(user_id, stripe_api, entitlement)
+            subscriptions = stripe_api.Subscription.list(customer=customer_id, limit=1)
+            status = subscriptions.data[0].status if subscriptions.data else "none"
+            return self.record(user_id, customer_id, status, "api")
+        except Exception as e:
+            if entitlement and entitlement["status"] is not None:
+                age = time.time() - entitlement["checked_at"]
+                logging.warning(f"Stripe unavailable for {user_id} ({str(e)}), using status cached {age:.0f}s ago")
+                return entitlement
+            raise
+
+    def apply_subscription_event(self, event):
+        """
+        Updates the cached status from a customer.subscription.* webhook event.
+
+        Returns:
+            str: The user ID that was updated, or None if the customer is unknown.
+        """
+        if event["type"] not in SUBSCRIPTION_EVENTS:
+            return None
+        subscription = event["data"]["object"]
+        customer_id = subscription["customer"]
+        status = "canceled" if event["type"] == "customer.subscription.deleted" else subscription["status"]
+        with self._lock:
+            row = self._conn.execute("SELECT user_id FROM entitlements WHERE customer_id = ?",
+                                     (customer_id,)).fetchone()
+        if row is None:
+            logging.info(f"Ignoring {event['type']} for unknown customer {customer_id}")
+            return None
+        self.record(row["user_id"], customer_id, status, "webhook")
+        logging.info(f"Entitlement for {row['user_id']} set to {status} by {event['type']}")
+        return row["user_id"]
+
+
+def handle_stripe_webhook(store, payload, sig_header, webhook_secret=None, stripe_api=None):
+    """
+    Verifies a Stripe webhook delivery and applies it to the entitlement store.
+
+    Args:
+        store (EntitlementStore): Store to update.
+        payload (bytes): Raw request body.
+        sig_header (str): Value of the Stripe-Signature header.
+        webhook_secret (str): Endpoint signing secret; defaults to STRIPE_WEBHOOK_SECRET.
+        stripe_api: The stripe module or a stand-in with the same interface.
+
+    Returns:
+        str: The user ID that was updated, or None.
+    """
+    if stripe_api is None:
+        import stripe as stripe_api
+    event = stripe_api.Webhook.construct_event(payload, sig_header, webhook_secret or STRIPE_WEBHOOK_SECRET)
+    return store.apply_subscription_event(event)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_entitlement_store():
+    """Returns the process-wide entitlement store."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = EntitlementStore()
+        return _store
+
+
+class StripeWebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        payload = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            handle_stripe_webhook(get_entitlement_store(), payload, self.headers.get("Stripe-Signature"))
+        except Exception as e:
+            logging.error(f"Rejected Stripe webhook: {str(e)}")
+            self.send_response(400)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Receive Stripe subscription webhooks into the entitlement store.')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    server = ThreadingHTTPServer((args.host, args.port), StripeWebhookHandler)
+    logging.info(f"Listening for Stripe webhooks on {args.host}:{args.port}")
+    server.serve_forever()
@@ -0,0 +1,366 @@
+import argparse
+import calendar
+import json
+import logging
+import os
+import re
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+from .config import USERS_DIR
+from .conversation_store import HEALTH_METRICS_FILENAME, HEALTH_METRICS_META_FILENAME
+from .locking import atomic_write_json
+
+# Every metric the extractor can produce: unit and how values within one day combine.
+METRIC_DEFINITIONS = {
+    "sleep_hours": {"unit": "h", "daily": "mean"},
+    "walk_minutes": {"unit": "min", "daily": "sum"},
+    "exercise_minutes": {"unit": "min", "daily": "sum"},
+    "steps": {"unit": "steps", "daily": "sum"},
+    "weight_kg": {"unit": "kg", "daily": "last"},
+    "stress_score": {"unit": "/10", "daily": "mean"},
+    "beverage_oz": {"unit": "oz", "daily": "sum"},
+    "water_oz": {"unit": "oz", "daily": "sum"},
+    "coffee_oz": {"unit": "oz", "daily": "sum"},
+    "tea_oz": {"unit": "oz", "daily": "sum"},
+    "soda_oz": {"unit": "oz", "daily": "sum"},
+    "diet_soda_oz": {"unit": "oz", "daily": "sum"},
+    "alcohol_oz": {"unit": "oz", "daily": "sum"},
+}
+
+# One fixed-size record per extracted value, appended to a flat binary file.
+RECORD_DTYPE = np.dtype([("ts", "<f8"), ("metric", "<u2"), ("value", "<f8"), ("seq", "<i4")])
+
+NUMBER = r"(\d+(?:[.,]\d+)?|an?|one|two|three|four|five|six|seven|eight|nine|ten|half an?)"
+WORD_NUMBERS = {"a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7,
+                "eight": 8, "nine": 9, "ten": 10, "half a": 0.5, "half an": 0.5}
+VOLUME_TO_OZ = {"oz": 1, "ounce": 1, "ounces": 1, "fl oz": 1, "cup": 8, "cups": 8, "glass": 8, "glasses": 8,
+                "can": 12, "cans": 12, "bottle": 16.9, "bottles": 16.9, "ml": 0.033814, "l": 33.814,
+                "liter": 33.814, "liters": 33.814, "litre": 33.814, "litres": 33.814, "pint": 16, "pints": 16,
+                "mug": 10, "mugs": 10}
+BEVERAGE_METRICS = [
+    (r"diet (?:soda|coke|pop|cola)|coke zero|diet coke", "diet_soda_oz"),
+    (r"soda|coke|pop|cola|soft drinks?", "soda_oz"),
+    (r"water", "water_oz"),
+    (r"coffee|espresso|latte|cappuccino", "coffee_oz"),
+    (r"tea", "tea_oz"),
+    (r"beer|wine|whiske?y|vodka|gin|rum|cocktails?|alcohol", "alcohol_oz"),
+]
+BEVERAGE_WORDS = "|".join(pattern for pattern, _ in BEVERAGE_METRICS)
+VOLUME_UNITS = "|".join(sorted((re.escape(unit) for unit in VOLUME_TO_OZ), key=len, reverse=True))
+# Drinks counted without a volume ("one diet coke", "two coffees"): metric and ounces per serving.
+SERVINGS = [
+    (r"diet (?:sodas?|cokes?|colas?)|coke zeros?", "diet_soda_oz", 12),
+    (r"sodas?|cokes?|colas?|soft drinks?", "soda_oz", 12),
+    (r"coffees?|espressos?|lattes?|cappuccinos?", "coffee_oz", 8),
+    (r"teas?", "tea_oz", 8),
+    (r"beers?", "alcohol_oz", 12),
+    (r"wines?|cocktails?", "alcohol_oz", 5),
+]
+SERVING_WORDS = "|".join(pattern for pattern, _, _ in SERVINGS)
+# Filler allowed between an activity and its duration, as in "walked the dog for 30 minutes".
+ACTIVITY_FILLER = r"(?:\s+[a-z']+){0,3}?"
+# "ran 5 minutes late" is about being late, not exercise.
+NOT_LATE = r"(?!\s+(?:late|early|behind|ahead|over|short)\b)"
+
+PATTERNS = [
+    ("sleep_hours", re.compile(rf"\b(?:slept|sleep(?:ing)?)\s+(?:for\s+)?(?:about\s+|around\s+)?{NUMBER}\s*"
+                               rf"(?:hours?|hrs?|h)\b", re.I), 1),
+    ("sleep_hours", re.compile(rf"\b{NUMBER}\s*(?:hours?|hrs?|h)\s+(?:of\s+)?sleep", re.I), 1),
+    ("walk_minutes", re.compile(rf"\bwalked{ACTIVITY_FILLER}\s+(?:for\s+)?(?:about\s+|around\s+)?{NUMBER}\s*"
+                                rf"(?:minutes?|mins?)\b{NOT_LATE}", re.I), 1),
+    ("walk_minutes", re.compile(rf"\b{NUMBER}[\s-]*(?:minutes?|mins?)\s+(?:of\s+)?walk", re.I), 1),
+    ("walk_minutes", re.compile(rf"\bwalked{ACTIVITY_FILLER}\s+(?:for\s+)?(?:about\s+|around\s+)?{NUMBER}\s*"
+                                rf"(?:hours?|hrs?)\b{NOT_LATE}", re.I), 60),
+    ("exercise_minutes", re.compile(rf"\b(?:ran|jogged|cycled|biked|swam|lifted|worked out|exercised|yoga)"
+                                    rf"{ACTIVITY_FILLER}\s+(?:for\s+)?(?:about\s+|around\s+)?{NUMBER}\s*"
+                                    rf"(?:minutes?|mins?)\b{NOT_LATE}", re.I), 1),
+    ("steps", re.compile(r"\b(\d{1,3}(?:,\d{3})+|\d+(?:\.\d+)?k?)\s+steps\b", re.I), 1),
+    ("weight_kg", re.compile(rf"\b(?:weigh(?:ed|t|s)?|weight\s+(?:is|was)?)\s*(?:in\s+at\s+)?{NUMBER}\s*"
+                             rf"(?:kg|kilos?|kilograms?)\b", re.I), 1),
+    ("weight_kg", re.compile(rf"\b(?:weigh(?:ed|t|s)?|weight\s+(?:is|was)?)\s*(?:in\s+at\s+)?{NUMBER}\s*"
+                             rf"(?:lbs?|pounds?)\b", re.I), 0.45359237),
+    ("stress_score", re.compile(r"\bstress(?:\s+level)?\s*(?:is|was|of|at|:)?\s*(\d+(?:\.\d+)?)\s*(?:/|out of)\s*10\b",
+                                re.I), 1),
+]
+BEVERAGE_PATTERN = re.compile(
+    rf"\b{NUMBER}\s*({VOLUME_UNITS})\.?\s+(?:of\s+)?(?:[a-z]+\s+){{0,2}}?({BEVERAGE_WORDS})\b", re.I)
+SERVING_PATTERN = re.compile(rf"\b{NUMBER}\s+(?:[a-z]+\s+)??({SERVING_WORDS})\b"
+                             rf"(?!\s+(?:breaks?|shops?|tables?|bags?|dates?|meetings?|time)\b)", re.I)
+
+
+def parse_number(text):
+    text = text.lower().strip()
+    if text in WORD_NUMBERS:
+        return float(WORD_NUMBERS[text])
+    if text.endswith("k"):
+        return float(text[:-1]) * 1000
+    if re.fullmatch(r"\d{1,3}(?:,\d{3})+", text):
+        return float(text.replace(",", ""))
+    return float(text.replace(",", "."))
+
+
+def extract_metrics(text):
+    """
+    Pulls typed health metrics out of a free-text health update.
+
+    Args:
+        text (str): e.g. "Slept 6 hours, drank 32 oz diet soda and walked 11 minutes."
+
+    Returns:
+        list: (metric name, value) pairs in canonical units, see METRIC_DEFINITIONS.
+    """
+    found = []
+    claimed = []
+
+    def overlaps(span):
+        return any(span[0] < end and start < span[1] for start, end in claimed)
+
+    for metric, pattern, factor in PATTERNS:
+        for match in pattern.finditer(text or ""):
+            if overlaps(match.span()):
+                continue
+            try:
+                value = parse_number(match.group(1)) * factor
+            except ValueError:
+                continue
+            claimed.append(match.span())
+            found.append((metric, round(value, 3)))
+
+    for match in BEVERAGE_PATTERN.finditer(text or ""):
+        try:
+            ounces = parse_number(match.group(1)) * VOLUME_TO_OZ[match.group(2).lower()]
+        except (ValueError, KeyError):
+            continue
+        drink = match.group(3).lower()
+        # "diet soda" must not also count as soda, so the first matching kind wins
+        kind = next(metric for pattern, metric in BEVERAGE_METRICS if re.fullmatch(pattern, drink))
+        if kind == "soda_oz" and re.search(r"\bdiet\s+" + re.escape(drink), match.group(0), re.I):
+            kind = "diet_soda_oz"
+        claimed.append(match.span())
+        found.append((kind, round(ounces, 2)))
+        found.append(("beverage_oz", round(ounces, 2)))
+
+    for match in SERVING_PATTERN.finditer(text or ""):
+        if overlaps(match.span()):
+            continue
+        try:
+            count = parse_number(match.group(1))
+        except ValueError:
+            continue
+        drink = match.group(2).lower()
+        kind, serving = next((metric, ounces) for pattern, metric, ounces in SERVINGS if re.fullmatch(pattern, drink))
+        found.append((kind, round(count * serving, 2)))
+        found.append(("beverage_oz", round(count * serving, 2)))
+    return found
+
+
+def parse_timestamp(timestamp):
+    """
+    Message timestamps are local wall-clock strings; they are stored as seconds
+    since 1970-01-01 on that same wall clock, so ts // 86400 is the user's day.
+    """
+    try:
+        return float(calendar.timegm(time.strptime(timestamp, "%Y-%m-%d %H:%M:%S")))
+    except (TypeError, ValueError):
+        return None
+
+
+def wall_clock_now():
+    return float(calendar.timegm(time.localtime()))
+
+
+class HealthMetricStore:
+    """
+    Columnar time series of one user's extracted health metrics.
+
+    Values live in health_metrics.bin as fixed-size (ts, metric, value, seq)
+    records, appended as updates arrive and loaded with one np.fromfile call.
+    health_metrics_meta.json holds the metric name table and the position of
+    the last message extracted, so ingest() only parses new messages.
+    """
+
+    def __init__(self, user_dir):
+        self.user_dir = Path(user_dir)
+        self.path = self.user_dir / HEALTH_METRICS_FILENAME
+        self.meta_path = self.user_dir / HEALTH_METRICS_META_FILENAME
+        self._lock = threading.Lock()
+        self._records = None
+        self._signature = None
+        self.meta = self._load_meta()
+
+    def _load_meta(self):
+        if self.meta_path.exists():
+            try:
+                with open(self.meta_path, "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+                meta.setdefault("metrics", [])
+                meta.setdefault("extracted_through", 0)
+                return meta
+            except json.JSONDecodeError:
+                logging.error(f"Corrupted health metric metadata in {self.meta_path}, re-extracting")
+        return {"metrics": [], "extracted_through": 0}
+
+    def _save_meta(self):
+        atomic_write_json(self.meta_path, self.meta)
+
+    def _metric_code(self, metric):
+        if metric not in self.meta["metrics"]:
+            self.meta["metrics"].append(metric)
+        return self.meta["metrics"].index(metric)
+
+    def records(self):
+        """All records as a structured array sorted by timestamp, re-read only when the file changed."""
+        with self._lock:
+            return self._read_records()
+
+    def signature(self):
+        """(mtime_ns, size) of the record file, or None; changes whenever values are added."""
+        with self._lock:
+            self._read_records()
+            return self._signature
+
+    def _read_records(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            if self._signature is not None:
+                # removed underneath us, e.g. by retention; the metadata went with it
+                self.meta = self._load_meta()
+            self._records, self._signature = np.empty(0, dtype=RECORD_DTYPE), None
+            return self._records
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature != self._signature:
+            # a torn trailing record from a crash is ignored rather than misaligning the rest
+            count = stat.st_size // RECORD_DTYPE.itemsize
+            records = np.fromfile(self.path, dtype=RECORD_DTYPE, count=count)
+            self._records = records[np.argsort(records["ts"], kind="stable")]
+            self._signature = signature
+            self.meta = self._load_meta()
+        return self._records
+
+    def ingest(self, conversation):
+        """
+        Extracts metrics from the user messages added since the last ingest.
+
+        Args:
+            conversation (list): The user's full conversation, newest message last.
+
+        Returns:
+            int: Number of metric values stored.
+        """
+        with self._lock:
+            self._read_records()
+            start = self.meta["extracted_through"]
+            if start > len(conversation):
+                # the conversation was deleted or replaced; extract it again from scratch
+                if self.path.exists():
+                    self.path.unlink()
+                self._read_records()
+                start = 0
+            rows = []
+            for seq in range(start, len(conversation)):
+                message = conversation[seq]
+                if message.get("role") != "user":
+                    continue
+                ts = parse_timestamp(message.get("timestamp")) or wall_clock_now()
+                for metric, value in extract_metrics(message.get("content")):
+                    rows.append((ts, self._metric_code(metric), value, seq))
+            self.meta["extracted_through"] = len(conversation)
+            if rows:
+                self.user_dir.mkdir(parents=True, exist_ok=True)
+                # the name table must be on disk before records that use its codes
+                self._save_meta()
+                with open(self.path, "ab") as f:
+                    np.array(rows, dtype=RECORD_DTYPE).tofile(f)
+                self._read_records()
+            else:
+                self._save_meta()
+            return len(rows)
+
+    def metrics(self):
+        """Names of the metrics this user has values for."""
+        records = self.records()
+        codes = np.unique(records["metric"])
+        return [self.meta["metrics"][code] for code in codes]
+
+    def series(self, metric, start=None, end=None):
+        """
+        Returns one metric's values in a time range.
+
+        Args:
+            metric (str): e.g. "sleep_hours".
+            start (float): Inclusive wall-clock seconds (see parse_timestamp); None for no lower bound.
+            end (float): Exclusive wall-clock seconds; None for no upper bound.
+
+        Returns:
+            tuple: (timestamps, values) as float64 arrays in time order.
+        """
+        records = self.records()
+        if metric not in self.meta["metrics"]:
+            return np.empty(0), np.empty(0)
+        lo = 0 if start is None else np.searchsorted(records["ts"], start, side="left")
+        hi = len(records) if end is None else np.searchsorted(records["ts"], end, side="left")
+        window = records[lo:hi]
+        window = window[window["metric"] == self.meta["metrics"].index(metric)]
+        return window["ts"].copy(), window["value"].copy()
+
+    def daily(self, metric, start=None, end=None):
+        """
+        Combines a metric into one value per calendar day that has data.
+
+        Returns:
+            tuple: (days as datetime64[D], values) in day order.
+        """
+        ts, values = self.series(metric, start, end)
+        if not len(ts):
+            return np.empty(0, dtype="datetime64[D]"), np.empty(0)
+        days = (ts // 86400).astype("int64")
+        unique_days, inverse = np.unique(days, return_inverse=True)
+        how = METRIC_DEFINITIONS.get(metric, {}).get("daily", "mean")
+        if how == "last":
+            # series() is in time order, so the last record of each day closes its run
+            combined = values[np.flatnonzero(np.r_[days[1:] != days[:-1], True])]
+        else:
+            combined = np.bincount(inverse, weights=values, minlength=len(unique_days))
+            if how == "mean":
+                combined = combined / np.bincount(inverse, minlength=len(unique_days))
+        return unique_days.astype("datetime64[D]"), combined
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_health_metric_store(user_dir):
+    """Returns the process-wide metric store for a user directory."""
+    key = str(Path(user_dir))
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = HealthMetricStore(user_dir)
+            _stores[key] = store
+        return store
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Show the health metrics extracted for a user.')
+    parser.add_argument('user_id', type=str, nargs='?')
+    parser.add_argument('--metric', type=str, help='Print daily values of one metric')
+    parser.add_argument('--text', type=str, help='Only run the extractor on this text and print the result')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.text is None and not args.user_id:
+        parser.error('give a user_id or --text')
+    if args.text is not None:
+        print(extract_metrics(args.text))
+    else:
+        store = HealthMetricStore(USERS_DIR / args.user_id)
+        if args.metric:
+            for day, value in zip(*store.daily(args.metric)):
+                print(day, round(float(value), 2))
+        else:
+            print(store.metrics())
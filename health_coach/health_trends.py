@@ -0,0 +1,246 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import warnings
+from pathlib import Path
+
+import numpy as np
+
+from .config import USERS_DIR
+from .conversation_store import HEALTH_METRICS_FILENAME, HEALTH_TRENDS_FILENAME
+from .health_metrics import METRIC_DEFINITIONS, get_health_metric_store, wall_clock_now
+from .locking import atomic_write_json
+
+# Days of history the trends look at; the rolling means need at least 30.
+TREND_WINDOW_DAYS = max(30, int(os.getenv("TREND_WINDOW_DAYS", "60")))
+# At most this many trend lines go into the system message.
+TREND_MAX_LINES = int(os.getenv("TREND_MAX_LINES", "5"))
+# Days whose robust z-score against the last 30 days exceeds this are outliers.
+TREND_OUTLIER_Z = float(os.getenv("TREND_OUTLIER_Z", "3.5"))
+OUTLIER_LOOKBACK_DAYS = 14
+OUTLIER_MIN_DAYS = 7
+
+# Daily targets for streaks; metrics without one get no streak.
+GOALS = {
+    "sleep_hours": 7,
+    "walk_minutes": 30,
+    "exercise_minutes": 20,
+    "steps": 7000,
+    "water_oz": 64,
+}
+
+
+def dense_daily(store, metric, today, window=TREND_WINDOW_DAYS):
+    """
+    One metric's daily values for the window ending today, NaN on days without data.
+
+    Args:
+        store (HealthMetricStore): The user's metric store.
+        today (int): Day number (wall-clock seconds // 86400) of the last column.
+
+    Returns:
+        np.ndarray: float64 array of length window, oldest day first.
+    """
+    first = today - window + 1
+    days, values = store.daily(metric, start=first * 86400.0, end=(today + 1) * 86400.0)
+    dense = np.full(window, np.nan)
+    dense[days.astype("int64") - first] = values
+    return dense
+
+
+def _window_mean(matrix, days):
+    window = matrix[:, -days:]
+    counts = np.count_nonzero(~np.isnan(window), axis=1)
+    sums = np.nansum(window, axis=1)
+    return np.divide(sums, counts, out=np.full(len(matrix), np.nan), where=counts > 0), counts
+
+
+def compute_trends(matrix, goal=None):
+    """
+    Trend statistics for many users' daily series of one metric at once.
+
+    Args:
+        matrix (np.ndarray): users x days, NaN where a day has no data, last column today.
+        goal (float): Daily target for the streak, or None.
+
+    Returns:
+        dict: Arrays with one entry per user: mean_7d, mean_30d, days_7d, days_30d,
+            week_delta (last 7 days' mean minus the 7 before), streak (days in a row
+            meeting the goal, ending today or yesterday when today has no data yet),
+            outlier_offset (days before today of the latest outlier in the last
+            OUTLIER_LOOKBACK_DAYS, -1 for none) and outlier_value.
+    """
+    matrix = np.atleast_2d(np.asarray(matrix, dtype=float))
+    users = len(matrix)
+    mean_7d, days_7d = _window_mean(matrix, 7)
+    mean_30d, days_30d = _window_mean(matrix, 30)
+    prior_7d, _ = _window_mean(matrix[:, :-7], 7)
+
+    streak = np.zeros(users, dtype=int)
+    if goal is not None:
+        met = np.nan_to_num(matrix, nan=-np.inf) >= goal
+        # a day not yet logged does not break the streak that ended yesterday
+        today_missing = np.isnan(matrix[:, -1])
+        met[today_missing, -1] = True
+        run = np.cumprod(met[:, ::-1], axis=1).sum(axis=1)
+        streak = run - today_missing
+
+    recent = matrix[:, -30:]
+    with warnings.catch_warnings():
+        # rows without any data produce all-NaN slices; they are masked out below
+        warnings.simplefilter("ignore", RuntimeWarning)
+        median = np.nanmedian(recent, axis=1, keepdims=True)
+        mad = np.nanmedian(np.abs(recent - median), axis=1, keepdims=True)
+    usable = (days_30d >= OUTLIER_MIN_DAYS)[:, None] & (mad > 0)
+    scale = np.where(usable, mad / 0.6745, np.inf)
+    z = np.abs(recent - median) / scale
+    outliers = np.nan_to_num(z, nan=0.0)[:, -OUTLIER_LOOKBACK_DAYS:] > TREND_OUTLIER_Z
+    latest = np.argmax(outliers[:, ::-1], axis=1)
+    outlier_offset = np.where(outliers.any(axis=1), latest, -1)
+    outlier_value = np.where(outlier_offset >= 0, recent[np.arange(users), -1 - np.maximum(outlier_offset, 0)], np.nan)
+
+    return {"mean_7d": mean_7d, "mean_30d": mean_30d, "days_7d": days_7d, "days_30d": days_30d,
+            "week_delta": mean_7d - prior_7d, "streak": streak,
+            "outlier_offset": outlier_offset, "outlier_value": outlier_value}
+
+
+def _number(value):
+    return f"{value:,.0f}" if abs(value) >= 100 else f"{value:.1f}"
+
+
+def format_trend(metric, trends, row, today):
+    """One compact line for a user's metric, or None when there is nothing recent to say."""
+    if trends["days_30d"][row] == 0:
+        return None
+    unit = METRIC_DEFINITIONS.get(metric, {}).get("unit", "")
+    label = metric.rsplit("_", 1)[0].replace("_", " ") if metric in METRIC_DEFINITIONS and "_" in metric else metric
+    parts = []
+    if trends["days_7d"][row]:
+        part = f"7-day avg {_number(trends['mean_7d'][row])} {unit} ({trends['days_7d'][row]}/7 days logged)"
+        delta = trends["week_delta"][row]
+        if not np.isnan(delta):
+            part += f", {'+' if delta >= 0 else '-'}{_number(abs(delta))} vs prior week"
+        parts.append(part)
+    parts.append(f"30-day avg {_number(trends['mean_30d'][row])} {unit}")
+    if metric in GOALS and trends["streak"][row] >= 2:
+        parts.append(f"{trends['streak'][row]}-day streak at or above {_number(GOALS[metric])} {unit}")
+    offset = trends["outlier_offset"][row]
+    if offset >= 0:
+        day = np.datetime64(today - int(offset), "D")
+        parts.append(f"unusual {_number(trends['outlier_value'][row])} {unit} on {day}")
+    return f"{label}: " + "; ".join(parts)
+
+
+def trend_lines(metric_trends, row, today, max_lines=TREND_MAX_LINES):
+    """Picks the most regularly logged metrics' lines for one user."""
+    ranked = sorted(metric_trends.items(), key=lambda item: -item[1]["days_30d"][row])
+    lines = []
+    for metric, trends in ranked:
+        line = format_trend(metric, trends, row, today)
+        if line:
+            lines.append(line)
+        if len(lines) >= max_lines:
+            break
+    return lines
+
+
+def _write_trends(user_dir, signature, today, lines):
+    atomic_write_json(Path(user_dir) / HEALTH_TRENDS_FILENAME,
+                      {"signature": list(signature) if signature else None, "day": today, "lines": lines})
+
+
+def _read_trends(user_dir):
+    path = Path(user_dir) / HEALTH_TRENDS_FILENAME
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except json.JSONDecodeError:
+        logging.error(f"Corrupted health trends in {path}, recomputing")
+        return None
+
+
+_trend_cache = {}
+_trend_cache_lock = threading.Lock()
+
+
+def get_trend_lines(user_dir):
+    """
+    Compact trend lines for one user's system message.
+
+    Recomputed only when the user's metric file changed or the day rolled over;
+    otherwise served from memory or from health_trends.json, which the batch job
+    may already have written.
+    """
+    key = str(Path(user_dir))
+    store = get_health_metric_store(user_dir)
+    signature = store.signature()
+    if signature is None:
+        return []
+    today = int(wall_clock_now() // 86400)
+    state = {"signature": list(signature), "day": today}
+    with _trend_cache_lock:
+        cached = _trend_cache.get(key)
+    if cached is None:
+        cached = _read_trends(user_dir)
+    if cached and cached.get("signature") == state["signature"] and cached.get("day") == today:
+        lines = cached["lines"]
+    else:
+        metric_trends = {metric: compute_trends(dense_daily(store, metric, today), GOALS.get(metric))
+                         for metric in store.metrics()}
+        lines = trend_lines(metric_trends, 0, today)
+        _write_trends(user_dir, signature, today, lines)
+    with _trend_cache_lock:
+        _trend_cache[key] = {**state, "lines": lines}
+    return lines
+
+
+def run_trend_batch(users_dir=USERS_DIR):
+    """
+    Computes every user's trends in one pass and writes their health_trends.json.
+
+    Each metric is stacked into one users x days matrix, so the statistics for
+    all users come from a handful of NumPy reductions.
+
+    Returns:
+        dict: Number of users processed and trend lines written.
+    """
+    user_dirs = sorted(path.parent for path in Path(users_dir).glob(f"*/{HEALTH_METRICS_FILENAME}"))
+    today = int(wall_clock_now() // 86400)
+    stores = [get_health_metric_store(user_dir) for user_dir in user_dirs]
+    signatures = [store.signature() for store in stores]
+    metrics = sorted({metric for store in stores for metric in store.metrics()})
+    metric_trends = {}
+    for metric in metrics:
+        matrix = np.vstack([dense_daily(store, metric, today) for store in stores])
+        metric_trends[metric] = compute_trends(matrix, GOALS.get(metric))
+    lines_written = 0
+    for row, (user_dir, signature) in enumerate(zip(user_dirs, signatures)):
+        if signature is None:
+            continue
+        lines = trend_lines(metric_trends, row, today)
+        try:
+            _write_trends(user_dir, signature, today, lines)
+        except OSError as e:
+            logging.error(f"Error writing health trends for {user_dir}: {str(e)}")
+            continue
+        with _trend_cache_lock:
+            _trend_cache[str(user_dir)] = {"signature": list(signature), "day": today, "lines": lines}
+        lines_written += len(lines)
+    return {"users": len(user_dirs), "lines": lines_written}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compute health metric trends for every user, or show one user\'s.')
+    parser.add_argument('user_id', type=str, nargs='?', help='Only print this user\'s trend lines')
+    parser.add_argument('--users_dir', type=str, default=str(USERS_DIR))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.user_id:
+        for line in get_trend_lines(Path(args.users_dir) / args.user_id):
+            print(line)
+    else:
+        print(json.dumps(run_trend_batch(args.users_dir)))
@@ -0,0 +1,379 @@
+import argparse
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from .config import USERS_DIR, XAI_HEALTH_DIR
+from .metrics import increment, observe, registry
+from .usage_ledger import set_current_user
+
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", os.path.join(XAI_HEALTH_DIR, "jobs.sqlite3"))
+# Worker threads per process; this, not the number of sessions, bounds concurrent xAI calls.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+# Submissions are refused once this many jobs are waiting.
+JOB_MAX_QUEUED = int(os.getenv("JOB_MAX_QUEUED", "500"))
+# Idle workers look for jobs submitted by other processes this often.
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))
+# Workers record a heartbeat for each running job this often, whatever the handler is doing.
+JOB_HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT_INTERVAL", "30"))
+# A running job without a heartbeat for this long lost its worker process and is requeued.
+JOB_STALE_AFTER = max(float(os.getenv("JOB_STALE_AFTER", "600")), 4 * JOB_HEARTBEAT_INTERVAL)
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "2"))
+# Finished jobs are kept this long so a page can still pick up their result.
+JOB_RETENTION_HOURS = float(os.getenv("JOB_RETENTION_HOURS", "48"))
+# Partial output is written at most this often while a job streams.
+PROGRESS_INTERVAL = 0.25
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    user_id TEXT,
+    status TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    partial TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    started REAL,
+    heartbeat REAL,
+    finished REAL,
+    worker TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created);
+CREATE INDEX IF NOT EXISTS jobs_user_kind ON jobs (user_id, kind, created);
+"""
+
+registry.describe("xai_health_job_wait_seconds", "Time jobs spent queued before a worker picked them up.")
+registry.describe("xai_health_job_run_seconds", "Time workers spent running jobs.")
+registry.describe("xai_health_jobs_total", "Finished jobs per kind and outcome.")
+
+
+class Job:
+    """What a handler sees of the job it runs."""
+
+    def __init__(self, queue, row):
+        self.queue = queue
+        self.id = row["id"]
+        self.kind = row["kind"]
+        self.user_id = row["user_id"]
+        self.payload = json.loads(row["payload"])
+        self._last_progress = 0.0
+
+    def progress(self, partial_text, force=False):
+        """Publishes partial output, e.g. the reply streamed so far, for pages polling the job."""
+        now = time.monotonic()
+        if force or now - self._last_progress >= PROGRESS_INTERVAL:
+            self._last_progress = now
+            self.queue._update(self.id, partial=partial_text, heartbeat=time.time())
+
+
+class JobQueue:
+    """
+    Persistent queue of LLM work, drained by a bounded pool of worker threads.
+
+    Jobs live in a WAL-mode SQLite table, so every Streamlit process shares
+    one queue, results survive reruns and restarts, and pages only poll a row
+    by id. Jobs of one user run one at a time; jobs of different users run in
+    parallel up to JOB_WORKERS per process. Queued jobs are taken in submission
+    order, except that background "summaries" jobs wait until no other job is
+    runnable.
+    """
+
+    def __init__(self, path=None, workers=None, handlers=None):
+        self.path = Path(path or JOB_QUEUE_PATH)
+        self.workers = JOB_WORKERS if workers is None else workers
+        self.handlers = dict(HANDLERS if handlers is None else handlers)
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._last_purge = 0.0
+
+    def _update(self, job_id, **columns):
+        assignments = ", ".join(f"{column} = ?" for column in columns)
+        with self._lock:
+            self._conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*columns.values(), job_id))
+
+    def submit(self, kind, payload, user_id=None):
+        """
+        Queues a job.
+
+        Args:
+            kind (str): Key into the queue's handlers, e.g. "health_update" or "research".
+            payload (dict): JSON-serializable input for the handler.
+            user_id (str): The user the job runs for; their jobs never run concurrently.
+
+        Returns:
+            str: The job id to poll with get().
+        """
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            queued = self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if queued >= JOB_MAX_QUEUED:
+                raise RuntimeError(f"Job queue is full ({queued} jobs waiting)")
+            self._conn.execute(
+                "INSERT INTO jobs (id, kind, user_id, status, payload, created) VALUES (?, ?, ?, 'queued', ?, ?)",
+                (job_id, kind, user_id, json.dumps(payload, ensure_ascii=False), time.time()),
+            )
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id):
+        """Returns a job as a dict with its status, partial output and decoded result, or None."""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def active_job(self, user_id, kind):
+        """The id of a user's unfinished job of a kind, so a new session can resume polling it."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id FROM jobs WHERE user_id = ? AND kind = ? AND status IN ('queued', 'running') "
+                "ORDER BY created DESC LIMIT 1", (user_id, kind)).fetchone()
+        return row["id"] if row else None
+
+    def stats(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT kind, status, COUNT(*) FROM jobs GROUP BY kind, status").fetchall()
+        return {f"{kind}:{status}": count for kind, status, count in rows}
+
+    def _requeue_stale(self, now):
+        # called inside the claim transaction
+        self._conn.execute(
+            "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+            "error = 'worker stopped responding', finished = CASE WHEN attempts >= ? THEN ? END "
+            "WHERE status = 'running' AND heartbeat < ?",
+            (JOB_MAX_ATTEMPTS, JOB_MAX_ATTEMPTS, now, now - JOB_STALE_AFTER),
+        )
+
+    def claim(self):
+        """Atomically takes the oldest runnable job, across every process sharing the queue, summaries last."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._requeue_stale(now)
+                row = self._conn.execute(
+                    "SELECT * FROM jobs WHERE status = 'queued' AND (user_id IS NULL OR user_id NOT IN "
+                    "(SELECT user_id FROM jobs WHERE status = 'running' AND user_id IS NOT NULL)) "
+                    "ORDER BY kind = 'summaries', created LIMIT 1").fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'running', started = ?, heartbeat = ?, attempts = attempts + 1, "
+                        "worker = ? WHERE id = ?", (now, now, self.worker_id, row["id"]))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if row is not None:
+            observe("xai_health_job_wait_seconds", now - row["created"], kind=row["kind"])
+        return row
+
+    def _heartbeat(self, job_id, done):
+        # separate from progress(), which only runs while a reply streams; context
+        # building and rate-limit waits before it can take minutes
+        while not done.wait(JOB_HEARTBEAT_INTERVAL):
+            try:
+                self._update(job_id, heartbeat=time.time())
+            except sqlite3.Error as e:
+                logging.error(f"Error recording heartbeat of job {job_id}: {str(e)}")
+
+    def run_one(self, row):
+        job = Job(self, row)
+        started = time.perf_counter()
+        done = threading.Event()
+        threading.Thread(target=self._heartbeat, args=(job.id, done), name=f"job-heartbeat-{job.id[:8]}",
+                         daemon=True).start()
+        set_current_user(job.user_id)
+        try:
+            result = self.handlers[job.kind](job)
+        except Exception as e:
+            logging.error(f"Job {job.id} ({job.kind} for {job.user_id}) failed: {str(e)}")
+            self._update(job.id, status="failed", error=str(e), finished=time.time())
+            increment("xai_health_jobs_total", kind=job.kind, outcome="failed")
+        else:
+            self._update(job.id, status="done", result=json.dumps(result, ensure_ascii=False), finished=time.time())
+            increment("xai_health_jobs_total", kind=job.kind, outcome="done")
+        finally:
+            done.set()
+            set_current_user(None)
+            observe("xai_health_job_run_seconds", time.perf_counter() - started, kind=job.kind)
+        # a finished job may unblock the same user's next one
+        self._wakeup.set()
+
+    def purge(self, older_than_hours=None):
+        """Deletes finished jobs older than JOB_RETENTION_HOURS."""
+        hours = JOB_RETENTION_HOURS if older_than_hours is None else older_than_hours
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished < ?",
+                                        (time.time() - hours * 3600,))
+        return cursor.rowcount
+
+    def _worker_loop(self):
+        while True:
+            try:
+                if time.monotonic() - self._last_purge > 3600:
+                    self._last_purge = time.monotonic()
+                    self.purge()
+                row = self.claim()
+            except sqlite3.Error as e:
+                logging.error(f"Error reading job queue {self.path}: {str(e)}")
+                row = None
+            if row is None:
+                self._wakeup.wait(JOB_POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+            self.run_one(row)
+
+    def start(self):
+        """Starts the worker threads once; later calls are no-ops."""
+        with self._lock:
+            if self._threads:
+                return
+            for number in range(self.workers):
+                thread = threading.Thread(target=self._worker_loop, name=f"job-worker-{number}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        logging.info(f"Started {self.workers} job workers on {self.path}")
+
+
+def run_health_update(job):
+    """
+    Answers a user's newest health update and saves the reply.
+
+    The update itself was saved before the job was submitted. The page supplies
+    the system message, so the worker needs no Streamlit session state.
+    """
+    from .context_builder import build_context, make_llm_summarizer
+    from .health_metrics import get_health_metric_store
+    from .health_trends import get_trend_lines
+    from .maintenance import record_activity
+    from .recommendations import get_recommendation_ledger
+    from .user_state import get_user_state_cache
+    from .xai_client import stream_chat_completion
+
+    user_dir = USERS_DIR / job.user_id
+    cache = get_user_state_cache()
+    # the update may have been saved by another process, after this cache last checked storage
+    cache.invalidate(job.user_id)
+    conversation, authentication = cache.load(job.user_id)
+    messages = build_context(job.payload["system_message"], conversation, user_dir, make_llm_summarizer())
+    # the text so far is published as job progress for the polling page
+    reply, time_to_first_token = stream_chat_completion(
+        "dialogue", messages, on_text=job.progress, on_fallback=lambda: job.progress("", force=True))
+    if time_to_first_token is not None:
+        observe("xai_health_time_to_first_token_seconds", time_to_first_token)
+
+    # reloaded so that anything saved while the reply streamed is kept
+    cache.invalidate(job.user_id)
+    conversation, authentication = cache.load(job.user_id)
+    conversation.append({"role": "assistant", "content": reply, "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")})
+    cache.save(job.user_id, conversation, authentication)
+    record_activity(job.user_id)
+    schedule_summary_backfill(job.queue, job.user_id, conversation)
+
+    try:
+        if get_health_metric_store(user_dir).ingest(conversation):
+            get_trend_lines(user_dir)
+    except Exception as e:
+        logging.error(f"Error extracting health metrics for {job.user_id}: {str(e)}")
+    try:
+        recommendations = get_recommendation_ledger(user_dir).capture(
+            reply, conversation[-1]["timestamp"], len(conversation) - 1)
+    except Exception as e:
+        logging.error(f"Error recording recommendations for {job.user_id}: {str(e)}")
+        recommendations = []
+    return {"reply": reply, "time_to_first_token": time_to_first_token, "recommendations": recommendations}
+
+
+def schedule_summary_backfill(queue, user_id, conversation):
+    """Queues a "summaries" job when build_context left older messages unsummarized."""
+    from .context_builder import summary_backlog
+
+    try:
+        if summary_backlog(conversation, USERS_DIR / user_id) and queue.active_job(user_id, "summaries") is None:
+            queue.submit("summaries", {}, user_id=user_id)
+    except Exception as e:
+        logging.error(f"Error scheduling summary backfill for {user_id}: {str(e)}")
+
+
+def run_summaries(job):
+    """
+    Summarizes CONTEXT_SUMMARY_JOB_BATCHES batches of a user's backlog, then
+    requeues itself for the rest. claim() takes the requeued job only after any
+    health update the user submitted meanwhile, so an update waits behind at
+    most one run, which is one batch by default.
+    """
+    from .context_builder import backfill_summaries, make_llm_summarizer
+    from .user_state import get_user_state_cache
+
+    conversation, _ = get_user_state_cache().load(job.user_id)
+    remaining = backfill_summaries(conversation, USERS_DIR / job.user_id, make_llm_summarizer())
+    if remaining:
+        job.queue.submit("summaries", {}, user_id=job.user_id)
+    return {"remaining": remaining}
+
+
+def run_research(job):
+    """Runs a research query; the page supplies the messages."""
+    from .llm_cache import cached_chat_completion
+
+    return {"text": cached_chat_completion("research", job.payload["messages"])}
+
+
+HANDLERS = {
+    "health_update": run_health_update,
+    "research": run_research,
+    "summaries": run_summaries,
+}
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    """Returns the process-wide job queue; call start() on it to run workers in this process."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue()
+        return _queue
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run job workers without the UI, or show queue counts.')
+    parser.add_argument('--workers', type=int, default=JOB_WORKERS, help='Worker threads in this process')
+    parser.add_argument('--status', action='store_true', help='Print job counts per kind and status and exit')
+    parser.add_argument('--db', type=str, default=JOB_QUEUE_PATH)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    queue = JobQueue(args.db, workers=args.workers)
+    if args.status:
+        print(json.dumps(queue.stats(), indent=2))
+    else:
+        queue.start()
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,201 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from .config import APP_DIR
+from .metrics import increment, registry
+from .xai_client import chat_completion, resolve_call_site
+
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", str(APP_DIR / "cache" / "llm_cache.sqlite3"))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(50 * 1024 * 1024)))
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# Seconds a cached response stays fresh, per call site. Zero means never cached:
+# personalised dialogue and conversation summaries must always hit the API.
+CALL_SITE_TTLS = {
+    "morph": 7 * 24 * 60 * 60,
+    "explode": 7 * 24 * 60 * 60,
+    "research": 24 * 60 * 60,
+    "dialogue": 0,
+    "summary": 0,
+}
+DEFAULT_TTL = 60 * 60
+
+registry.describe("xai_health_llm_cache_lookups_total", "LLM cache lookups per call site and outcome (hit or miss).")
+
+
+def make_cache_key(model, messages, params=None):
+    """Stable hash of everything that determines a completion."""
+    payload = json.dumps({"model": model, "messages": messages, "params": params or {}},
+                         sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """
+    On-disk cache of chat completion text keyed by model, messages and parameters.
+
+    Entries expire after the TTL of the call site that reads them, and once the
+    stored text exceeds max_bytes the least recently used entries are evicted.
+    Hits and misses are counted in the same database, so stats() reports every
+    process's lookups, not just its own.
+    """
+
+    def __init__(self, path=None, max_bytes=None, ttls=None):
+        self.path = Path(path or LLM_CACHE_PATH)
+        self.max_bytes = max_bytes or LLM_CACHE_MAX_BYTES
+        self.ttls = dict(CALL_SITE_TTLS, **(ttls or {}))
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS completions (
+                key TEXT PRIMARY KEY,
+                call_site TEXT NOT NULL,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS completions_last_access ON completions (last_access)")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS lookups (
+                call_site TEXT PRIMARY KEY,
+                hits INTEGER NOT NULL DEFAULT 0,
+                misses INTEGER NOT NULL DEFAULT 0
+            )"""
+        )
+        self._conn.commit()
+
+    def ttl_for(self, call_site):
+        return self.ttls.get(call_site, DEFAULT_TTL)
+
+    def _count(self, call_site, hit):
+        # inside the caller's transaction
+        column = "hits" if hit else "misses"
+        self._conn.execute(f"INSERT INTO lookups (call_site, {column}) VALUES (?, 1) "
+                           f"ON CONFLICT(call_site) DO UPDATE SET {column} = {column} + 1", (call_site,))
+        increment("xai_health_llm_cache_lookups_total", call_site=call_site, outcome="hit" if hit else "miss")
+
+    def get(self, key, call_site):
+        ttl = self.ttl_for(call_site)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT response, created_at FROM completions WHERE key = ?", (key,)).fetchone()
+            hit = bool(row) and now - row[1] <= ttl
+            if hit:
+                self._conn.execute("UPDATE completions SET last_access = ? WHERE key = ?", (now, key))
+            elif row:
+                self._conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+            self._count(call_site, hit)
+            self._conn.commit()
+            return row[0] if hit else None
+
+    def put(self, key, call_site, response):
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO completions (key, call_site, response, size, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, call_site, response, size, now, now),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = 0
+        for key, size in self._conn.execute("SELECT key, size FROM completions ORDER BY last_access").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+            total -= size
+            evicted += 1
+        logging.info(f"LLM cache evicted {evicted} least recently used entries")
+
+    def stats(self):
+        with self._lock:
+            entries, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions").fetchone()
+            lookups = self._conn.execute("SELECT call_site, hits, misses FROM lookups").fetchall()
+        return {
+            "entries": entries,
+            "bytes": total,
+            "hits": {call_site: hits for call_site, hits, _ in lookups if hits},
+            "misses": {call_site: misses for call_site, _, misses in lookups if misses},
+        }
+
+    def clear(self):
+        """Deletes every cached response and resets the hit/miss counts."""
+        with self._lock:
+            self._conn.execute("DELETE FROM completions")
+            self._conn.execute("DELETE FROM lookups")
+            self._conn.commit()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_llm_cache():
+    """Returns the process-wide cache, opening it on first use."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = LLMCache()
+        return _cache
+
+
+def cached_chat_completion(call_site, messages, use_cache=True, **overrides):
+    """
+    Returns the text of a chat completion, served from the cache when possible.
+
+    Args:
+        call_site (str): Picks the client defaults and TTL, and labels hit/miss counters.
+        messages (list): Chat messages.
+        use_cache (bool): Set False to always call the API, e.g. for personalised dialogue.
+        **overrides: Completion parameters; all but timeout are part of the cache key.
+
+    Returns:
+        str: The completion text.
+    """
+    cache = get_llm_cache() if LLM_CACHE_ENABLED and use_cache else None
+    if cache is None or cache.ttl_for(call_site) <= 0:
+        response = chat_completion(call_site, messages, **overrides)
+        return response.choices[0].message.content
+
+    params = resolve_call_site(call_site, overrides)
+    params.pop("timeout", None)
+    model = params.pop("model")
+    key = make_cache_key(model, messages, params)
+    cached = cache.get(key, call_site)
+    if cached is not None:
+        logging.debug(f"LLM cache hit for {call_site} ({key[:12]})")
+        return cached
+
+    response = chat_completion(call_site, messages, **overrides)
+    content = response.choices[0].message.content
+    if content:
+        cache.put(key, call_site, content)
+    return content
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Inspect or clear the LLM response cache.')
+    parser.add_argument('--clear', action='store_true', help='Delete every cached response')
+    args = parser.parse_args()
+    cache = get_llm_cache()
+    if args.clear:
+        cache.clear()
+    print(cache.stats())
@@ -0,0 +1,121 @@
+import contextlib
+import hashlib
+import json
+import os
+import re
+import threading
+from pathlib import Path
+
+from .config import XAI_HEALTH_DIR
+
+try:
+    import fcntl
+except ImportError:
+    # no advisory file locks (e.g. Windows): writes are only serialized within one process
+    fcntl = None
+
+# One lock file per user; every process sharing the data must see the same directory.
+USER_LOCK_DIR = os.getenv("USER_LOCK_DIR", os.path.join(XAI_HEALTH_DIR, "locks"))
+
+
+class ConflictError(Exception):
+    """A save was based on data that another session or process has changed since it was read."""
+
+
+def atomic_write_json(path, data, **dump_kwargs):
+    """
+    Replaces a JSON file in one step, so readers see the old or the new
+    contents but never a truncated file, even if the writer dies midway.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, **dump_kwargs)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def file_version(path):
+    """Token that changes whenever a file is replaced or written, or None if it is missing."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_ino, stat.st_mtime_ns, stat.st_size]
+
+
+def message_fingerprint(message):
+    """Short digest of one message, used to check that a conversation still starts like the stored one."""
+    key = json.dumps([message.get("role"), message.get("timestamp"), message.get("content")], ensure_ascii=False)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    Holds an exclusive advisory flock on <path>.lock for one read-modify-write
+    of a file several processes update. Not re-entrant, and threads of one
+    process must serialize on their own lock around it.
+    """
+    if fcntl is None:
+        yield
+        return
+    lock_path = Path(f"{path}.lock")
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, "a") as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+class _UserLock:
+    __slots__ = ("thread_lock", "depth", "file")
+
+    def __init__(self):
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self.file = None
+
+
+_user_locks = {}
+_user_locks_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def user_lock(user_id):
+    """
+    Holds a user's write lock across threads and processes.
+
+    Threads of this process queue on a re-entrant lock; the first holder also
+    takes an advisory flock on USER_LOCK_DIR/<user_id>.lock, which other
+    processes wait for. Reads do not need it, because every write is either an
+    append of whole lines or an atomic replace.
+
+        with user_lock(user_id):
+            ...
+    """
+    key = str(user_id)
+    with _user_locks_lock:
+        lock = _user_locks.setdefault(key, _UserLock())
+    with lock.thread_lock:
+        if lock.depth == 0 and fcntl is not None:
+            Path(USER_LOCK_DIR).mkdir(parents=True, exist_ok=True)
+            safe_name = re.sub(r"[^A-Za-z0-9_.-]", "_", key) or "_"
+            lock.file = open(Path(USER_LOCK_DIR) / f"{safe_name}.lock", "a")
+            fcntl.flock(lock.file.fileno(), fcntl.LOCK_EX)
+        lock.depth += 1
+        try:
+            yield
+        finally:
+            lock.depth -= 1
+            if lock.depth == 0 and lock.file is not None:
+                fcntl.flock(lock.file.fileno(), fcntl.LOCK_UN)
+                lock.file.close()
+                lock.file = None
@@ -0,0 +1,239 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+from .config import USERS_DIR
+from .locking import atomic_write_json, file_lock
+from .storage import get_storage
+from .user_state import get_user_state_cache
+
+ACTIVITY_INDEX_PATH = Path(os.getenv("ACTIVITY_INDEX_PATH", str(USERS_DIR / "activity_index.json")))
+MAINTENANCE_REPORT_PATH = Path(os.getenv("MAINTENANCE_REPORT_PATH", str(USERS_DIR / "maintenance_report.json")))
+# Conversations of users inactive for longer than this are deleted.
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "90"))
+# Seconds between maintenance passes, and the delay before the first one after startup.
+MAINTENANCE_INTERVAL = int(os.getenv("MAINTENANCE_INTERVAL", str(24 * 60 * 60)))
+MAINTENANCE_INITIAL_DELAY = int(os.getenv("MAINTENANCE_INITIAL_DELAY", "300"))
+# A user's activity is written to the index at most this often.
+ACTIVITY_WRITE_INTERVAL = int(os.getenv("ACTIVITY_WRITE_INTERVAL", "300"))
+
+
+class ActivityIndex:
+    """
+    Last-activity time of every user, kept in one small JSON file.
+
+    Maintenance reads this index instead of walking and stat-ing the whole user
+    tree. The first load seeds it from directory mtimes when the file is missing.
+    Every read-modify-write holds a file lock, so updates from other processes
+    are never lost; a lost touch could make retention delete an active user.
+    """
+
+    def __init__(self, path=None, users_dir=None):
+        self.path = Path(path or ACTIVITY_INDEX_PATH)
+        self.users_dir = Path(users_dir or USERS_DIR)
+        self._lock = threading.Lock()
+        self._written = {}
+        self._entries = None
+
+    def _load(self):
+        if self._entries is not None:
+            return self._entries
+        if self.path.exists():
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._entries = json.load(f)
+                return self._entries
+            except json.JSONDecodeError:
+                logging.error(f"Corrupted activity index {self.path}, reseeding")
+        self._entries = {}
+        if self.users_dir.exists():
+            for user_dir in self.users_dir.iterdir():
+                if user_dir.is_dir():
+                    self._entries[user_dir.name] = user_dir.stat().st_mtime
+        self._save()
+        logging.info(f"Seeded activity index with {len(self._entries)} users")
+        return self._entries
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write_json(self.path, self._entries)
+
+    def touch(self, user_id, when=None):
+        when = when or time.time()
+        with self._lock:
+            if when - self._written.get(user_id, 0) < ACTIVITY_WRITE_INTERVAL:
+                return
+            with file_lock(self.path):
+                # re-read so activity written by other processes is not lost
+                self._entries = None
+                entries = self._load()
+                entries[str(user_id)] = max(when, entries.get(str(user_id), 0))
+                self._save()
+            self._written[user_id] = when
+
+    def entries(self):
+        with self._lock, file_lock(self.path):
+            self._entries = None
+            return dict(self._load())
+
+    def remove(self, user_ids, unless_active_since=None):
+        """
+        Drops users from the index.
+
+        Args:
+            unless_active_since (float): Keep users whose activity, re-read under
+                the lock, is at or after this time.
+
+        Returns:
+            list: The user IDs that were removed.
+        """
+        with self._lock, file_lock(self.path):
+            self._entries = None
+            entries = self._load()
+            removed = []
+            for user_id in user_ids:
+                if unless_active_since is not None and entries.get(user_id, 0) >= unless_active_since:
+                    continue
+                if entries.pop(user_id, None) is not None:
+                    removed.append(user_id)
+            self._save()
+            return removed
+
+
+_activity_index = ActivityIndex()
+
+
+def record_activity(user_id):
+    """Marks a user as active now; cheap enough to call on every save."""
+    if user_id:
+        _activity_index.touch(user_id)
+
+
+def run_maintenance(activity_index=None, storage=None, users_dir=None, retention_days=None, last_run=None):
+    """
+    One maintenance pass: retention, compaction and empty-directory cleanup.
+
+    Args:
+        activity_index (ActivityIndex): Source of last-activity times.
+        storage: Storage backend; defaults to get_storage().
+        users_dir (Path): Directory of per-user subdirectories.
+        retention_days (int): Delete conversations idle for longer than this.
+        last_run (float): Time of the previous pass; only users active since then are compacted.
+
+    Returns:
+        dict: What the pass did.
+    """
+    activity_index = activity_index or _activity_index
+    storage = storage or get_storage()
+    users_dir = Path(users_dir or USERS_DIR)
+    retention_days = RETENTION_DAYS if retention_days is None else retention_days
+    started = time.time()
+    report = {"started_at": started, "expired_users": 0, "removed_records": 0, "compacted_users": 0,
+              "dropped_lines": 0, "removed_directories": 0, "errors": 0}
+
+    entries = activity_index.entries()
+    cutoff = started - retention_days * 24 * 60 * 60
+    expired = [user_id for user_id, last_active in entries.items() if last_active < cutoff]
+    if expired:
+        # taken out of the index first, re-checked under its lock, so a user who
+        # became active since the snapshot above is kept
+        expired = activity_index.remove(expired, unless_active_since=cutoff)
+    for user_id in expired:
+        try:
+            report["removed_records"] += storage.delete_conversation(user_id)
+            get_user_state_cache().invalidate(user_id)
+            report["expired_users"] += 1
+            logging.info(f"Removed conversation of {user_id}, inactive since {time.ctime(entries[user_id])}")
+        except Exception as e:
+            report["errors"] += 1
+            logging.error(f"Error expiring conversation of {user_id}: {str(e)}")
+
+    for user_id, last_active in entries.items():
+        if user_id in expired or (last_run is not None and last_active < last_run):
+            continue
+        try:
+            stats = storage.compact_conversation(user_id)
+            report["compacted_users"] += 1
+            report["dropped_lines"] += stats.get("dropped", 0)
+        except Exception as e:
+            report["errors"] += 1
+            logging.error(f"Error compacting conversation of {user_id}: {str(e)}")
+    storage.checkpoint()
+
+    removed_directories = []
+    if users_dir.exists():
+        for user_dir in users_dir.iterdir():
+            if user_dir.is_dir() and not any(user_dir.iterdir()):
+                user_dir.rmdir()
+                removed_directories.append(user_dir.name)
+                logging.info(f"Removed empty user directory: {user_dir}")
+    if removed_directories:
+        activity_index.remove(removed_directories)
+    report["removed_directories"] = len(removed_directories)
+
+    report["duration_seconds"] = round(time.time() - started, 3)
+    logging.info(f"Maintenance pass finished: {report}")
+    return report
+
+
+def load_last_report():
+    if not MAINTENANCE_REPORT_PATH.exists():
+        return None
+    try:
+        with open(MAINTENANCE_REPORT_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        return None
+
+
+def save_report(report):
+    MAINTENANCE_REPORT_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with open(MAINTENANCE_REPORT_PATH, "w", encoding="utf-8") as f:
+        json.dump(report, f)
+
+
+def maintenance_loop(stop_event):
+    stop_event.wait(MAINTENANCE_INITIAL_DELAY)
+    while not stop_event.is_set():
+        last_report = load_last_report()
+        last_run = last_report["started_at"] if last_report else None
+        # another process behind the same data directory may already have run this cycle
+        if last_run is None or time.time() - last_run >= MAINTENANCE_INTERVAL:
+            try:
+                save_report(run_maintenance(last_run=last_run))
+            except Exception as e:
+                logging.error(f"Maintenance pass failed: {str(e)}")
+        stop_event.wait(MAINTENANCE_INTERVAL)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+_stop_event = threading.Event()
+
+
+def start_maintenance_scheduler():
+    """Starts the background maintenance thread once per process; later calls are no-ops."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None or not _scheduler.is_alive():
+            _scheduler = threading.Thread(target=maintenance_loop, args=(_stop_event,),
+                                          name="maintenance", daemon=True)
+            _scheduler.start()
+            logging.info(f"Maintenance scheduler started, interval {MAINTENANCE_INTERVAL}s")
+        return _scheduler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run one retention and compaction pass now.')
+    parser.add_argument('--retention_days', type=int, default=RETENTION_DAYS)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    last_report = load_last_report()
+    report = run_maintenance(retention_days=args.retention_days,
+                             last_run=last_report["started_at"] if last_report else None)
+    save_report(report)
+    print(report)
@@ -0,0 +1,232 @@
+import contextlib
+import functools
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+# Serve /metrics on this port when set; bound to METRICS_HOST, localhost by default.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# Write the same text to this file every METRICS_WRITE_INTERVAL seconds when set,
+# e.g. into a node_exporter textfile collector directory.
+METRICS_FILE = os.getenv("METRICS_FILE", "")
+METRICS_WRITE_INTERVAL = float(os.getenv("METRICS_WRITE_INTERVAL", "15"))
+
+# Upper bounds in seconds, from a cached file read up to a slow completion.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, bucket_count):
+        self.counts = [0] * bucket_count
+        self.sum = 0.0
+        self.count = 0
+
+
+class MetricsRegistry:
+    """
+    In-process counters and histograms, rendered in the Prometheus text format.
+
+    Recording a value is a dictionary lookup, a bisect and a few additions under
+    one lock, so instrumentation can stay on in production.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(len(self.buckets) + 1)
+            histogram.counts[index] += 1
+            histogram.sum += value
+            histogram.count += 1
+
+    def snapshot(self):
+        """Returns plain copies of every counter and histogram, e.g. for tests or a debug page."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: {"sum": h.sum, "count": h.count, "counts": list(h.counts)}
+                          for key, h in self._histograms.items()}
+        return {"counters": counters, "histograms": histograms}
+
+    def render(self):
+        """Renders every metric in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+        for kind, series in (("counter", snapshot["counters"]), ("histogram", snapshot["histograms"])):
+            for name in sorted({name for name, _ in series}):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+                for (series_name, labels), value in sorted(series.items()):
+                    if series_name != name:
+                        continue
+                    if kind == "counter":
+                        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(self.buckets + ("+Inf",), value["counts"]):
+                        cumulative += count
+                        bucket_labels = labels + (("le", bound if bound == "+Inf" else repr(float(bound))),)
+                        lines.append(f"{name}_bucket{_format_labels(bucket_labels)} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value['sum'])}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+registry.describe("xai_health_stage_seconds", "Wall time of each page stage.")
+registry.describe("xai_health_stage_errors_total", "Page stages that raised an exception.")
+registry.describe("xai_health_llm_request_seconds", "Wall time of xAI completions per call site, to the last chunk for streams.")
+registry.describe("xai_health_llm_requests_total", "xAI completion requests per call site and outcome.")
+registry.describe("xai_health_time_to_first_token_seconds", "Time until the first streamed coach token.")
+
+
+@contextlib.contextmanager
+def span(stage):
+    """
+    Times a block as one observation of xai_health_stage_seconds{stage=...}.
+
+    Exceptions are counted in xai_health_stage_errors_total and re-raised.
+    Streamlit's rerun and stop signals are not Exceptions, so they are timed
+    but not counted as errors.
+
+        with span("load_session_state"):
+            ...
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        increment("xai_health_stage_errors_total", stage=stage)
+        raise
+    finally:
+        observe("xai_health_stage_seconds", time.perf_counter() - started, stage=stage)
+
+
+def timed(stage):
+    """Decorator form of span."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def observe(name, value, **labels):
+    if METRICS_ENABLED:
+        registry.observe(name, value, **labels)
+
+
+def increment(name, amount=1, **labels):
+    if METRICS_ENABLED:
+        registry.increment(name, amount, **labels)
+
+
+def write_metrics_file(path=None):
+    """Atomically replaces the metrics file with the current text exposition."""
+    path = Path(path or METRICS_FILE)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(registry.render())
+    os.replace(tmp_path, path)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+def _file_writer_loop(path, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            write_metrics_file(path)
+        except OSError as e:
+            logging.error(f"Error writing metrics to {path}: {str(e)}")
+
+
+_exporters_started = False
+_exporters_lock = threading.Lock()
+
+
+def start_metrics_exporter(port=None, path=None):
+    """
+    Starts the /metrics endpoint and/or the file writer once per process.
+
+    Both are off unless METRICS_PORT or METRICS_FILE (or the arguments) are set;
+    later calls are no-ops.
+    """
+    global _exporters_started
+    port = METRICS_PORT if port is None else port
+    path = path or METRICS_FILE
+    with _exporters_lock:
+        if _exporters_started or not METRICS_ENABLED:
+            return
+        _exporters_started = True
+        if port:
+            try:
+                server = ThreadingHTTPServer((METRICS_HOST, port), MetricsHandler)
+            except OSError as e:
+                # another worker process already serves this port
+                logging.error(f"Could not serve metrics on {METRICS_HOST}:{port}: {str(e)}")
+            else:
+                server.daemon_threads = True
+                threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+                logging.info(f"Serving metrics on http://{METRICS_HOST}:{port}/metrics")
+        if path:
+            threading.Thread(target=_file_writer_loop, args=(path, METRICS_WRITE_INTERVAL),
+                             name="metrics-file", daemon=True).start()
+            logging.info(f"Writing metrics to {path} every {METRICS_WRITE_INTERVAL}s")
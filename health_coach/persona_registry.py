@@ -0,0 +1,136 @@
+import json
+import logging
+import os
+import threading
+import time
+
+# Seconds between mtime checks of a persona file; within this window cached data
+# is returned without touching the filesystem at all.
+PERSONA_CHECK_INTERVAL = float(os.getenv("PERSONA_CHECK_INTERVAL", "5"))
+
+COACH_INSTRUCTIONS_HEADER = "As you formulate your response, consider the following additional attributes of your personality.\n\n"
+
+
+class _CachedJSONFile:
+    """A parsed JSON file that is re-read only when its mtime or size changes."""
+
+    def __init__(self, path, check_interval):
+        self.path = path
+        self.check_interval = check_interval
+        self.data = None
+        self.signature = None
+        self.checked_at = 0.0
+
+    def get(self):
+        now = time.monotonic()
+        if self.signature is not None and now - self.checked_at < self.check_interval:
+            return self.data
+        self.checked_at = now
+        try:
+            stat = os.stat(self.path)
+        except (FileNotFoundError, TypeError):
+            self.data, self.signature = None, None
+            return None
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature != self.signature:
+            try:
+                with open(self.path, "r") as file:
+                    self.data = json.load(file)
+                logging.info(f"Persona data loaded from {self.path}")
+            except json.JSONDecodeError:
+                logging.error(f"Corrupted JSON in {self.path}")
+                self.data = None
+            self.signature = signature
+        return self.data
+
+    def invalidate(self):
+        self.signature = None
+
+
+class PersonaRegistry:
+    """
+    Process-wide cache of coach persona data shared by every Streamlit session.
+
+    Loads all_available_coach_attributes.json and each user's coach attribute
+    file once, reloads them only when the file changes on disk, and memoizes the
+    persona instructions per (user, attribute set).
+    """
+
+    def __init__(self, available_attributes_file_path, check_interval=None):
+        self.check_interval = PERSONA_CHECK_INTERVAL if check_interval is None else check_interval
+        self._available = _CachedJSONFile(available_attributes_file_path, self.check_interval)
+        self._user_files = {}
+        self._prompts = {}
+        self._prompts_signature = None
+        self._lock = threading.Lock()
+
+    def available_attributes(self):
+        with self._lock:
+            return self._available.get() or {}
+
+    def user_attributes(self, coach_attributes_file_path, user_id):
+        """
+        Returns the attributes stored for user_id, or None if the file is missing or unreadable.
+        """
+        with self._lock:
+            cached = self._user_files.get(coach_attributes_file_path)
+            if cached is None:
+                cached = _CachedJSONFile(coach_attributes_file_path, self.check_interval)
+                self._user_files[coach_attributes_file_path] = cached
+            data = cached.get()
+        if not isinstance(data, dict):
+            return None
+        return data.get(user_id, [])
+
+    def invalidate_user(self, coach_attributes_file_path):
+        """Forces the next read of a user's attribute file, e.g. right after saving it."""
+        with self._lock:
+            cached = self._user_files.get(coach_attributes_file_path)
+            if cached is not None:
+                cached.invalidate()
+
+    def persona_instructions(self, user_id, attributes):
+        """The memoized persona part of the prompt for a user's attribute selection."""
+        available = self.available_attributes()
+        with self._lock:
+            if self._prompts_signature != self._available.signature:
+                self._prompts.clear()
+                self._prompts_signature = self._available.signature
+            key = (user_id, tuple(attributes))
+            instructions = self._prompts.get(key)
+            if instructions is None:
+                instructions = COACH_INSTRUCTIONS_HEADER
+                for attribute in attributes:
+                    instructions += f"{available.get(attribute, 'Unknown attribute')}\n"
+                self._prompts[key] = instructions
+            return instructions
+
+    def system_message(self, user_id, attributes, base_system_message, context=""):
+        """
+        Returns the coach system prompt for a user's attribute selection.
+
+        Args:
+            user_id (str): The user the prompt is for.
+            attributes (list): Selected coach attribute names.
+            base_system_message (str): Fixed instructions that precede the persona attributes.
+            context (str): Per-turn material such as metric trends, appended after
+                the persona and never part of the memo key.
+
+        Returns:
+            str: The assembled system prompt.
+        """
+        return f"{base_system_message}\n{self.persona_instructions(user_id, attributes)}{context}"
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_persona_registry(available_attributes_file_path):
+    """Returns the process-wide registry for an available-attributes file."""
+    with _registries_lock:
+        registry = _registries.get(available_attributes_file_path)
+        if registry is None:
+            registry = PersonaRegistry(available_attributes_file_path)
+            _registries[available_attributes_file_path] = registry
+        return registry
@@ -0,0 +1,327 @@
+import argparse
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from .config import XAI_HEALTH_DIR
+from .metrics import increment, observe, registry
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes")
+RATE_LIMIT_PATH = os.getenv("RATE_LIMIT_PATH", os.path.join(XAI_HEALTH_DIR, "rate_limit.sqlite3"))
+# Shared quota for every process on this machine; 0 turns a bucket off.
+XAI_REQUESTS_PER_MINUTE = float(os.getenv("XAI_REQUESTS_PER_MINUTE", "60"))
+XAI_TOKENS_PER_MINUTE = float(os.getenv("XAI_TOKENS_PER_MINUTE", "0"))
+# Each bucket holds this many seconds' worth of quota, which bounds a burst.
+XAI_RATE_BURST_SECONDS = float(os.getenv("XAI_RATE_BURST_SECONDS", "10"))
+# In-flight requests per process, adjusted between the bounds from latency and errors.
+XAI_CONCURRENCY_MIN = int(os.getenv("XAI_CONCURRENCY_MIN", "1"))
+XAI_CONCURRENCY_MAX = int(os.getenv("XAI_CONCURRENCY_MAX", "16"))
+XAI_CONCURRENCY_INITIAL = int(os.getenv("XAI_CONCURRENCY_INITIAL", "4"))
+# A response slower than this multiple of the best recent latency counts as congestion.
+XAI_LATENCY_TOLERANCE = float(os.getenv("XAI_LATENCY_TOLERANCE", "2.0"))
+# Retries after a 429, 5xx or connection error, with full-jitter exponential backoff.
+XAI_RETRY_ATTEMPTS = int(os.getenv("XAI_RETRY_ATTEMPTS", "4"))
+XAI_BACKOFF_BASE = float(os.getenv("XAI_BACKOFF_BASE", "0.5"))
+XAI_BACKOFF_CAP = float(os.getenv("XAI_BACKOFF_CAP", "30"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pauses (
+    name TEXT PRIMARY KEY,
+    until REAL NOT NULL
+);
+"""
+
+registry.describe("xai_health_rate_limit_wait_seconds", "Time xAI requests waited for the shared rate limit.")
+registry.describe("xai_health_llm_retries_total", "xAI requests retried per call site and reason.")
+
+
+class TokenBucket:
+    """
+    Token buckets shared by every process through one SQLite file.
+
+    Each acquire is a single short IMMEDIATE transaction that refills the
+    buckets for the time elapsed and takes what the request costs, so all
+    processes draw from the same quota without a coordinating service. A 429
+    pauses every process until the server's Retry-After has passed.
+    """
+
+    def __init__(self, path=None, requests_per_minute=None, tokens_per_minute=None, burst_seconds=None):
+        self.path = Path(path or RATE_LIMIT_PATH)
+        requests_per_minute = XAI_REQUESTS_PER_MINUTE if requests_per_minute is None else requests_per_minute
+        tokens_per_minute = XAI_TOKENS_PER_MINUTE if tokens_per_minute is None else tokens_per_minute
+        burst_seconds = XAI_RATE_BURST_SECONDS if burst_seconds is None else burst_seconds
+        # name -> (refill per second, capacity)
+        self.rates = {}
+        for name, per_minute in (("requests", requests_per_minute), ("tokens", tokens_per_minute)):
+            if per_minute > 0:
+                self.rates[name] = (per_minute / 60, max(1.0, per_minute / 60 * burst_seconds))
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def _try_take(self, costs, now):
+        """Takes every cost or none; returns 0 on success, else seconds until it could succeed."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                pause = self._conn.execute("SELECT until FROM pauses WHERE name = 'xai'").fetchone()
+                if pause and pause[0] > now:
+                    self._conn.execute("COMMIT")
+                    return pause[0] - now
+                levels = {}
+                wait = 0.0
+                for name, cost in costs.items():
+                    rate, capacity = self.rates[name]
+                    row = self._conn.execute("SELECT tokens, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+                    tokens = capacity if row is None else min(capacity, row[0] + max(0.0, now - row[1]) * rate)
+                    levels[name] = tokens
+                    # a request larger than the bucket waits for a full one rather than forever
+                    cost = min(cost, capacity)
+                    if tokens < cost:
+                        wait = max(wait, (cost - tokens) / rate)
+                if not wait:
+                    for name, cost in costs.items():
+                        levels[name] -= min(cost, self.rates[name][1])
+                for name, tokens in levels.items():
+                    self._conn.execute("INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)",
+                                       (name, tokens, now))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return wait
+
+    def acquire(self, tokens=0, timeout=None):
+        """
+        Blocks until the shared quota allows one more request.
+
+        Args:
+            tokens (int): Estimated prompt tokens, charged to the token bucket when it is on.
+            timeout (float): Give up after this many seconds.
+
+        Returns:
+            float: Seconds spent waiting.
+        """
+        costs = {name: (1 if name == "requests" else tokens) for name in self.rates}
+        if not costs:
+            return 0.0
+        started = time.monotonic()
+        while True:
+            wait = self._try_take(costs, time.time())
+            waited = time.monotonic() - started
+            if not wait:
+                return waited
+            if timeout is not None and waited + wait > timeout:
+                raise TimeoutError(f"xAI rate limit: no quota within {timeout:.0f}s")
+            # jitter keeps processes that woke together from retrying in lockstep
+            time.sleep(wait * random.uniform(1.0, 1.2))
+
+    def pause(self, seconds):
+        """Stops every process from sending requests for the next seconds, e.g. after a 429."""
+        until = time.time() + seconds
+        with self._lock:
+            self._conn.execute("INSERT INTO pauses (name, until) VALUES ('xai', ?) "
+                               "ON CONFLICT(name) DO UPDATE SET until = MAX(until, excluded.until)", (until,))
+
+    def levels(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT name, tokens, updated FROM buckets").fetchall()
+            pause = self._conn.execute("SELECT until FROM pauses WHERE name = 'xai'").fetchone()
+        now = time.time()
+        result = {}
+        for name, tokens, updated in rows:
+            if name in self.rates:
+                rate, capacity = self.rates[name]
+                result[name] = {"available": round(min(capacity, tokens + (now - updated) * rate), 1),
+                                "capacity": capacity, "per_minute": rate * 60}
+        result["paused_for"] = round(max(0.0, pause[0] - now), 1) if pause else 0.0
+        return result
+
+
+class AdaptiveConcurrency:
+    """
+    Per-process cap on in-flight xAI requests, adjusted by AIMD.
+
+    While the cap is being reached, it grows by one per cap's worth of fast
+    successes. It is cut in half on a 429, 5xx or connection error, at most
+    once per second so a burst of failures from one overload counts once.
+    Responses slower than
+    XAI_LATENCY_TOLERANCE times the best recent latency of their call site
+    shrink it by 10%, which backs off before the server starts refusing.
+    """
+
+    def __init__(self, minimum=None, maximum=None, initial=None, tolerance=None):
+        self.minimum = max(1, XAI_CONCURRENCY_MIN if minimum is None else minimum)
+        self.maximum = max(self.minimum, XAI_CONCURRENCY_MAX if maximum is None else maximum)
+        initial = XAI_CONCURRENCY_INITIAL if initial is None else initial
+        self.limit = float(min(self.maximum, max(self.minimum, initial)))
+        self.tolerance = XAI_LATENCY_TOLERANCE if tolerance is None else tolerance
+        self.in_flight = 0
+        self.baselines = {}
+        self._last_decrease = 0.0
+        self._saturated_at = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(f"No free xAI request slot within {timeout:.0f}s")
+                self._condition.wait(remaining)
+            self.in_flight += 1
+            if self.in_flight >= int(self.limit):
+                self._saturated_at = time.monotonic()
+
+    def release(self, call_site, latency=None, ok=True, overloaded=False):
+        """
+        Frees a slot and feeds the outcome back into the cap.
+
+        Args:
+            latency (float): Seconds until the response (or its headers, for a stream) arrived.
+            overloaded (bool): True after a 429, 5xx or connection error.
+        """
+        with self._condition:
+            self.in_flight = max(0, self.in_flight - 1)
+            previous = int(self.limit)
+            now = time.monotonic()
+            if overloaded:
+                if now - self._last_decrease > 1.0:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._last_decrease = now
+            elif ok and latency is not None:
+                baseline = self.baselines.get(call_site)
+                # the baseline follows the fastest responses and drifts up slowly
+                self.baselines[call_site] = latency if baseline is None else min(latency, baseline * 1.01)
+                # floored so that a few near-instant responses do not make every other one look slow
+                if baseline is not None and latency > max(baseline, 0.05) * self.tolerance:
+                    if now - self._last_decrease > 1.0:
+                        self.limit = max(self.minimum, self.limit * 0.9)
+                        self._last_decrease = now
+                elif now - self._saturated_at < 5.0:
+                    # only grow while the cap is actually being reached
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            if int(self.limit) != previous:
+                logging.info(f"xAI concurrency limit {previous} -> {int(self.limit)}")
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {"limit": int(self.limit), "in_flight": self.in_flight,
+                    "baselines": {site: round(value, 3) for site, value in self.baselines.items()}}
+
+
+def status_code(error):
+    """HTTP status of an SDK error, or None for errors without a response."""
+    code = getattr(error, "status_code", None)
+    if code is None:
+        code = getattr(getattr(error, "response", None), "status_code", None)
+    return code
+
+
+def is_retryable(error):
+    """True for 429s, 5xx responses, timeouts and connection errors."""
+    code = status_code(error)
+    if code is not None:
+        return code == 429 or code >= 500
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError", "ConnectError", "ReadTimeout",
+                                    "ConnectionError", "TimeoutError")
+
+
+def retry_after(error):
+    """Seconds from the response's Retry-After header, when it sent one."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, error=None):
+    """Full-jitter exponential backoff, never shorter than the server's Retry-After."""
+    delay = random.uniform(0, min(XAI_BACKOFF_CAP, XAI_BACKOFF_BASE * 2 ** attempt))
+    server_delay = retry_after(error) if error is not None else None
+    return max(delay, server_delay or 0.0)
+
+
+class RateLimiter:
+    """The shared token bucket and this process's adaptive concurrency cap, used around every xAI call."""
+
+    def __init__(self, bucket=None, concurrency=None):
+        self.bucket = bucket or TokenBucket()
+        self.concurrency = concurrency or AdaptiveConcurrency()
+
+    def acquire(self, tokens=0, timeout=None):
+        """Waits for a slot and then for quota; returns a Slot the caller must release."""
+        started = time.monotonic()
+        self.concurrency.acquire(timeout)
+        try:
+            remaining = None if timeout is None else max(0.0, timeout - (time.monotonic() - started))
+            self.bucket.acquire(tokens, remaining)
+        except Exception:
+            self.concurrency.release(None, ok=False)
+            raise
+        observe("xai_health_rate_limit_wait_seconds", time.monotonic() - started)
+        return Slot(self)
+
+    def throttled(self, call_site, error):
+        """Records a 429 from the server; every process pauses for its Retry-After."""
+        increment("xai_health_llm_retries_total", call_site=call_site, reason="throttled")
+        self.bucket.pause(retry_after(error) or XAI_BACKOFF_BASE)
+
+    def stats(self):
+        return {"concurrency": self.concurrency.stats(), "buckets": self.bucket.levels()}
+
+
+class Slot:
+    """One acquired request slot; releasing it twice is harmless."""
+
+    def __init__(self, limiter):
+        self._limiter = limiter
+        self._released = False
+
+    def release(self, call_site, latency=None, ok=True, overloaded=False):
+        if not self._released:
+            self._released = True
+            self._limiter.concurrency.release(call_site, latency, ok, overloaded)
+
+    def __del__(self):
+        # a stream that was never consumed must not hold its slot forever
+        if not self._released:
+            self.release(None, ok=False)
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """Returns the process-wide limiter, or None when RATE_LIMIT_ENABLED is off."""
+    global _limiter
+    if not RATE_LIMIT_ENABLED:
+        return None
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter()
+        return _limiter
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Show the shared xAI rate limit buckets.')
+    parser.add_argument('--db', type=str, default=RATE_LIMIT_PATH)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print(json.dumps(TokenBucket(args.db).levels(), indent=2))
@@ -0,0 +1,205 @@
+import json
+import logging
+import math
+import os
+import re
+import threading
+from collections import Counter
+from pathlib import Path
+
+from .conversation_store import RECALL_INDEX_FILENAME
+
+# BM25 term-frequency saturation and length normalisation.
+BM25_K1 = float(os.getenv("BM25_K1", "1.5"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset("""
+a about above after again against all am an and any are as at be because been before being below between both
+but by can could did do does doing down during each few for from further had has have having he her here hers
+him his how i if in into is it its itself just me more most my myself no nor not now of off on once only or
+other our ours out over own same she should so some such than that the their them then there these they this
+those through to too under until up very was we were what when where which while who whom why will with would
+you your yours yourself today feel feeling got get really also im ive
+""".split())
+
+
+def tokenize(text):
+    """Lowercased word tokens without stopwords, with a plural "s" stripped so knee/knees match."""
+    tokens = []
+    for token in TOKEN_PATTERN.findall((text or "").lower()):
+        if token in STOPWORDS or len(token) < 2:
+            continue
+        if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+def exchange_ranges(conversation, start=0):
+    """
+    Splits conversation[start:] into exchanges: a user message and the replies up
+    to the next user message. Only exchanges followed by a later user message are
+    returned, because the last one may still be waiting for its reply.
+
+    Returns:
+        list: Half-open (start, end) message ranges.
+    """
+    user_positions = [i for i in range(start, len(conversation)) if conversation[i].get("role") == "user"]
+    return list(zip(user_positions, user_positions[1:]))
+
+
+class RecallIndex:
+    """
+    BM25 inverted index over one user's past exchanges.
+
+    Stored as recall_index.jsonl next to the conversation log, one line of term
+    frequencies per exchange. New exchanges are appended as the conversation
+    grows, so neither the log nor the index is ever rescanned, and postings are
+    rebuilt in memory from the lines only when the process first needs them.
+    """
+
+    def __init__(self, user_dir):
+        self.path = Path(user_dir) / RECALL_INDEX_FILENAME
+        self.postings = {}
+        self.documents = {}
+        self.total_length = 0
+        self.indexed_through = 0
+        self.read_size = 0
+        self.inode = None
+        self._lock = threading.Lock()
+
+    def _reset(self):
+        self.postings, self.documents = {}, {}
+        self.total_length, self.indexed_through, self.read_size = 0, 0, 0
+
+    def _add(self, entry):
+        start = entry["start"]
+        # postings hold the term frequencies; documents only what ranking and staleness checks need
+        self.documents[start] = {"end": entry["end"], "length": entry["length"], "timestamp": entry.get("timestamp")}
+        self.total_length += entry["length"]
+        for term, frequency in entry["terms"].items():
+            self.postings.setdefault(term, {})[start] = frequency
+        self.indexed_through = max(self.indexed_through, entry["end"])
+
+    def _read_new_lines(self):
+        """Picks up lines appended by this or another process since the last read."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self._reset()
+            self.inode = None
+            return
+        if stat.st_ino != self.inode or stat.st_size < self.read_size:
+            self._reset()
+            self.inode = stat.st_ino
+        if stat.st_size == self.read_size:
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self.read_size)
+            offset = self.read_size
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                offset += len(line)
+                try:
+                    self._add(json.loads(line))
+                except (json.JSONDecodeError, KeyError, AttributeError):
+                    logging.warning(f"Skipping unreadable line in {self.path}")
+        self.read_size = offset
+
+    def _is_stale(self, conversation):
+        """True when the indexed ranges no longer line up with the conversation, e.g. after deletion."""
+        if self.indexed_through > len(conversation):
+            return True
+        if not self.documents:
+            return False
+        last_start = max(self.documents)
+        return conversation[last_start].get("timestamp") != self.documents[last_start]["timestamp"]
+
+    def update(self, conversation):
+        """
+        Indexes the exchanges added since the last update.
+
+        Args:
+            conversation (list): The user's full conversation, newest message last.
+
+        Returns:
+            int: Number of exchanges added.
+        """
+        with self._lock:
+            self._read_new_lines()
+            if self._is_stale(conversation):
+                logging.info(f"Rebuilding recall index {self.path}")
+                if self.path.exists():
+                    self.path.unlink()
+                self._reset()
+                self.inode = None
+            entries = []
+            for start, end in exchange_ranges(conversation, self.indexed_through):
+                terms = Counter()
+                for message in conversation[start:end]:
+                    terms.update(tokenize(message.get("content")))
+                entries.append({"start": start, "end": end, "length": sum(terms.values()),
+                                "timestamp": conversation[start].get("timestamp"), "terms": dict(terms)})
+            if not entries:
+                return 0
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                for entry in entries:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            # the lines just written are picked up like any other appended lines
+            self._read_new_lines()
+            return len(entries)
+
+    def search(self, query, k=3, before=None):
+        """
+        Ranks past exchanges against a query with BM25.
+
+        Args:
+            query (str): Usually the user's newest health update.
+            k (int): Maximum number of exchanges to return.
+            before (int): Only consider exchanges ending at or before this message position.
+
+        Returns:
+            list: (score, start, end) tuples, best first.
+        """
+        with self._lock:
+            document_count = len(self.documents)
+            if not document_count:
+                return []
+            average_length = self.total_length / document_count or 1
+            scores = Counter()
+            for term in set(tokenize(query)):
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (document_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for start, frequency in postings.items():
+                    length = self.documents[start]["length"]
+                    scores[start] += idf * frequency * (BM25_K1 + 1) / (
+                        frequency + BM25_K1 * (1 - BM25_B + BM25_B * length / average_length))
+            ranked = []
+            for start, score in scores.most_common():
+                end = self.documents[start]["end"]
+                if before is not None and end > before:
+                    continue
+                ranked.append((score, start, end))
+                if len(ranked) >= k:
+                    break
+            return ranked
+
+
+_recall_indexes = {}
+_recall_indexes_lock = threading.Lock()
+
+
+def get_recall_index(user_dir):
+    """Returns the process-wide recall index for a user directory."""
+    path = str(Path(user_dir) / RECALL_INDEX_FILENAME)
+    with _recall_indexes_lock:
+        index = _recall_indexes.get(path)
+        if index is None:
+            index = RecallIndex(user_dir)
+            _recall_indexes[path] = index
+        return index
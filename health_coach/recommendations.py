@@ -0,0 +1,260 @@
+import argparse
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from .config import USERS_DIR
+from .conversation_store import RECOMMENDATIONS_FILENAME
+
+# Open recommendations older than this are no longer brought up for follow-up.
+RECOMMENDATION_FOLLOW_UP_DAYS = int(os.getenv("RECOMMENDATION_FOLLOW_UP_DAYS", "21"))
+# At most this many open recommendations go into the system message.
+RECOMMENDATION_PROMPT_LIMIT = int(os.getenv("RECOMMENDATION_PROMPT_LIMIT", "5"))
+
+STATUSES = ("open", "done", "dismissed")
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+TOPIC_KEYWORDS = {
+    "sleep": r"sleep|bed|nap|insomnia|wake",
+    "activity": r"walk|exercise|steps|run|jog|stretch|workout|strength|cycling|swim|yoga|active|activity|movement",
+    "hydration": r"water|hydrat|soda|drink|caffeine|coffee|tea",
+    "nutrition": r"diet|eat|food|meal|snack|breakfast|lunch|dinner|protein|sugar|fiber|vegetable|fruit|calorie|"
+                 r"sodium|nutrition|omega",
+    "stress": r"stress|mindful|meditat|anxiety|relax|breath|mood|mental",
+    "medical": r"doctor|physician|healthcare provider|blood pressure|medication|symptom|check-?up",
+}
+TOPIC_PATTERNS = {topic: re.compile(rf"\b(?:{pattern})", re.I) for topic, pattern in TOPIC_KEYWORDS.items()}
+
+# "Recommendation: ...", optionally bulleted or in bold
+INLINE_PATTERN = re.compile(r"^\s*(?:[-*•]|\d+[.)])?\s*(?:\*\*)?recommendations?(?:\*\*)?\s*:\s*(?:\*\*)?\s*"
+                            r"((?:\*\*)?[^\s*].*)$", re.I)
+# a heading such as "**Recommendations for Tomorrow:**" or "### Overall Recommendations"
+HEADING_PATTERN = re.compile(r"^\s*(?:#+[^:]*\brecommendations?\b[^:]*|\*\*[^:*]*\brecommendations?\b[^:*]*:?\*\*"
+                             r"|[^:]*\brecommendations?\b[^:]*:)\s*:?\s*$", re.I)
+BULLET_PATTERN = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s+(\S.*)$")
+
+
+def classify_topic(text):
+    """The topic whose keywords occur most often in a recommendation, or "general"."""
+    counts = {topic: len(pattern.findall(text)) for topic, pattern in TOPIC_PATTERNS.items()}
+    topic = max(counts, key=counts.get)
+    return topic if counts[topic] else "general"
+
+
+def _clean(text):
+    return re.sub(r"\s+", " ", text.replace("**", "")).strip()
+
+
+def parse_recommendations(reply):
+    """
+    Finds the actionable recommendations in a coach reply.
+
+    Recognises "Recommendation: ..." lines and the bullets under a
+    recommendations heading, which is how the coach usually formats them.
+
+    Returns:
+        list: Recommendation texts without markdown emphasis, in reply order.
+    """
+    found = []
+    in_section = False
+    for line in (reply or "").split("\n"):
+        inline = INLINE_PATTERN.match(line)
+        if inline:
+            found.append(_clean(inline.group(1)))
+            continue
+        if HEADING_PATTERN.match(line) and line.strip():
+            in_section = True
+            continue
+        if not in_section or not line.strip():
+            continue
+        bullet = BULLET_PATTERN.match(line)
+        if bullet:
+            found.append(_clean(bullet.group(1)))
+        else:
+            # prose or the next heading ends the section
+            in_section = False
+    return [text for text in found if text]
+
+
+class RecommendationLedger:
+    """
+    Structured record of the recommendations a user has been given.
+
+    Stored as recommendations.jsonl in the user directory: an "add" line per
+    recommendation and a "status" line per change, so nothing is rewritten.
+    The lines are folded into in-memory indexes by id, status and topic, and
+    only lines appended since the last read are parsed.
+    """
+
+    def __init__(self, user_dir):
+        self.path = Path(user_dir) / RECOMMENDATIONS_FILENAME
+        self.records = {}
+        self.by_status = {status: set() for status in STATUSES}
+        self.by_topic = {}
+        self.read_size = 0
+        self.inode = None
+        self._lock = threading.Lock()
+
+    def _reset(self):
+        self.records = {}
+        self.by_status = {status: set() for status in STATUSES}
+        self.by_topic = {}
+        self.read_size = 0
+
+    def _apply(self, event):
+        if event["event"] == "add":
+            record = {key: event[key] for key in ("id", "text", "topic", "created", "seq")}
+            record.update({"status": "open", "updated": event["created"]})
+            self.records[record["id"]] = record
+            self.by_status["open"].add(record["id"])
+            self.by_topic.setdefault(record["topic"], set()).add(record["id"])
+        elif event["event"] == "status":
+            record = self.records.get(event["id"])
+            if record is None or event["status"] not in STATUSES:
+                return
+            self.by_status[record["status"]].discard(record["id"])
+            record["status"], record["updated"] = event["status"], event["at"]
+            self.by_status[record["status"]].add(record["id"])
+
+    def _read_new_lines(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self._reset()
+            self.inode = None
+            return
+        if stat.st_ino != self.inode or stat.st_size < self.read_size:
+            self._reset()
+            self.inode = stat.st_ino
+        if stat.st_size == self.read_size:
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self.read_size)
+            offset = self.read_size
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                offset += len(line)
+                try:
+                    self._apply(json.loads(line))
+                except (json.JSONDecodeError, KeyError, TypeError):
+                    logging.warning(f"Skipping unreadable line in {self.path}")
+        self.read_size = offset
+
+    def _append(self, events):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            for event in events:
+                f.write(json.dumps(event, ensure_ascii=False) + "\n")
+        self._read_new_lines()
+
+    def capture(self, reply, timestamp=None, seq=None):
+        """
+        Records the recommendations in a coach reply as open.
+
+        A recommendation whose text matches one that is still open is not added again.
+
+        Args:
+            reply (str): The coach's reply.
+            timestamp (str): When it was given, "%Y-%m-%d %H:%M:%S"; defaults to now.
+            seq (int): Position of the reply in the conversation.
+
+        Returns:
+            list: The new records.
+        """
+        texts = parse_recommendations(reply)
+        if not texts:
+            return []
+        timestamp = timestamp or time.strftime(TIMESTAMP_FORMAT)
+        with self._lock:
+            self._read_new_lines()
+            open_texts = {self.records[i]["text"].lower() for i in self.by_status["open"]}
+            events = []
+            for text in texts:
+                if text.lower() in open_texts:
+                    continue
+                open_texts.add(text.lower())
+                events.append({"event": "add", "id": uuid.uuid4().hex[:12], "text": text,
+                               "topic": classify_topic(text), "created": timestamp, "seq": seq})
+            if events:
+                self._append(events)
+            return [dict(self.records[event["id"]]) for event in events]
+
+    def set_status(self, recommendation_id, status):
+        """Marks a recommendation done, dismissed or open again."""
+        if status not in STATUSES:
+            raise ValueError(f"Unknown recommendation status: {status}")
+        with self._lock:
+            self._read_new_lines()
+            if recommendation_id not in self.records:
+                raise KeyError(recommendation_id)
+            self._append([{"event": "status", "id": recommendation_id, "status": status,
+                           "at": time.strftime(TIMESTAMP_FORMAT)}])
+
+    def query(self, status=None, topic=None, since=None):
+        """
+        Returns recommendations, newest first.
+
+        Args:
+            status (str): One of STATUSES, or None for all.
+            topic (str): e.g. "sleep", or None for all.
+            since (str): Only those created at or after this timestamp.
+        """
+        with self._lock:
+            self._read_new_lines()
+            ids = set(self.records) if status is None else set(self.by_status.get(status, ()))
+            if topic is not None:
+                ids &= self.by_topic.get(topic, set())
+            # newest first, also among records captured from the same reply
+            records = [dict(self.records[i]) for i in reversed(self.records) if i in ids]
+        if since is not None:
+            records = [record for record in records if record["created"] >= since]
+        return sorted(records, key=lambda record: record["created"], reverse=True)
+
+    def follow_up(self, limit=RECOMMENDATION_PROMPT_LIMIT, max_age_days=RECOMMENDATION_FOLLOW_UP_DAYS):
+        """
+        The open recommendations to bring up next: the newest one per topic
+        first, then further ones, ignoring any older than max_age_days.
+        """
+        since = time.strftime(TIMESTAMP_FORMAT, time.localtime(time.time() - max_age_days * 86400))
+        records = self.query(status="open", since=since)
+        topics = set()
+        first, rest = [], []
+        for record in records:
+            (rest if record["topic"] in topics else first).append(record)
+            topics.add(record["topic"])
+        return (first + rest)[:limit]
+
+
+_ledgers = {}
+_ledgers_lock = threading.Lock()
+
+
+def get_recommendation_ledger(user_dir):
+    """Returns the process-wide recommendation ledger for a user directory."""
+    path = str(Path(user_dir) / RECOMMENDATIONS_FILENAME)
+    with _ledgers_lock:
+        ledger = _ledgers.get(path)
+        if ledger is None:
+            ledger = RecommendationLedger(user_dir)
+            _ledgers[path] = ledger
+        return ledger
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='List or update a user\'s recommendations.')
+    parser.add_argument('user_id', type=str)
+    parser.add_argument('--status', choices=STATUSES, help='Only recommendations with this status')
+    parser.add_argument('--topic', type=str, help='Only recommendations on this topic')
+    parser.add_argument('--set', nargs=2, metavar=('ID', 'STATUS'), help='Change one recommendation\'s status')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    ledger = RecommendationLedger(USERS_DIR / args.user_id)
+    if args.set:
+        ledger.set_status(*args.set)
+    print(json.dumps(ledger.query(status=args.status, topic=args.topic), indent=2))
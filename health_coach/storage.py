@@ -0,0 +1,492 @@
+import argparse
+import contextlib
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from .config import USERS_DIR, XAI_HEALTH_DIR
+from .conversation_store import (CONTEXT_SUMMARIES_FILENAME, CONVERSATION_LOG_FILENAME, ConversationLog,
+                                HEALTH_METRICS_FILENAME, HEALTH_METRICS_META_FILENAME, HEALTH_TRENDS_FILENAME,
+                                LEGACY_SESSION_FILENAME, RECALL_INDEX_FILENAME, RECOMMENDATIONS_FILENAME,
+                                SESSION_META_FILENAME, SESSION_STORAGE_MODE, get_conversation_index,
+                                read_legacy_session_file)
+from .locking import ConflictError, atomic_write_json, file_version, message_fingerprint, user_lock
+from .persona_registry import get_persona_registry
+
+# "files" keeps the per-user JSON files; "sqlite" stores everything in XAI_HEALTH_DB_PATH.
+XAI_HEALTH_STORAGE = os.getenv("XAI_HEALTH_STORAGE", "files")
+XAI_HEALTH_DB_PATH = os.getenv("XAI_HEALTH_DB_PATH", os.path.join(XAI_HEALTH_DIR, "xai_health.sqlite3"))
+# Idle SQLite connections kept open for reuse; busier moments open extra ones briefly.
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", "4"))
+
+# Files derived from a user's conversation, removed together with it.
+DERIVED_FILENAMES = (CONTEXT_SUMMARIES_FILENAME, RECALL_INDEX_FILENAME, HEALTH_METRICS_FILENAME,
+                     HEALTH_METRICS_META_FILENAME, HEALTH_TRENDS_FILENAME, RECOMMENDATIONS_FILENAME)
+
+
+class FileStorage:
+    """
+    The original on-disk layout:
+
+    - userdata/<user>/conversation.jsonl (or session_state.json) under the app directory
+    - XAI_HEALTH_DIR/userdata/<user>_profile.json
+    - XAI_HEALTH_DIR/<user>_coach_attributes.json
+    - XAI_HEALTH_DIR/<user>_stripe_customer.json
+
+    Every write holds the user's lock and replaces JSON files atomically, so
+    several processes can serve the same user. Saves that pass an
+    expected_version raise ConflictError if the data changed since it was read.
+    """
+
+    def __init__(self, users_dir=None, data_dir=None):
+        self.users_dir = Path(users_dir or USERS_DIR)
+        self.data_dir = Path(data_dir or XAI_HEALTH_DIR)
+
+    def user_dir(self, user_id):
+        user_dir = self.users_dir / str(user_id)
+        user_dir.mkdir(parents=True, exist_ok=True)
+        return user_dir
+
+    def profile_path(self, user_id):
+        return self.data_dir / "userdata" / f"{user_id}_profile.json"
+
+    def coach_attributes_path(self, user_id):
+        return self.data_dir / f"{user_id}_coach_attributes.json"
+
+    def customer_path(self, user_id):
+        return self.data_dir / f"{user_id}_stripe_customer.json"
+
+    def load_conversation(self, user_id):
+        user_dir = self.user_dir(user_id)
+        if SESSION_STORAGE_MODE == "jsonl":
+            return ConversationLog(user_dir).load()
+        session_file = user_dir / LEGACY_SESSION_FILENAME
+        conversation, authentication = read_legacy_session_file(session_file) if session_file.exists() else ([], {})
+        log = ConversationLog(user_dir)
+        if log.exists():
+            # after a spell in jsonl mode session_state.json stops at the migration
+            # and the log carries on from it; the next save writes it back here
+            logged, logged_authentication = log.load()
+            if len(logged) > len(conversation) and logged[:len(conversation)] == conversation:
+                return logged, logged_authentication
+        return conversation, authentication
+
+    def save_conversation(self, user_id, conversation, authentication):
+        """
+        Stores the messages not yet on disk and the auth block.
+
+        Raises:
+            ConflictError: Another session saved messages this conversation lacks.
+        """
+        user_dir = self.user_dir(user_id)
+        with user_lock(user_id):
+            if SESSION_STORAGE_MODE == "jsonl":
+                ConversationLog(user_dir).sync(conversation, authentication=authentication)
+                return
+            session_file = user_dir / LEGACY_SESSION_FILENAME
+            if session_file.exists():
+                stored, _ = read_legacy_session_file(session_file)
+                if conversation[:len(stored)] != stored:
+                    raise ConflictError(f"{session_file} has messages this conversation does not start with")
+            atomic_write_json(session_file, {"conversation": conversation, "authentication": authentication},
+                              indent=4)
+
+    def conversation_version(self, user_id):
+        """Cheap token that changes whenever the stored conversation or auth block changes."""
+        user_dir = self.users_dir / str(user_id)
+        version = []
+        for filename in (CONVERSATION_LOG_FILENAME, SESSION_META_FILENAME, LEGACY_SESSION_FILENAME):
+            try:
+                stat = os.stat(user_dir / filename)
+                version.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                version.append(None)
+        return tuple(version)
+
+    def history_page(self, user_id, page_number, page_size):
+        if SESSION_STORAGE_MODE == "jsonl":
+            return get_conversation_index(self.user_dir(user_id)).page(page_number, page_size)
+        conversation, _ = self.load_conversation(user_id)
+        # timestamps are "%Y-%m-%d %H:%M:%S" strings, so they sort without parsing
+        conversation.sort(key=lambda x: x.get("timestamp", ""), reverse=True)
+        start = page_number * page_size
+        return conversation[start:start + page_size], len(conversation)
+
+    def delete_conversation(self, user_id):
+        user_dir = self.users_dir / str(user_id)
+        removed = 0
+        with user_lock(user_id):
+            filenames = (CONVERSATION_LOG_FILENAME, SESSION_META_FILENAME, LEGACY_SESSION_FILENAME) + DERIVED_FILENAMES
+            for filename in filenames:
+                path = user_dir / filename
+                if path.exists():
+                    path.unlink()
+                    removed += 1
+        return removed
+
+    def compact_conversation(self, user_id):
+        log = ConversationLog(self.users_dir / str(user_id))
+        # in json mode session_state.json is the conversation; compacting would migrate it away
+        if SESSION_STORAGE_MODE != "jsonl" or not log.exists() and not log.legacy_path.exists():
+            return {"kept": 0, "dropped": 0}
+        with user_lock(user_id):
+            return log.compact()
+
+    def checkpoint(self):
+        pass
+
+    def load_profile(self, user_id):
+        profile_path = self.profile_path(user_id)
+        if not profile_path.exists():
+            return None
+        with open(profile_path, "r") as file:
+            return json.load(file)
+
+    def profile_version(self, user_id):
+        return file_version(self.profile_path(user_id))
+
+    def save_profile(self, user_id, profile, expected_version=None):
+        """
+        Args:
+            expected_version: profile_version() when the profile was read; None to overwrite unconditionally.
+
+        Raises:
+            ConflictError: The profile was saved by someone else since expected_version.
+        """
+        profile_path = self.profile_path(user_id)
+        profile_path.parent.mkdir(parents=True, exist_ok=True)
+        with user_lock(user_id):
+            if expected_version is not None and self.profile_version(user_id) != expected_version:
+                raise ConflictError(f"Profile of {user_id} was changed by another session")
+            atomic_write_json(profile_path, profile)
+
+    def load_coach_attributes(self, user_id):
+        # mtime-cached through the persona registry; None when missing or unreadable
+        registry = get_persona_registry(str(self.data_dir / "all_available_coach_attributes.json"))
+        return registry.user_attributes(str(self.coach_attributes_path(user_id)), user_id)
+
+    def coach_attributes_version(self, user_id):
+        return file_version(self.coach_attributes_path(user_id))
+
+    def save_coach_attributes(self, user_id, attributes, expected_version=None):
+        """Like save_profile, for the coach attributes."""
+        path = self.coach_attributes_path(user_id)
+        with user_lock(user_id):
+            if expected_version is not None and self.coach_attributes_version(user_id) != expected_version:
+                raise ConflictError(f"Coach attributes of {user_id} were changed by another session")
+            atomic_write_json(path, {user_id: attributes}, indent=4)
+        get_persona_registry(str(self.data_dir / "all_available_coach_attributes.json")).invalidate_user(str(path))
+
+    def load_customer_id(self, user_id):
+        customer_path = self.customer_path(user_id)
+        if not customer_path.exists():
+            return None
+        with open(customer_path, "r") as f:
+            return json.load(f)["customer_id"]
+
+    def save_customer_id(self, user_id, customer_id):
+        with user_lock(user_id):
+            atomic_write_json(self.customer_path(user_id), {"customer_id": customer_id})
+
+    def list_users(self):
+        """Every user ID that has any data in the file layout."""
+        users = set()
+        if self.users_dir.exists():
+            users.update(p.name for p in self.users_dir.iterdir() if p.is_dir())
+        suffixes = {
+            self.data_dir / "userdata": "_profile.json",
+            self.data_dir: "_coach_attributes.json",
+        }
+        for directory, suffix in suffixes.items():
+            if directory.exists():
+                users.update(p.name[:-len(suffix)] for p in directory.glob(f"*{suffix}"))
+        if self.data_dir.exists():
+            users.update(p.name[:-len("_stripe_customer.json")] for p in self.data_dir.glob("*_stripe_customer.json"))
+        users.difference_update({"default", "all_available"})
+        return sorted(users)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    user_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT,
+    timestamp TEXT,
+    PRIMARY KEY (user_id, seq)
+);
+CREATE INDEX IF NOT EXISTS messages_user_timestamp ON messages (user_id, timestamp);
+CREATE TABLE IF NOT EXISTS sessions (
+    user_id TEXT PRIMARY KEY,
+    authentication TEXT NOT NULL DEFAULT '{}',
+    message_count INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS profiles (
+    user_id TEXT PRIMARY KEY,
+    profile TEXT NOT NULL,
+    updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS coach_attributes (
+    user_id TEXT PRIMARY KEY,
+    attributes TEXT NOT NULL,
+    updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS billing (
+    user_id TEXT PRIMARY KEY,
+    customer_id TEXT NOT NULL,
+    updated_at REAL
+);
+CREATE INDEX IF NOT EXISTS billing_customer ON billing (customer_id);
+"""
+
+
+class SQLiteStorage:
+    """
+    All per-user data in one SQLite database in WAL mode.
+
+    Connections come from a small pool shared by all threads; Streamlit runs
+    each rerun on a new thread, so per-thread connections would pile up. Every
+    save is a single IMMEDIATE transaction, so readers never see a half-written
+    state and concurrent writers from any process are serialized.
+    """
+
+    def __init__(self, path=None, pool_size=None):
+        self.path = Path(path or XAI_HEALTH_DB_PATH)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._pool = queue.LifoQueue(maxsize=SQLITE_POOL_SIZE if pool_size is None else pool_size)
+        with self._connection() as conn:
+            conn.executescript(SCHEMA)
+
+    def _open(self):
+        conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextlib.contextmanager
+    def _connection(self):
+        """
+        Lends a connection to one thread; it is returned to the pool afterwards,
+        or closed when the pool is full. Wrap it in `with conn:` to commit.
+        """
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._open()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            try:
+                self._pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    def close(self):
+        """Closes the pooled connections."""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def load_conversation(self, user_id):
+        with self._connection() as conn:
+            rows = conn.execute(
+                "SELECT role, content, timestamp FROM messages WHERE user_id = ? ORDER BY seq", (user_id,)
+            ).fetchall()
+            session = conn.execute("SELECT authentication FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+        conversation = [{"role": role, "content": content, "timestamp": timestamp} for role, content, timestamp in rows]
+        return conversation, json.loads(session[0]) if session else {}
+
+    def save_conversation(self, user_id, conversation, authentication):
+        """
+        Raises:
+            ConflictError: Another session saved messages this conversation lacks.
+        """
+        with self._connection() as conn, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT message_count FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+            message_count = row[0] if row else 0
+            if message_count:
+                last = conn.execute("SELECT role, content, timestamp FROM messages WHERE user_id = ? AND seq = ?",
+                                    (user_id, message_count - 1)).fetchone()
+                stored = {"role": last[0], "content": last[1], "timestamp": last[2]} if last else None
+                if (len(conversation) < message_count or stored is not None
+                        and message_fingerprint(conversation[message_count - 1]) != message_fingerprint(stored)):
+                    raise ConflictError(f"Stored conversation of {user_id} has messages this one does not start with")
+            new_messages = conversation[message_count:]
+            conn.executemany(
+                "INSERT OR REPLACE INTO messages (user_id, seq, role, content, timestamp) VALUES (?, ?, ?, ?, ?)",
+                [(user_id, message_count + i, m["role"], m.get("content"), m.get("timestamp"))
+                 for i, m in enumerate(new_messages)],
+            )
+            conn.execute(
+                "INSERT INTO sessions (user_id, authentication, message_count, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET authentication = excluded.authentication, "
+                "message_count = excluded.message_count, updated_at = excluded.updated_at",
+                (user_id, json.dumps(authentication or {}), message_count + len(new_messages), time.time()),
+            )
+
+    def _fetchone(self, sql, params):
+        with self._connection() as conn:
+            return conn.execute(sql, params).fetchone()
+
+    def conversation_version(self, user_id):
+        row = self._fetchone("SELECT message_count, updated_at FROM sessions WHERE user_id = ?", (user_id,))
+        return tuple(row) if row else None
+
+    def history_page(self, user_id, page_number, page_size):
+        with self._connection() as conn:
+            total = conn.execute("SELECT COUNT(*) FROM messages WHERE user_id = ?", (user_id,)).fetchone()[0]
+            rows = conn.execute(
+                "SELECT role, content, timestamp FROM messages WHERE user_id = ? "
+                "ORDER BY timestamp DESC LIMIT ? OFFSET ?",
+                (user_id, page_size, page_number * page_size),
+            ).fetchall()
+        return [{"role": role, "content": content, "timestamp": timestamp} for role, content, timestamp in rows], total
+
+    def delete_conversation(self, user_id):
+        with self._connection() as conn, conn:
+            removed = conn.execute("DELETE FROM messages WHERE user_id = ?", (user_id,)).rowcount
+            conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+        # derived files live in the user directory whichever backend holds the messages
+        for filename in DERIVED_FILENAMES:
+            path = USERS_DIR / str(user_id) / filename
+            if path.exists():
+                path.unlink()
+        return removed
+
+    def compact_conversation(self, user_id):
+        # rows are only ever complete, so there is nothing to drop per user
+        count = self._fetchone("SELECT COUNT(*) FROM messages WHERE user_id = ?", (user_id,))[0]
+        return {"kept": count, "dropped": 0}
+
+    def checkpoint(self):
+        """Folds the WAL back into the database file so it does not grow without bound."""
+        self._fetchone("PRAGMA wal_checkpoint(TRUNCATE)", ())
+
+    def load_profile(self, user_id):
+        row = self._fetchone("SELECT profile FROM profiles WHERE user_id = ?", (user_id,))
+        return json.loads(row[0]) if row else None
+
+    def profile_version(self, user_id):
+        row = self._fetchone("SELECT updated_at FROM profiles WHERE user_id = ?", (user_id,))
+        return row[0] if row else None
+
+    def save_profile(self, user_id, profile, expected_version=None):
+        with self._connection() as conn, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT updated_at FROM profiles WHERE user_id = ?", (user_id,)).fetchone()
+            if expected_version is not None and (row[0] if row else None) != expected_version:
+                raise ConflictError(f"Profile of {user_id} was changed by another session")
+            conn.execute("INSERT OR REPLACE INTO profiles (user_id, profile, updated_at) VALUES (?, ?, ?)",
+                         (user_id, json.dumps(profile), time.time()))
+
+    def load_coach_attributes(self, user_id):
+        row = self._fetchone("SELECT attributes FROM coach_attributes WHERE user_id = ?", (user_id,))
+        return json.loads(row[0]) if row else None
+
+    def coach_attributes_version(self, user_id):
+        row = self._fetchone("SELECT updated_at FROM coach_attributes WHERE user_id = ?", (user_id,))
+        return row[0] if row else None
+
+    def save_coach_attributes(self, user_id, attributes, expected_version=None):
+        with self._connection() as conn, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT updated_at FROM coach_attributes WHERE user_id = ?", (user_id,)).fetchone()
+            if expected_version is not None and (row[0] if row else None) != expected_version:
+                raise ConflictError(f"Coach attributes of {user_id} were changed by another session")
+            conn.execute("INSERT OR REPLACE INTO coach_attributes (user_id, attributes, updated_at) VALUES (?, ?, ?)",
+                         (user_id, json.dumps(attributes), time.time()))
+
+    def load_customer_id(self, user_id):
+        row = self._fetchone("SELECT customer_id FROM billing WHERE user_id = ?", (user_id,))
+        return row[0] if row else None
+
+    def save_customer_id(self, user_id, customer_id):
+        with self._connection() as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO billing (user_id, customer_id, updated_at) VALUES (?, ?, ?)",
+                         (user_id, customer_id, time.time()))
+
+    def list_users(self):
+        users = set()
+        with self._connection() as conn:
+            for table in ("sessions", "profiles", "coach_attributes", "billing"):
+                users.update(row[0] for row in conn.execute(f"SELECT user_id FROM {table}"))
+        return sorted(users)
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    """Returns the process-wide storage backend selected by XAI_HEALTH_STORAGE."""
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            if XAI_HEALTH_STORAGE == "sqlite":
+                _storage = SQLiteStorage()
+            elif XAI_HEALTH_STORAGE == "files":
+                _storage = FileStorage()
+            else:
+                raise ValueError(f"Unknown XAI_HEALTH_STORAGE backend: {XAI_HEALTH_STORAGE}")
+            logging.info(f"Using {type(_storage).__name__} for user data")
+        return _storage
+
+
+def migrate_files_to_sqlite(source=None, target=None, overwrite=False):
+    """
+    Copies every user's file-based data into the SQLite backend.
+
+    Users that already have a session row in the database are skipped unless
+    overwrite is set, so the migrator can safely be run more than once.
+
+    Returns:
+        dict: Number of users and records migrated per kind of data.
+    """
+    source = source or FileStorage()
+    target = target or SQLiteStorage()
+    counts = {"users": 0, "messages": 0, "profiles": 0, "coach_attributes": 0, "billing": 0}
+    already_migrated = set(target.list_users())
+    for user_id in source.list_users():
+        if user_id in already_migrated and not overwrite:
+            logging.info(f"Skipping {user_id}, already in {target.path}")
+            continue
+        conversation, authentication = source.load_conversation(user_id)
+        if conversation or authentication:
+            target.save_conversation(user_id, conversation, authentication)
+            counts["messages"] += len(conversation)
+        profile = source.load_profile(user_id)
+        if profile is not None:
+            target.save_profile(user_id, profile)
+            counts["profiles"] += 1
+        attributes = source.load_coach_attributes(user_id)
+        if attributes is not None:
+            target.save_coach_attributes(user_id, attributes)
+            counts["coach_attributes"] += 1
+        customer_id = source.load_customer_id(user_id)
+        if customer_id:
+            target.save_customer_id(user_id, customer_id)
+            counts["billing"] += 1
+        counts["users"] += 1
+    logging.info(f"Migrated file storage into {target.path}: {counts}")
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Manage the per-user storage backend.')
+    parser.add_argument('command', choices=['migrate'], help='migrate: copy file-based user data into SQLite')
+    parser.add_argument('--db', type=str, default=XAI_HEALTH_DB_PATH, help='SQLite database to migrate into')
+    parser.add_argument('--overwrite', action='store_true', help='Re-copy users that are already in the database')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print(migrate_files_to_sqlite(target=SQLiteStorage(args.db), overwrite=args.overwrite))
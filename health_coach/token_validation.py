@@ -0,0 +1,107 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Seconds a successful X token validation is trusted.
+TOKEN_VALIDATION_TTL = float(os.getenv("TOKEN_VALIDATION_TTL", "600"))
+# Fraction of the TTL after which a cached entry is revalidated in the background.
+TOKEN_REVALIDATE_AFTER = float(os.getenv("TOKEN_REVALIDATE_AFTER", "0.75"))
+
+
+def token_key(access_token):
+    # never keep raw tokens as dictionary keys
+    return hashlib.sha256(access_token.encode("utf-8")).hexdigest()
+
+
+class TokenValidationCache:
+    """
+    In-memory record of recently validated X access tokens.
+
+    A cached validation is returned without any network call; once an entry is
+    older than TOKEN_REVALIDATE_AFTER of its TTL it is revalidated on a
+    background thread, and any failed validation drops the entry immediately.
+    """
+
+    def __init__(self, ttl=None, revalidate_after=None):
+        self.ttl = TOKEN_VALIDATION_TTL if ttl is None else ttl
+        self.revalidate_after = TOKEN_REVALIDATE_AFTER if revalidate_after is None else revalidate_after
+        self._entries = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="token-revalidate")
+
+    def prime(self, access_token, username):
+        """Records a validation that just happened elsewhere, e.g. at the end of the OAuth callback."""
+        with self._lock:
+            self._entries[token_key(access_token)] = (username, time.monotonic())
+
+    def invalidate(self, access_token):
+        with self._lock:
+            self._entries.pop(token_key(access_token), None)
+
+    def validate(self, access_token, access_token_secret, validator):
+        """
+        Returns the username for a token pair, validating it only when needed.
+
+        Args:
+            access_token (str): X OAuth access token.
+            access_token_secret (str): X OAuth access token secret.
+            validator (callable): Takes (access_token, access_token_secret), returns the
+                username and raises if the tokens are not valid.
+
+        Returns:
+            str: The username the tokens belong to.
+        """
+        key = token_key(access_token)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None:
+            username, validated_at = entry
+            age = now - validated_at
+            if age < self.ttl:
+                if age >= self.ttl * self.revalidate_after:
+                    self._revalidate_in_background(key, access_token, access_token_secret, validator)
+                return username
+
+        try:
+            username = validator(access_token, access_token_secret)
+        except Exception:
+            self.invalidate(access_token)
+            raise
+        with self._lock:
+            self._entries[key] = (username, time.monotonic())
+        return username
+
+    def _revalidate_in_background(self, key, access_token, access_token_secret, validator):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def revalidate():
+            try:
+                username = validator(access_token, access_token_secret)
+                with self._lock:
+                    self._entries[key] = (username, time.monotonic())
+                logging.debug("Background token revalidation succeeded: user=%s", username)
+            except Exception as e:
+                logging.warning("Background token revalidation failed, dropping cached entry: %s", str(e))
+                with self._lock:
+                    self._entries.pop(key, None)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        self._executor.submit(revalidate)
+
+
+_cache = TokenValidationCache()
+
+
+def get_token_validation_cache():
+    """Returns the process-wide validation cache shared by every session."""
+    return _cache
@@ -0,0 +1,225 @@
+"""
+Prompt morphing and topic explosion against the xAI API.
+
+Importable without Streamlit so the batch pipeline and the UI can share it;
+xai_utilities.py re-exports these names for existing callers.
+"""
+import contextvars
+import json
+import logging
+import os
+import re
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .llm_cache import cached_chat_completion
+
+XAI_STACKS_DIR = os.getenv("XAI_STACKS_DIR") or "xai_stacks"
+
+# Maximum number of prompts sent to the API at the same time.
+XAI_MAX_CONCURRENCY = int(os.getenv("XAI_MAX_CONCURRENCY", "4"))
+
+
+class GiveMeTheLatest:
+
+    def __init__(self, real_time_friendly_morpher=None,reformulater=None, morph_prompt=None, exploder_instruction=None, exploder_value=8, max_concurrency=None):
+        self.morph_prompt = morph_prompt or "Optimize this prompt."
+        self.reformulater = f"{morph_prompt}. Return the revised prompt as plain text without pleasantries or explanations."
+        self.real_time_friendly_morpher = real_time_friendly_morpher or "You are a search assistant who is fully aware of all Grok's real-time information sources including but not limited to news, fresh X content, fresh web content, Arxiv and other pdfs, financial, sports, and location-based data. As you know, not all these sources are currently available via the xai API. To remedy this shortcoming, you will reformulate the following prompts to take full advantage of real-time results.  You must prioritize real-time information from peer-reviewed or highly credible sources."
+        self.exploder_value = exploder_value or 8
+        self.exploder_instruction = exploder_instruction or f"Your task is to 'explode' this prompt, which describes a particular substantive domain, into a set of {exploder_value} prompts that are subsets of or interestingly adjacent to this domain. Please provide those prompts as valid JSON."
+        self.max_concurrency = max_concurrency or XAI_MAX_CONCURRENCY
+
+
+    def generate_real_time_friendly_topic_link_sets(self, prompts, exploder_value=8):
+        # generates real-time-friendly prompts for domain-specific publications
+        # prompts are high-level concepts like health, space warfare, etc.
+        # example prompts: ["xai Health Coach on fitness, nutrition, exercise, equipment", "UltraScale Aerospace publication"]
+        if isinstance(prompts,str):
+            prompts = [prompts]
+        exploder_morph_prompt = self.real_time_friendly_morpher + '/n/n' + self.exploder_instruction
+        prompts = [prompt for prompt in prompts if prompt]
+        new_link_sets = self.morph_prompt_list(prompts, exploder_morph_prompt, create_link=True)
+        exploded_prompts_dict = {}
+        for prompt, new_link_set in zip(prompts, new_link_sets):
+            exploded_prompts_dict[prompt] = new_link_set or prompt
+        return exploded_prompts_dict
+
+    def save_exploded_prompts_dict(self, exploded_prompts_dict):
+        os.makedirs(XAI_STACKS_DIR, exist_ok=True)
+        with open(f"{XAI_STACKS_DIR}/exploded_prompts_dict.json", "w") as file:
+            json.dump(exploded_prompts_dict, file, indent=4)
+
+    def explode_topic_catalog(self, topics, output_path, max_concurrency=None):
+        """
+        Explodes a catalog of topics, streaming each result to a JSONL file as it finishes.
+
+        The output file doubles as the checkpoint: topics that already have a
+        result line are skipped, so a rerun after a crash only calls the API for
+        the topics that were still pending or had failed.
+
+        Args:
+            topics (list): Topics to explode, e.g. from read_topic_catalog.
+            output_path (str): JSONL file that results are appended to.
+            max_concurrency (int): Maximum simultaneous API calls; defaults to self.max_concurrency.
+
+        Returns:
+            dict: Counts of skipped, completed and failed topics.
+        """
+        completed = load_completed_topics(output_path)
+        pending = [topic for topic in dict.fromkeys(topics) if topic and topic not in completed]
+        summary = {"skipped": len(completed), "completed": 0, "failed": 0}
+        logging.info(f"Exploding {len(pending)} topics, {len(completed)} already done in {output_path}")
+        if not pending:
+            return summary
+
+        exploder_morph_prompt = self.real_time_friendly_morpher + '/n/n' + self.exploder_instruction
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        write_lock = threading.Lock()
+        workers = min(max_concurrency or self.max_concurrency, len(pending))
+        with open(output_path, "a", encoding="utf-8") as output, \
+                ThreadPoolExecutor(max_workers=workers, thread_name_prefix="explode") as executor:
+            # each call runs in a copy of this thread's context, so the usage
+            # ledger still charges it to the current user
+            futures = {
+                executor.submit(contextvars.copy_context().run, self.morph_single_prompt, topic,
+                                exploder_morph_prompt, True, "explode"): topic
+                for topic in pending
+            }
+            for future in as_completed(futures):
+                topic = futures[future]
+                result = future.result()
+                if result is None:
+                    summary["failed"] += 1
+                    continue
+                record = {"topic": topic, "result": result, "completed_at": time.strftime("%Y-%m-%d %H:%M:%S")}
+                with write_lock:
+                    output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    output.flush()
+                    os.fsync(output.fileno())
+                summary["completed"] += 1
+        logging.info(f"Topic explosion finished: {summary}")
+        return summary
+
+
+    def morph_prompts(self, prompts, morph_prompt=None, create_link=True):
+        """
+        Processes single or multiple prompts, applies a morph prompt, and e
+        ither
+        fetches the result of the morphed prompt or creates a link to the Grok website.
+
+        Args:
+            prompts (str|list): A single prompt or a list of prompts.
+            morph_prompt (str): Instruction to optimize the prompt(s).
+            create_link (bool): If True, create a Grok website link for the morphed prompt(s).
+
+        Returns:
+            str|list: Morphed prompt(s) or a link to the Grok website.
+        """
+
+        if isinstance(prompts, str):
+            prompts = [prompts]  # Ensure prompts is a list
+
+        results = self.morph_prompt_list(prompts, morph_prompt, create_link)
+
+        # Return single result if input was a single prompt
+        if len(prompts) == 1:
+            return results[0] if results else None
+        return results
+
+    def morph_prompt_list(self, prompts, morph_prompt=None, create_link=True, max_concurrency=None):
+        """
+        Morphs a list of prompts concurrently.
+
+        Args:
+            prompts (list): Prompts to morph; empty prompts are skipped.
+            morph_prompt (str): Instruction to optimize the prompts.
+            create_link (bool): If True, create Grok website links for the morphed prompts.
+            max_concurrency (int): Maximum simultaneous API calls; defaults to self.max_concurrency.
+
+        Returns:
+            list: One result per non-empty prompt, in input order, with None for
+            prompts whose call failed or returned nothing.
+        """
+        if not morph_prompt:
+            morph_prompt = "You are a search assistant who is fully aware of all Grok's real-time information sources including but not limited to news, fresh X content, fresh web content, Arxiv and other pdfs, financial, sports, and location-based data. As you know, not all these sources are currently available via the xai API. To remedy this shortcoming, you will be reformulating the prompts to take full advantage of real-time results.  You should prioritize real-time information from peer-reviewed or highly credible sources."
+
+        prompts = [prompt for prompt in prompts if prompt]
+        if not prompts:
+            return []
+
+        logging.debug(f"Morphing {len(prompts)} prompts (create_link={create_link})")
+
+        workers = min(max_concurrency or self.max_concurrency, len(prompts))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="morph") as executor:
+            # map preserves input order regardless of completion order; contexts are
+            # copied here, in the caller's thread, so usage is charged to its user
+            contexts = [contextvars.copy_context() for _ in prompts]
+            return list(executor.map(
+                lambda context, prompt: context.run(self.morph_single_prompt, prompt, morph_prompt, create_link),
+                contexts, prompts))
+
+    def morph_single_prompt(self, prompt, morph_prompt, create_link=True, call_site="morph"):
+        """Morphs one prompt; errors are logged and reported as None so a batch is never aborted."""
+        reformulate = f"{morph_prompt}. Return the revised prompt as plain text without pleasantries or explanations."
+
+        # Prepare messages for OpenAI API
+        messages = [
+            dict(role="system", content=morph_prompt),
+            dict(role="user", content=prompt),
+            dict(role="assistant", content=reformulate)
+        ]
+
+        try:
+            # Get revised prompt; identical morph requests are served from the cache
+            ai_response = cached_chat_completion(call_site, messages)
+        except Exception as e:
+            logging.error(f"Error morphing prompt {prompt!r}: {str(e)}")
+            return None
+
+        logging.debug(f"Morphed prompt {prompt!r} to {ai_response!r}")
+        if not ai_response:
+            return None
+        if create_link:
+            encoded_prompt = urllib.parse.quote(ai_response)
+            return f"https://grok.com/?q={encoded_prompt}"
+        return ai_response
+
+
+def read_topic_catalog(path):
+    """
+    Reads topics from a catalog such as resources/healthprompts.csv.
+
+    Each line holds one topic, optionally quoted and followed by a comma or by
+    a JSON-style ': ""' remnant, so both list-like and dict-like lines parse.
+    """
+    topics = []
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            quoted = re.match(r'\s*"([^"]+)"', line)
+            topic = quoted.group(1) if quoted else line.rstrip(",").strip()
+            if topic:
+                topics.append(topic.strip())
+    return list(dict.fromkeys(topics))
+
+
+def load_completed_topics(output_path):
+    """Returns the topics that already have a result in a topic explosion JSONL file."""
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path, "r", encoding="utf-8") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the line being written when the previous run died
+                continue
+            if record.get("result"):
+                completed.add(record["topic"])
+    return completed
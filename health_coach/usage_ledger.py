@@ -0,0 +1,269 @@
+import argparse
+import atexit
+import contextvars
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from .config import XAI_HEALTH_DIR
+
+USAGE_LEDGER_PATH = os.getenv("USAGE_LEDGER_PATH", os.path.join(XAI_HEALTH_DIR, "usage_ledger.sqlite3"))
+USAGE_LEDGER_ENABLED = os.getenv("USAGE_LEDGER_ENABLED", "true").lower() in ("1", "true", "yes")
+# Records are buffered in memory and written in one transaction at most this often,
+# or sooner once USAGE_FLUSH_BATCH of them are waiting.
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "5"))
+USAGE_FLUSH_BATCH = int(os.getenv("USAGE_FLUSH_BATCH", "200"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    ts REAL NOT NULL,
+    day TEXT NOT NULL,
+    user_id TEXT,
+    call_site TEXT NOT NULL,
+    model TEXT,
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    completion_tokens INTEGER NOT NULL DEFAULT 0,
+    latency_ms REAL NOT NULL,
+    first_token_ms REAL,
+    streamed INTEGER NOT NULL DEFAULT 0,
+    ok INTEGER NOT NULL DEFAULT 1,
+    estimated INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS usage_user_day ON usage (user_id, day);
+CREATE INDEX IF NOT EXISTS usage_day ON usage (day);
+"""
+
+# The user a request is made for. Streamlit runs each session's script on its own
+# thread, so setting this once per rerun attributes every call made on that thread.
+current_user = contextvars.ContextVar("usage_current_user", default=None)
+
+
+def set_current_user(user_id):
+    current_user.set(user_id)
+
+
+def estimate_prompt_tokens(messages):
+    # same four-characters-per-token estimate as the context builder
+    return sum(len(str(m.get("content") or "")) // 4 + 1 for m in messages or [])
+
+
+class UsageLedger:
+    """
+    Append-only record of every xAI call: who, which call site, which model,
+    how many tokens and how long it took.
+
+    Rows are never updated. Writes are buffered and flushed in batches from a
+    background thread, so recording adds no disk I/O to the request itself.
+    """
+
+    def __init__(self, path=None, flush_interval=None, flush_batch=None):
+        self.path = Path(path or USAGE_LEDGER_PATH)
+        self.flush_interval = USAGE_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self.flush_batch = flush_batch or USAGE_FLUSH_BATCH
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self._pending = []
+        self._wakeup = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name="usage-ledger", daemon=True)
+        self._flusher.start()
+
+    def record(self, call_site, model, latency, usage=None, messages=None, completion_text=None,
+               first_token=None, streamed=False, ok=True, user_id=None):
+        """
+        Queues one call for the ledger.
+
+        Args:
+            call_site (str): e.g. "dialogue", "morph" or "research".
+            model (str): Model the request was sent to.
+            latency (float): Seconds until the full response was received.
+            usage: The response's usage object or dict; when missing, tokens are
+                estimated from messages and completion_text and flagged as estimated.
+            first_token (float): Seconds to the first streamed token, if streamed.
+            user_id (str): Defaults to the current_user context variable.
+        """
+        now = time.time()
+        prompt_tokens = completion_tokens = None
+        if usage is not None:
+            if not isinstance(usage, dict):
+                usage = {"prompt_tokens": getattr(usage, "prompt_tokens", None),
+                         "completion_tokens": getattr(usage, "completion_tokens", None)}
+            prompt_tokens = usage.get("prompt_tokens")
+            completion_tokens = usage.get("completion_tokens")
+        estimated = ok and prompt_tokens is None
+        if estimated:
+            prompt_tokens = estimate_prompt_tokens(messages)
+            completion_tokens = len(completion_text or "") // 4
+        row = (now, time.strftime("%Y-%m-%d", time.localtime(now)), user_id or current_user.get(), call_site,
+               model, prompt_tokens or 0, completion_tokens or 0, latency * 1000,
+               first_token * 1000 if first_token is not None else None,
+               int(streamed), int(ok), int(bool(estimated)))
+        with self._lock:
+            self._pending.append(row)
+            if len(self._pending) >= self.flush_batch:
+                self._wakeup.set()
+
+    def flush(self):
+        with self._lock:
+            rows, self._pending = self._pending, []
+            if not rows:
+                return 0
+            self._conn.executemany(
+                "INSERT INTO usage (ts, day, user_id, call_site, model, prompt_tokens, completion_tokens, "
+                "latency_ms, first_token_ms, streamed, ok, estimated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+        return len(rows)
+
+    def _flush_loop(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logging.error(f"Error writing usage ledger {self.path}: {str(e)}")
+
+    def _aggregate(self, group_by, where, params):
+        self.flush()
+        query = (
+            f"SELECT {group_by}, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens), "
+            "AVG(CASE WHEN ok THEN prompt_tokens END), MAX(prompt_tokens), AVG(latency_ms), MAX(latency_ms), "
+            "AVG(first_token_ms), SUM(1 - ok) "
+            f"FROM usage {where} GROUP BY {group_by} ORDER BY {group_by}"
+        )
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        keys = group_by.split(", ")
+        results = []
+        for row in rows:
+            entry = dict(zip(keys, row[:len(keys)]))
+            (calls, prompt_tokens, completion_tokens, avg_prompt, max_prompt,
+             avg_latency, max_latency, avg_first_token, errors) = row[len(keys):]
+            entry.update({
+                "calls": calls,
+                "prompt_tokens": prompt_tokens or 0,
+                "completion_tokens": completion_tokens or 0,
+                "avg_prompt_tokens": round(avg_prompt or 0, 1),
+                "max_prompt_tokens": max_prompt or 0,
+                "avg_latency_ms": round(avg_latency or 0, 1),
+                "max_latency_ms": round(max_latency or 0, 1),
+                "avg_first_token_ms": round(avg_first_token, 1) if avg_first_token is not None else None,
+                "errors": errors or 0,
+            })
+            results.append(entry)
+        return results
+
+    @staticmethod
+    def _filters(user_id=None, call_site=None, since=None, until=None):
+        clauses, params = [], []
+        for column, op, value in (("user_id", "=", user_id), ("call_site", "=", call_site),
+                                  ("day", ">=", since), ("day", "<=", until)):
+            if value is not None:
+                clauses.append(f"{column} {op} ?")
+                params.append(value)
+        return ("WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def usage_by_user(self, call_site=None, since=None, until=None):
+        """Totals per user and call site; since/until are inclusive YYYY-MM-DD days."""
+        where, params = self._filters(call_site=call_site, since=since, until=until)
+        return self._aggregate("user_id, call_site", where, params)
+
+    def usage_by_day(self, user_id=None, call_site=None, since=None, until=None):
+        """
+        Totals per day and call site, optionally for one user.
+
+        avg_prompt_tokens and max_prompt_tokens per day show whether a user's
+        context keeps growing.
+        """
+        where, params = self._filters(user_id=user_id, call_site=call_site, since=since, until=until)
+        return self._aggregate("day, call_site", where, params)
+
+
+class MeteredStream:
+    """
+    Wraps a streamed completion and records it in the ledger, if any, once it is consumed.
+
+    Chunks are passed through unchanged; usage comes from the final chunk when
+    the API sends one (stream_options include_usage), otherwise it is estimated.
+    """
+
+    def __init__(self, stream, ledger, call_site, model, messages, started, on_finish=None):
+        self._stream = stream
+        self._ledger = ledger
+        self._call_site = call_site
+        self._model = model
+        self._messages = messages
+        self._started = started
+        self._on_finish = on_finish
+        self._user_id = current_user.get()
+
+    def __iter__(self):
+        first_token = None
+        usage = None
+        text = []
+        ok = False
+        try:
+            for chunk in self._stream:
+                if getattr(chunk, "usage", None):
+                    usage = chunk.usage
+                for choice in chunk.choices or []:
+                    if choice.delta and choice.delta.content:
+                        if first_token is None:
+                            first_token = time.perf_counter() - self._started
+                        text.append(choice.delta.content)
+                yield chunk
+            ok = True
+        finally:
+            latency = time.perf_counter() - self._started
+            if self._ledger is not None:
+                self._ledger.record(self._call_site, self._model, latency, usage=usage, messages=self._messages,
+                                    completion_text="".join(text), first_token=first_token, streamed=True,
+                                    ok=ok, user_id=self._user_id)
+            if self._on_finish:
+                self._on_finish(latency, ok)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def get_usage_ledger():
+    """Returns the process-wide ledger, or None when USAGE_LEDGER_ENABLED is off."""
+    global _ledger
+    if not USAGE_LEDGER_ENABLED:
+        return None
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = UsageLedger()
+            atexit.register(_ledger.flush)
+        return _ledger
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summarize xAI token usage and latency from the ledger.')
+    parser.add_argument('--by', choices=['user', 'day'], default='day', help='Aggregate per user or per day')
+    parser.add_argument('--user', type=str, help='Only this user (with --by day)')
+    parser.add_argument('--call_site', type=str, help='Only this call site, e.g. dialogue')
+    parser.add_argument('--since', type=str, help='First day to include, YYYY-MM-DD')
+    parser.add_argument('--until', type=str, help='Last day to include, YYYY-MM-DD')
+    parser.add_argument('--db', type=str, default=USAGE_LEDGER_PATH)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    ledger = UsageLedger(args.db)
+    if args.by == 'user':
+        rows = ledger.usage_by_user(call_site=args.call_site, since=args.since, until=args.until)
+    else:
+        rows = ledger.usage_by_day(user_id=args.user, call_site=args.call_site, since=args.since, until=args.until)
+    print(json.dumps(rows, indent=2))
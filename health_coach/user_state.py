@@ -0,0 +1,162 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from .locking import ConflictError, user_lock
+from .storage import get_storage
+
+# Seconds between version checks of a cached user; within this window a rerun
+# is served from memory without touching the storage backend at all.
+USER_STATE_CHECK_INTERVAL = float(os.getenv("USER_STATE_CHECK_INTERVAL", "2"))
+# Number of users whose conversation is kept in memory.
+USER_STATE_CACHE_SIZE = int(os.getenv("USER_STATE_CACHE_SIZE", "256"))
+
+
+def _message_key(message):
+    return message.get("role"), message.get("timestamp"), message.get("content")
+
+
+class _UserState:
+    __slots__ = ("conversation", "authentication", "version", "checked_at")
+
+    def __init__(self, conversation, authentication, version, checked_at):
+        self.conversation = conversation
+        self.authentication = authentication
+        self.version = version
+        self.checked_at = checked_at
+
+
+class UserStateCache:
+    """
+    Process-wide cache of each user's conversation and auth block.
+
+    Shared by every Streamlit rerun, tab and session in the process. An entry
+    is reused until the backend's conversation_version for that user changes,
+    and saves write through to the backend and refresh the entry, so a rerun
+    only reads from disk when another process changed the data.
+
+    The cache-wide lock only guards the entry table; storage reads and writes
+    happen under a lock per user, so one user's slow disk or contended file
+    lock never holds up anyone else.
+    """
+
+    def __init__(self, storage=None, check_interval=None, max_users=None):
+        self.storage = storage
+        self.check_interval = USER_STATE_CHECK_INTERVAL if check_interval is None else check_interval
+        self.max_users = USER_STATE_CACHE_SIZE if max_users is None else max_users
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._user_locks = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _storage(self):
+        return self.storage or get_storage()
+
+    def _user_lock(self, user_id):
+        with self._lock:
+            return self._user_locks.setdefault(user_id, threading.Lock())
+
+    def _remember(self, user_id, entry):
+        self._entries[user_id] = entry
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+
+    def load(self, user_id):
+        """
+        Returns a user's conversation and auth block, reading the backend only when needed.
+
+        Returns:
+            tuple: (conversation list, authentication dict). The list is a copy the
+                caller may append to without affecting other sessions.
+        """
+        storage = self._storage()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and time.monotonic() - entry.checked_at < self.check_interval:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return list(entry.conversation), dict(entry.authentication)
+
+        with self._user_lock(user_id):
+            now = time.monotonic()
+            with self._lock:
+                # another thread may have refreshed the entry while we waited
+                entry = self._entries.get(user_id)
+            if entry is not None and (now - entry.checked_at < self.check_interval
+                                      or storage.conversation_version(user_id) == entry.version):
+                with self._lock:
+                    entry.checked_at = now
+                    self.hits += 1
+                    return list(entry.conversation), dict(entry.authentication)
+
+            # read the version first: a write landing in between only causes one extra reload
+            version = storage.conversation_version(user_id)
+            conversation, authentication = storage.load_conversation(user_id)
+            with self._lock:
+                self._remember(user_id, _UserState(list(conversation), dict(authentication or {}), version, now))
+                self.misses += 1
+            logging.debug(f"Loaded {len(conversation)} messages for {user_id} from storage")
+            return list(conversation), dict(authentication or {})
+
+    def save(self, user_id, conversation, authentication):
+        """
+        Writes a user's conversation through to the backend and updates the cached copy.
+
+        Nothing is written when the conversation and auth block match what is
+        already stored. If another session or process saved messages this
+        conversation lacks, the stored messages are kept, ours are added after
+        them, and the list passed in is updated to the merged conversation.
+
+        Returns:
+            bool: Whether the backend was written.
+        """
+        storage = self._storage()
+        # the storage lock keeps the conflict reload and the merged save together across processes
+        with self._user_lock(user_id), user_lock(user_id):
+            with self._lock:
+                entry = self._entries.get(user_id)
+            if (entry is not None and len(entry.conversation) == len(conversation)
+                    and entry.conversation[-1:] == conversation[-1:]
+                    and entry.authentication == (authentication or {})
+                    and storage.conversation_version(user_id) == entry.version):
+                return False
+            try:
+                storage.save_conversation(user_id, conversation, authentication)
+            except ConflictError:
+                stored, _ = storage.load_conversation(user_id)
+                seen = {_message_key(message) for message in stored}
+                merged = list(stored) + [message for message in conversation if _message_key(message) not in seen]
+                logging.warning(f"Conversation of {user_id} was saved by another session; merged "
+                                f"{len(merged) - len(stored)} of our messages after its {len(stored)}")
+                conversation[:] = merged
+                storage.save_conversation(user_id, conversation, authentication)
+            version = storage.conversation_version(user_id)
+            with self._lock:
+                self._remember(user_id, _UserState(list(conversation), dict(authentication or {}), version,
+                                                   time.monotonic()))
+            return True
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {"users": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+_user_state_cache = None
+_user_state_cache_lock = threading.Lock()
+
+
+def get_user_state_cache():
+    """Returns the process-wide user state cache."""
+    global _user_state_cache
+    with _user_state_cache_lock:
+        if _user_state_cache is None:
+            _user_state_cache = UserStateCache()
+        return _user_state_cache
@@ -0,0 +1,198 @@
+import logging
+import os
+import threading
+import time
+
+from .metrics import increment, observe
+from .rate_limiter import (RATE_LIMIT_ENABLED, XAI_RETRY_ATTEMPTS, backoff_delay, get_rate_limiter, is_retryable,
+                           status_code)
+from .usage_ledger import MeteredStream, estimate_prompt_tokens, get_usage_ledger
+
+XAI_BASE_URL = os.getenv("XAI_BASE_URL", "https://api.x.ai/v1")
+# Connection pool shared by every call site in the process.
+XAI_POOL_MAX_CONNECTIONS = int(os.getenv("XAI_POOL_MAX_CONNECTIONS", "20"))
+XAI_POOL_MAX_KEEPALIVE = int(os.getenv("XAI_POOL_MAX_KEEPALIVE", "10"))
+XAI_KEEPALIVE_EXPIRY = float(os.getenv("XAI_KEEPALIVE_EXPIRY", "60"))
+XAI_CONNECT_TIMEOUT = float(os.getenv("XAI_CONNECT_TIMEOUT", "5"))
+XAI_DEFAULT_TIMEOUT = float(os.getenv("XAI_DEFAULT_TIMEOUT", "60"))
+# SDK-level retries, only used when RATE_LIMIT_ENABLED is off; otherwise chat_completion
+# retries through the rate limiter (XAI_RETRY_ATTEMPTS).
+XAI_MAX_RETRIES = int(os.getenv("XAI_MAX_RETRIES", "2"))
+# Ask for token usage in the last chunk of streamed replies, for the usage ledger.
+XAI_STREAM_USAGE = os.getenv("XAI_STREAM_USAGE", "true").lower() in ("1", "true", "yes")
+
+DEFAULT_MODEL = "grok-2-latest"
+
+# Completion defaults per call site; anything passed to chat_completion overrides them.
+CALL_SITE_DEFAULTS = {
+    "dialogue": {"model": DEFAULT_MODEL, "timeout": 120},
+    "summary": {"model": DEFAULT_MODEL, "timeout": 60},
+    "morph": {"model": DEFAULT_MODEL, "timeout": 60},
+    "explode": {"model": DEFAULT_MODEL, "timeout": 90},
+    "research": {"model": DEFAULT_MODEL, "timeout": 90},
+}
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def build_http_client():
+    # imported here so that importing the core package does not pay for httpx/openai
+    import httpx
+
+    limits = httpx.Limits(
+        max_connections=XAI_POOL_MAX_CONNECTIONS,
+        max_keepalive_connections=XAI_POOL_MAX_KEEPALIVE,
+        keepalive_expiry=XAI_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(XAI_DEFAULT_TIMEOUT, connect=XAI_CONNECT_TIMEOUT)
+    try:
+        from openai import DefaultHttpxClient
+    except ImportError:
+        return httpx.Client(limits=limits, timeout=timeout)
+    return DefaultHttpxClient(limits=limits, timeout=timeout)
+
+
+def get_client():
+    """
+    Returns the process-wide xAI client, creating it on first use.
+
+    Every call site shares one HTTP connection pool, so connections stay warm
+    across requests, sessions and threads instead of being set up per call.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            api_key = os.getenv("XAI_API_KEY")
+            if not api_key or not api_key.startswith('xai-'):
+                raise ValueError("Invalid API key format")
+            from openai import OpenAI
+
+            _client = OpenAI(
+                api_key=api_key,
+                base_url=XAI_BASE_URL,
+                http_client=build_http_client(),
+                max_retries=0 if RATE_LIMIT_ENABLED else XAI_MAX_RETRIES,
+            )
+            logging.info(f"Created pooled xAI client for {XAI_BASE_URL}")
+        return _client
+
+
+def resolve_call_site(call_site, overrides=None):
+    """Merges a call site's defaults with per-call overrides."""
+    params = dict(CALL_SITE_DEFAULTS.get(call_site, {"model": DEFAULT_MODEL}))
+    params.update(overrides or {})
+    params.setdefault("timeout", XAI_DEFAULT_TIMEOUT)
+    return params
+
+
+def chat_completion(call_site, messages, **overrides):
+    """
+    Creates a chat completion with the defaults of a call site.
+
+    Every call waits for the shared rate limiter and a concurrency slot, and
+    429, 5xx and connection errors are retried with jittered backoff. Calls
+    are counted in the metrics and recorded in the usage ledger; a streamed
+    reply is recorded, and its slot freed, once the caller has consumed it.
+
+    Args:
+        call_site (str): Key into CALL_SITE_DEFAULTS, e.g. "dialogue" or "morph".
+        messages (list): Chat messages.
+        **overrides: Completion parameters that replace the call site's defaults,
+            including model, timeout and stream.
+
+    Returns:
+        The API response, or a stream of chunks when stream=True.
+    """
+    params = resolve_call_site(call_site, overrides)
+    streamed = bool(params.get("stream"))
+    if streamed and XAI_STREAM_USAGE:
+        params.setdefault("stream_options", {"include_usage": True})
+    ledger = get_usage_ledger()
+    limiter = get_rate_limiter()
+    attempt = 0
+    while True:
+        slot = limiter.acquire(estimate_prompt_tokens(messages), timeout=params["timeout"]) if limiter else None
+        started = time.perf_counter()
+        try:
+            response = get_client().chat.completions.create(messages=messages, **params)
+            break
+        except Exception as e:
+            overloaded = is_retryable(e)
+            if slot:
+                slot.release(call_site, time.perf_counter() - started, ok=False, overloaded=overloaded)
+            if limiter and status_code(e) == 429:
+                limiter.throttled(call_site, e)
+            if limiter and overloaded and attempt < XAI_RETRY_ATTEMPTS:
+                delay = backoff_delay(attempt, e)
+                attempt += 1
+                reason = str(status_code(e) or "connection")
+                increment("xai_health_llm_retries_total", call_site=call_site, reason=reason)
+                logging.warning(f"xAI {call_site} request failed ({str(e)}), retry {attempt} in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            increment("xai_health_llm_requests_total", call_site=call_site, outcome="error")
+            if ledger:
+                ledger.record(call_site, params["model"], time.perf_counter() - started, messages=messages,
+                              streamed=streamed, ok=False)
+            raise
+    response_latency = time.perf_counter() - started
+
+    def finished(latency, ok):
+        observe("xai_health_llm_request_seconds", latency, call_site=call_site)
+        increment("xai_health_llm_requests_total", call_site=call_site, outcome="ok" if ok else "error")
+        if slot:
+            # congestion shows in the time to response headers, not in how long the reply is
+            slot.release(call_site, response_latency, ok=ok)
+
+    if streamed:
+        if ledger is None and slot is None:
+            return response
+        return MeteredStream(response, ledger, call_site, params["model"], messages, started, on_finish=finished)
+
+    finished(response_latency, True)
+    if ledger:
+        content = response.choices[0].message.content if response.choices else None
+        ledger.record(call_site, params["model"], response_latency, usage=getattr(response, "usage", None),
+                      messages=messages, completion_text=content)
+    return response
+
+
+def stream_chat_completion(call_site, messages, on_text=None, on_fallback=None, **overrides):
+    """
+    Streams a completion, handing the text received so far to on_text.
+
+    If the stream fails or ends without a finish reason, the partial text is
+    discarded, on_fallback is called and the reply is fetched again without
+    streaming, so callers always get a complete message.
+
+    Returns:
+        tuple: (reply text, seconds to first token or None after a fallback).
+    """
+    started = time.perf_counter()
+    first_token_at = None
+    finish_reason = None
+    chunks = []
+    try:
+        for chunk in chat_completion(call_site, messages, stream=True, **overrides):
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if choice.delta and choice.delta.content:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                chunks.append(choice.delta.content)
+                if on_text:
+                    on_text("".join(chunks))
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+        if finish_reason is None:
+            raise ConnectionError("stream closed before the reply finished")
+    except Exception as e:
+        logging.warning(f"xAI {call_site} stream broke after {len(chunks)} chunks ({str(e)}), "
+                        f"retrying without streaming")
+        if on_fallback:
+            on_fallback()
+        response = chat_completion(call_site, messages, **overrides)
+        return response.choices[0].message.content, None
+    return "".join(chunks), first_token_at - started if first_token_at is not None else None
@@ -0,0 +1,82 @@
+import pytest
+
+from health_coach import context_builder
+from health_coach.context_builder import (CONTEXT_SUMMARY_BATCH, ConversationSummaries, backfill_summaries,
+                                          build_context, estimate_message_tokens, summary_backlog)
+
+
+def conversation_of(count, words=80):
+    return [{"role": "user" if number % 2 == 0 else "assistant",
+             "content": f"message {number} " + "walked stretched slept " * (words // 3),
+             "timestamp": f"2026-01-01 00:{number // 60:02d}:{number % 60:02d}"} for number in range(count)]
+
+
+class FakeSummarizer:
+    def __init__(self, fail=False):
+        self.calls = []
+        self.fail = fail
+
+    def __call__(self, messages):
+        if self.fail:
+            raise RuntimeError("summarizer down")
+        self.calls.append(messages)
+        return f"{len(messages)} messages from {messages[0]['content'].split()[1]}"
+
+
+@pytest.fixture(autouse=True)
+def no_recall(monkeypatch):
+    monkeypatch.setattr(context_builder, "CONTEXT_RECALL_TOP_K", 0)
+
+
+def test_recent_turns_are_sent_verbatim(tmp_path):
+    conversation = conversation_of(30)
+    messages = build_context("system", conversation, tmp_path, FakeSummarizer(), token_budget=100000,
+                             verbatim_turns=8)
+    assert messages[0] == {"role": "system", "content": "system"}
+    assert messages[-8:] == [{"role": m["role"], "content": m["content"]} for m in conversation[-8:]]
+
+
+def test_context_stays_within_the_token_budget(tmp_path):
+    conversation = conversation_of(60)
+    for budget in (600, 1500, 4000):
+        messages = build_context("system", conversation, tmp_path / str(budget), FakeSummarizer(),
+                                 token_budget=budget, verbatim_turns=8)
+        assert sum(estimate_message_tokens(m) for m in messages) <= budget
+        assert messages[-1]["content"] == conversation[-1]["content"]
+
+
+def test_a_request_summarizes_at_most_max_batches(tmp_path):
+    conversation = conversation_of(8 + 5 * CONTEXT_SUMMARY_BATCH)
+    summarizer = FakeSummarizer()
+    build_context("system", conversation, tmp_path, summarizer, token_budget=100000, verbatim_turns=8)
+    assert len(summarizer.calls) == context_builder.CONTEXT_SUMMARY_MAX_BATCHES
+    assert summary_backlog(conversation, tmp_path, verbatim_turns=8) == 5 - context_builder.CONTEXT_SUMMARY_MAX_BATCHES
+
+
+def test_backfill_works_through_the_backlog_in_order(tmp_path):
+    conversation = conversation_of(8 + 5 * CONTEXT_SUMMARY_BATCH)
+    summarizer = FakeSummarizer()
+    remaining = [backfill_summaries(conversation, tmp_path, summarizer, max_batches=2, token_budget=100000,
+                                    verbatim_turns=8) for _ in range(3)]
+    assert remaining == [3, 1, 0]
+    segments = ConversationSummaries(tmp_path).segments
+    assert [(s["start"], s["end"]) for s in segments] == [
+        (n * CONTEXT_SUMMARY_BATCH, (n + 1) * CONTEXT_SUMMARY_BATCH) for n in range(5)]
+    assert summary_backlog(conversation, tmp_path, verbatim_turns=8) == 0
+
+
+def test_summaries_are_merged_to_fit_their_share(tmp_path):
+    conversation = conversation_of(8 + 4 * CONTEXT_SUMMARY_BATCH)
+    summaries = ConversationSummaries(tmp_path)
+    summaries.update(conversation, 4 * CONTEXT_SUMMARY_BATCH, lambda messages: "x" * 400, summary_budget=250,
+                     max_batches=4)
+    assert len(summaries.segments) == 2
+    assert summaries.segments[0]["start"] == 0 and summaries.segments[-1]["end"] == 4 * CONTEXT_SUMMARY_BATCH
+
+
+def test_a_failing_summarizer_still_builds_a_context(tmp_path):
+    conversation = conversation_of(30)
+    messages = build_context("system", conversation, tmp_path, FakeSummarizer(fail=True), token_budget=100000,
+                             verbatim_turns=8)
+    assert messages[1:] == [{"role": m["role"], "content": m["content"]} for m in conversation]
+    assert summary_backlog(conversation, tmp_path, verbatim_turns=8) == 22 // CONTEXT_SUMMARY_BATCH
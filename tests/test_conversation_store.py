@@ -0,0 +1,52 @@
+import json
+
+import pytest
+
+from health_coach import conversation_store, locking, storage as storage_module
+from health_coach.conversation_store import ConversationLog, compact_all
+from health_coach.storage import FileStorage
+
+
+def message(number, role="user"):
+    return {"role": role, "content": f"message {number}", "timestamp": f"2026-01-01 00:00:{number:02d}"}
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    monkeypatch.setattr(locking, "USER_LOCK_DIR", str(tmp_path / "locks"))
+    return FileStorage(users_dir=tmp_path / "users", data_dir=tmp_path)
+
+
+def set_mode(monkeypatch, mode):
+    monkeypatch.setattr(storage_module, "SESSION_STORAGE_MODE", mode)
+    monkeypatch.setattr(conversation_store, "SESSION_STORAGE_MODE", mode)
+
+
+def test_rollback_to_json_mode_keeps_the_history(storage, tmp_path, monkeypatch):
+    legacy_path = storage.user_dir("alice") / "session_state.json"
+    legacy_path.write_text(json.dumps({"conversation": [message(1), message(2, "assistant")], "authentication": {}}))
+
+    set_mode(monkeypatch, "jsonl")
+    storage.save_conversation("alice", storage.load_conversation("alice")[0] + [message(3)], {})
+    assert compact_all(tmp_path / "users")["alice"] == {"kept": 3, "dropped": 0}
+    storage.compact_conversation("alice")
+    assert legacy_path.exists()
+
+    set_mode(monkeypatch, "json")
+    conversation, _ = storage.load_conversation("alice")
+    assert conversation == [message(1), message(2, "assistant"), message(3)]
+    storage.save_conversation("alice", conversation + [message(4, "assistant")], {})
+    assert compact_all(tmp_path / "users")["alice"] == {"kept": 3, "dropped": 0}
+    assert storage.load_conversation("alice")[0] == [message(1), message(2, "assistant"), message(3),
+                                                     message(4, "assistant")]
+
+
+def test_compact_drops_torn_lines(tmp_path, monkeypatch):
+    monkeypatch.setattr(locking, "USER_LOCK_DIR", str(tmp_path / "locks"))
+    log = ConversationLog(tmp_path / "alice")
+    log.user_dir.mkdir()
+    log.sync([message(1), message(2, "assistant")], authentication={})
+    with open(log.log_path, "a", encoding="utf-8") as f:
+        f.write('{"role": "user", "cont')
+    assert log.compact() == {"kept": 2, "dropped": 1}
+    assert log.load()[0] == [message(1), message(2, "assistant")]
@@ -0,0 +1,49 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from health_coach.health_metrics import extract_metrics
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Slept 6 hours, drank 32 oz diet soda and walked 11 minutes.",
+     {"sleep_hours": 6.0, "walk_minutes": 11.0, "diet_soda_oz": 32.0, "beverage_oz": 32.0}),
+    ("Got about 7.5 hours of sleep", {"sleep_hours": 7.5}),
+    ("walked the dog for 30 minutes", {"walk_minutes": 30.0}),
+    ("walked for about 2 hours", {"walk_minutes": 120.0}),
+    ("a 45-minute walk after dinner", {"walk_minutes": 45.0}),
+    ("ran for 20 minutes", {"exercise_minutes": 20.0}),
+    ("swam laps for 40 mins", {"exercise_minutes": 40.0}),
+    ("12,000 steps today", {"steps": 12000.0}),
+    ("weighed in at 82 kg", {"weight_kg": 82.0}),
+    ("weighed 180 lbs", {"weight_kg": 81.647}),
+    ("stress level is 7/10", {"stress_score": 7.0}),
+    ("one diet coke", {"diet_soda_oz": 12.0, "beverage_oz": 12.0}),
+    ("two coffees", {"coffee_oz": 16.0, "beverage_oz": 16.0}),
+    ("had 2 cans of coke", {"soda_oz": 24.0, "beverage_oz": 24.0}),
+    ("half a liter of water", {"water_oz": 16.91, "beverage_oz": 16.91}),
+])
+def test_extracts(text, expected):
+    assert dict(extract_metrics(text)) == expected
+
+
+@pytest.mark.parametrize("text", [
+    "ran 5 minutes late for work",
+    "walked in 10 minutes early",
+    "I took a tea break",
+    "a lot of coffee this week",
+    "the meeting took two hours",
+    "",
+    None,
+])
+def test_ignores(text):
+    assert extract_metrics(text) == []
+
+
+def test_cli_requires_a_user_or_text():
+    result = subprocess.run([sys.executable, "-m", "health_coach.health_metrics"], capture_output=True, text=True,
+                            cwd=Path(__file__).resolve().parents[1])
+    assert result.returncode == 2
+    assert "give a user_id or --text" in result.stderr
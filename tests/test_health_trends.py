@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from health_coach.health_trends import compute_trends, format_trend, trend_lines
+
+TODAY = 20000  # 2024-10-04
+
+
+def sleep_series():
+    # 23 days of 6 hours, then a week of 8
+    return np.array([6.0] * 23 + [8.0] * 7)
+
+
+def test_window_means_and_week_delta():
+    trends = compute_trends(sleep_series(), goal=7)
+    assert trends["mean_7d"][0] == 8.0
+    assert trends["mean_30d"][0] == pytest.approx((23 * 6 + 7 * 8) / 30)
+    assert trends["week_delta"][0] == 2.0
+    assert (trends["days_7d"][0], trends["days_30d"][0]) == (7, 30)
+    assert trends["streak"][0] == 7
+    assert trends["outlier_offset"][0] == -1
+
+
+def test_missing_days_are_left_out_of_the_means():
+    series = sleep_series()
+    series[-3:-1] = np.nan
+    trends = compute_trends(series, goal=7)
+    assert trends["mean_7d"][0] == 8.0
+    assert trends["days_7d"][0] == 5
+    # the gap breaks the streak
+    assert trends["streak"][0] == 1
+
+
+def test_a_streak_survives_today_not_being_logged_yet():
+    series = sleep_series()
+    series[-1] = np.nan
+    assert compute_trends(series, goal=7)["streak"][0] == 6
+
+
+def test_latest_outlier():
+    series = np.array([7.0, 7.5] * 15)
+    series[-4] = 14.0
+    trends = compute_trends(series)
+    assert trends["outlier_offset"][0] == 3
+    assert trends["outlier_value"][0] == 14.0
+
+
+def test_rows_are_independent():
+    matrix = np.vstack([sleep_series(), np.full(30, np.nan), np.full(30, 5.0)])
+    trends = compute_trends(matrix, goal=7)
+    assert trends["days_30d"].tolist() == [30, 0, 30]
+    assert trends["streak"].tolist() == [7, 0, 0]
+    assert trends["week_delta"][2] == 0.0
+
+
+def test_format_trend():
+    trends = compute_trends(sleep_series(), goal=7)
+    assert format_trend("sleep_hours", trends, 0, TODAY) == (
+        "sleep: 7-day avg 8.0 h (7/7 days logged), +2.0 vs prior week; 30-day avg 6.5 h; "
+        "7-day streak at or above 7.0 h")
+
+
+def test_format_trend_names_the_outlier_day():
+    series = np.array([7000.0, 7500.0] * 15)
+    series[-4] = 30000.0
+    line = format_trend("steps", compute_trends(series, goal=7000), 0, TODAY)
+    assert line.endswith("unusual 30,000 steps on 2024-10-01")
+
+
+def test_trend_lines_prefer_regularly_logged_metrics():
+    sparse = np.full(30, np.nan)
+    sparse[-1] = 2000.0
+    metric_trends = {"steps": compute_trends(sparse), "sleep_hours": compute_trends(sleep_series(), goal=7),
+                     "water_oz": compute_trends(np.full(30, np.nan))}
+    lines = trend_lines(metric_trends, 0, TODAY, max_lines=5)
+    assert [line.split(":")[0] for line in lines] == ["sleep", "steps"]
+    assert trend_lines(metric_trends, 0, TODAY, max_lines=1) == lines[:1]
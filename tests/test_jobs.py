@@ -0,0 +1,62 @@
+import pytest
+
+from health_coach import context_builder, jobs, locking, maintenance, user_state, xai_client
+from health_coach.jobs import JobQueue
+from health_coach.storage import FileStorage
+from health_coach.user_state import UserStateCache
+
+
+def message(number, role="user"):
+    return {"role": role, "content": f"message {number}", "timestamp": f"2026-01-01 00:00:{number:02d}"}
+
+
+class FakeJob:
+    def __init__(self, user_id, payload):
+        self.queue = None
+        self.user_id = user_id
+        self.payload = payload
+
+    def progress(self, partial_text, force=False):
+        pass
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    monkeypatch.setattr(locking, "USER_LOCK_DIR", str(tmp_path / "locks"))
+    monkeypatch.setattr(jobs, "USERS_DIR", tmp_path / "users")
+    return FileStorage(users_dir=tmp_path / "users", data_dir=tmp_path)
+
+
+def test_health_update_answers_an_update_saved_by_another_process(storage, monkeypatch):
+    worker_cache = UserStateCache(storage, check_interval=3600)
+    monkeypatch.setattr(user_state, "_user_state_cache", worker_cache)
+    storage.save_conversation("alice", [message(1), message(2, "assistant")], {})
+    worker_cache.load("alice")
+    # the page runs in another process, with its own cache
+    UserStateCache(storage, check_interval=0).save("alice", [message(1), message(2, "assistant"), message(3)], {})
+
+    contexts = []
+    monkeypatch.setattr(context_builder, "build_context",
+                        lambda system, conversation, *args: contexts.append(list(conversation)) or [])
+    monkeypatch.setattr(context_builder, "make_llm_summarizer", lambda: None)
+    monkeypatch.setattr(xai_client, "stream_chat_completion", lambda *args, **kwargs: ("reply", None))
+    monkeypatch.setattr(maintenance, "record_activity", lambda user_id: None)
+    monkeypatch.setattr(jobs, "schedule_summary_backfill", lambda *args: None)
+
+    result = jobs.run_health_update(FakeJob("alice", {"system_message": "system"}))
+
+    assert result["reply"] == "reply"
+    assert contexts[0][-1] == message(3)
+    conversation, _ = storage.load_conversation("alice")
+    assert [m["content"] for m in conversation] == ["message 1", "message 2", "message 3", "reply"]
+
+
+def test_summaries_jobs_wait_for_health_updates(tmp_path):
+    queue = JobQueue(tmp_path / "jobs.sqlite3", handlers={kind: None for kind in jobs.HANDLERS})
+    queue.submit("summaries", {}, user_id="alice")
+    update = queue.submit("health_update", {}, user_id="alice")
+    research = queue.submit("research", {}, user_id="bob")
+    assert queue.claim()["id"] == update
+    assert queue.claim()["id"] == research
+    # alice's summaries stay queued while her update runs
+    assert queue.claim() is None
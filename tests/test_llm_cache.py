@@ -0,0 +1,86 @@
+from types import SimpleNamespace
+
+import pytest
+
+from health_coach import llm_cache
+from health_coach.llm_cache import LLMCache, cached_chat_completion, make_cache_key
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(llm_cache, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def cache(tmp_path, clock):
+    return LLMCache(tmp_path / "llm_cache.sqlite3", ttls={"morph": 100, "research": 10})
+
+
+def test_entries_expire_after_their_call_site_ttl(cache, clock):
+    cache.put("key", "morph", "text")
+    clock.now += 100
+    assert cache.get("key", "morph") == "text"
+    # the same entry read by a call site with a shorter TTL is already stale, and dropped
+    assert cache.get("key", "research") is None
+    assert cache.get("key", "morph") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock):
+    cache = LLMCache(tmp_path / "llm_cache.sqlite3", max_bytes=25)
+    for key in ("a", "b"):
+        cache.put(key, "morph", "x" * 10)
+        clock.now += 1
+    assert cache.get("a", "morph") is not None
+    clock.now += 1
+    cache.put("c", "morph", "x" * 10)
+    assert cache.get("b", "morph") is None
+    assert cache.get("a", "morph") is not None and cache.get("c", "morph") is not None
+    assert cache.stats()["bytes"] == 20
+
+
+def test_lookups_are_counted_across_instances(cache, tmp_path):
+    cache.put("key", "morph", "text")
+    cache.get("key", "morph")
+    cache.get("other", "morph")
+    other = LLMCache(tmp_path / "llm_cache.sqlite3")
+    other.get("key", "morph")
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == ({"morph": 2}, {"morph": 1})
+    other.clear()
+    assert cache.stats() == {"entries": 0, "bytes": 0, "hits": {}, "misses": {}}
+
+
+def test_cache_key_covers_model_messages_and_params():
+    messages = [{"role": "user", "content": "hi"}]
+    key = make_cache_key("grok", messages, {"temperature": 0.2})
+    assert key == make_cache_key("grok", list(messages), {"temperature": 0.2})
+    assert key != make_cache_key("grok", messages, {"temperature": 0.3})
+    assert key != make_cache_key("other", messages, {"temperature": 0.2})
+
+
+def test_cached_chat_completion_only_caches_call_sites_with_a_ttl(cache, monkeypatch):
+    calls = []
+
+    def chat_completion(call_site, messages, **overrides):
+        calls.append(call_site)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=f"reply {len(calls)}"))])
+
+    monkeypatch.setattr(llm_cache, "chat_completion", chat_completion)
+    monkeypatch.setattr(llm_cache, "_cache", cache)
+    messages = [{"role": "user", "content": "hi"}]
+    assert cached_chat_completion("morph", messages) == "reply 1"
+    assert cached_chat_completion("morph", messages) == "reply 1"
+    assert cached_chat_completion("morph", messages, temperature=0.9) == "reply 2"
+    assert cached_chat_completion("dialogue", messages) == "reply 3"
+    assert cached_chat_completion("dialogue", messages) == "reply 4"
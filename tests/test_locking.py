@@ -0,0 +1,120 @@
+import multiprocessing
+
+import pytest
+
+from health_coach import locking
+from health_coach.locking import ConflictError
+from health_coach.maintenance import ActivityIndex
+from health_coach.storage import FileStorage, SQLiteStorage
+from health_coach.user_state import UserStateCache
+
+
+def message(number, role="user"):
+    return {"role": role, "content": f"message {number}", "timestamp": f"2026-01-01 00:00:{number:02d}"}
+
+
+@pytest.fixture(autouse=True)
+def lock_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(locking, "USER_LOCK_DIR", str(tmp_path / "locks"))
+
+
+@pytest.fixture(params=["files", "sqlite"])
+def storage(request, tmp_path):
+    if request.param == "files":
+        return FileStorage(users_dir=tmp_path / "users", data_dir=tmp_path)
+    return SQLiteStorage(tmp_path / "health.sqlite3")
+
+
+def test_save_extending_the_stored_conversation(storage):
+    storage.save_conversation("alice", [message(1), message(2)], {})
+    storage.save_conversation("alice", [message(1), message(2), message(3)], {})
+    assert storage.load_conversation("alice")[0] == [message(1), message(2), message(3)]
+
+
+def test_save_from_a_stale_conversation_conflicts(storage):
+    storage.save_conversation("alice", [message(1), message(2)], {})
+    with pytest.raises(ConflictError):
+        storage.save_conversation("alice", [message(1), message(3), message(4)], {})
+    with pytest.raises(ConflictError):
+        storage.save_conversation("alice", [message(1)], {})
+    assert storage.load_conversation("alice")[0] == [message(1), message(2)]
+
+
+def test_profile_version_check(storage):
+    storage.save_profile("alice", {"profile_text": "v1"})
+    version = storage.profile_version("alice")
+    storage.save_profile("alice", {"profile_text": "v2"}, expected_version=version)
+    with pytest.raises(ConflictError):
+        storage.save_profile("alice", {"profile_text": "v3"}, expected_version=version)
+    assert storage.load_profile("alice") == {"profile_text": "v2"}
+    storage.save_profile("alice", {"profile_text": "v4"})
+    assert storage.load_profile("alice") == {"profile_text": "v4"}
+
+
+def test_coach_attributes_version_check(storage):
+    storage.save_coach_attributes("alice", ["no-bs"])
+    version = storage.coach_attributes_version("alice")
+    storage.save_coach_attributes("alice", ["hard-core"], expected_version=version)
+    with pytest.raises(ConflictError):
+        storage.save_coach_attributes("alice", ["loves-citations"], expected_version=version)
+    assert storage.coach_attributes_version("alice") != version
+
+
+def test_user_state_cache_merges_a_conflicting_save(storage):
+    first, second = UserStateCache(storage, check_interval=0), UserStateCache(storage, check_interval=0)
+    first.save("alice", [message(1)], {})
+    ours, theirs = [message(1), message(2)], [message(1), message(3, "assistant")]
+    assert first.save("alice", ours, {})
+    assert second.save("alice", theirs, {})
+    assert theirs == [message(1), message(2), message(3, "assistant")]
+    assert storage.load_conversation("alice")[0] == theirs
+
+
+def _save_in_turns(users_dir, data_dir, lock_dir, worker, rounds):
+    locking.USER_LOCK_DIR = lock_dir
+    storage = FileStorage(users_dir=users_dir, data_dir=data_dir)
+    saved = 0
+    for number in range(rounds):
+        conversation, _ = storage.load_conversation("alice")
+        try:
+            storage.save_conversation("alice", conversation + [message(worker * rounds + number)], {})
+            saved += 1
+        except ConflictError:
+            pass
+    return saved
+
+
+def test_concurrent_processes_never_lose_or_duplicate_messages(tmp_path):
+    context = multiprocessing.get_context("fork")
+    args = [(tmp_path / "users", tmp_path, str(tmp_path / "locks"), worker, 15) for worker in range(4)]
+    with context.Pool(4) as pool:
+        saved = sum(pool.starmap(_save_in_turns, args))
+    conversation, _ = FileStorage(users_dir=tmp_path / "users", data_dir=tmp_path).load_conversation("alice")
+    assert len(conversation) == saved
+    assert len({m["content"] for m in conversation}) == saved
+
+
+def _touch_users(path, users_dir, users):
+    index = ActivityIndex(path, users_dir)
+    for user_id in users:
+        index.touch(user_id)
+
+
+def test_activity_index_keeps_touches_from_every_process(tmp_path):
+    path, users_dir = tmp_path / "activity_index.json", tmp_path / "users"
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=_touch_users, args=(path, users_dir, [f"user{p}-{n}" for n in range(20)]))
+                 for p in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert len(ActivityIndex(path, users_dir).entries()) == 80
+
+
+def test_activity_index_remove_keeps_recently_active_users(tmp_path):
+    index = ActivityIndex(tmp_path / "activity_index.json", tmp_path / "users")
+    index.touch("idle", when=10000.0)
+    index.touch("active", when=50000.0)
+    assert index.remove(["idle", "active"], unless_active_since=20000.0) == ["idle"]
+    assert set(index.entries()) == {"active"}
@@ -0,0 +1,141 @@
+import time
+
+import pytest
+
+from health_coach.rate_limiter import AdaptiveConcurrency, TokenBucket, backoff_delay, is_retryable
+
+
+@pytest.fixture
+def bucket(tmp_path):
+    # one request per second, ten seconds of burst
+    return TokenBucket(tmp_path / "rate_limit.sqlite3", requests_per_minute=60, tokens_per_minute=0, burst_seconds=10)
+
+
+def test_bucket_allows_a_burst_then_waits_for_refill(bucket):
+    now = 1000.0
+    assert [bucket._try_take({"requests": 1}, now) for _ in range(10)] == [0] * 10
+    assert bucket._try_take({"requests": 1}, now) == pytest.approx(1.0)
+    assert bucket._try_take({"requests": 1}, now + 2.5) == 0
+    assert bucket._try_take({"requests": 1}, now + 2.5) == 0
+    assert bucket._try_take({"requests": 1}, now + 2.5) == pytest.approx(0.5)
+
+
+def test_bucket_refills_no_further_than_its_capacity(bucket):
+    bucket._try_take({"requests": 1}, 1000.0)
+    results = [bucket._try_take({"requests": 1}, 5000.0) for _ in range(11)]
+    assert results[:10] == [0] * 10 and results[10] > 0
+
+
+def test_buckets_are_shared_through_the_file(bucket, tmp_path):
+    other = TokenBucket(tmp_path / "rate_limit.sqlite3", requests_per_minute=60, tokens_per_minute=0,
+                        burst_seconds=10)
+    for _ in range(10):
+        bucket._try_take({"requests": 1}, 1000.0)
+    assert other._try_take({"requests": 1}, 1000.0) > 0
+
+
+def test_token_bucket_charges_all_or_nothing(tmp_path):
+    bucket = TokenBucket(tmp_path / "rate_limit.sqlite3", requests_per_minute=60, tokens_per_minute=600,
+                         burst_seconds=10)
+    assert bucket._try_take({"requests": 1, "tokens": 80}, 1000.0) == 0
+    # 20 tokens left: the request waits two seconds and takes nothing meanwhile
+    assert bucket._try_take({"requests": 1, "tokens": 40}, 1000.0) == pytest.approx(2.0)
+    assert bucket._try_take({"requests": 1, "tokens": 40}, 1002.0) == 0
+    # larger than the bucket: waits for a full one instead of forever
+    assert bucket._try_take({"requests": 1, "tokens": 1000}, 1002.0) == pytest.approx(10.0)
+
+
+def test_pause_stops_every_request(bucket):
+    bucket.pause(30)
+    assert bucket._try_take({"requests": 1}, time.time()) > 25
+    with pytest.raises(TimeoutError):
+        bucket.acquire(timeout=0.1)
+
+
+def saturate_and_release(concurrency, latency=0.1):
+    slots = int(concurrency.limit)
+    for _ in range(slots):
+        concurrency.acquire()
+    for _ in range(slots):
+        concurrency.release("dialogue", latency=latency)
+
+
+def test_concurrency_grows_only_while_saturated():
+    concurrency = AdaptiveConcurrency(minimum=1, maximum=8, initial=4, tolerance=2.0)
+    concurrency._saturated_at = time.monotonic() - 60
+    concurrency.acquire()
+    concurrency.release("dialogue", latency=0.1)
+    assert concurrency.limit == 4
+    saturate_and_release(concurrency)
+    assert int(concurrency.limit) == 4 and concurrency.limit > 4
+    for _ in range(5):
+        saturate_and_release(concurrency)
+    assert int(concurrency.limit) >= 5
+
+
+def test_concurrency_halves_once_per_overload():
+    concurrency = AdaptiveConcurrency(minimum=1, maximum=16, initial=8)
+    for _ in range(3):
+        concurrency.acquire()
+    for _ in range(3):
+        concurrency.release("dialogue", ok=False, overloaded=True)
+    assert concurrency.limit == 4
+    concurrency._last_decrease -= 2
+    concurrency.acquire()
+    concurrency.release("dialogue", ok=False, overloaded=True)
+    assert concurrency.limit == 2
+    concurrency._last_decrease -= 2
+    concurrency.acquire()
+    concurrency.release("dialogue", ok=False, overloaded=True)
+    concurrency._last_decrease -= 2
+    concurrency.acquire()
+    concurrency.release("dialogue", ok=False, overloaded=True)
+    assert concurrency.limit == 1
+
+
+def test_slow_responses_shrink_the_limit():
+    concurrency = AdaptiveConcurrency(minimum=1, maximum=16, initial=10, tolerance=2.0)
+    concurrency.acquire()
+    concurrency.release("dialogue", latency=0.5)
+    concurrency.acquire()
+    concurrency.release("dialogue", latency=1.5)
+    assert concurrency.limit == pytest.approx(9.0)
+    # the baseline keeps the fast response, drifting up by 1%
+    assert concurrency.baselines["dialogue"] == pytest.approx(0.505)
+
+
+def test_acquire_times_out_when_every_slot_is_taken():
+    concurrency = AdaptiveConcurrency(minimum=1, maximum=1, initial=1)
+    concurrency.acquire()
+    with pytest.raises(TimeoutError):
+        concurrency.acquire(timeout=0.05)
+    concurrency.release("dialogue", ok=False)
+    concurrency.acquire(timeout=0.05)
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakeError(Exception):
+    def __init__(self, status_code=None, headers=None):
+        super().__init__("fake")
+        self.response = FakeResponse(status_code, headers) if status_code else None
+
+
+@pytest.mark.parametrize("error, retryable", [
+    (FakeError(429), True),
+    (FakeError(503), True),
+    (FakeError(400), False),
+    (TimeoutError(), True),
+    (ValueError(), False),
+])
+def test_is_retryable(error, retryable):
+    assert is_retryable(error) == retryable
+
+
+def test_backoff_respects_retry_after():
+    assert backoff_delay(0, FakeError(429, {"retry-after": "7"})) >= 7
+    assert all(0 <= backoff_delay(attempt) <= 30 for attempt in range(10))
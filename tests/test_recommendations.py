@@ -0,0 +1,51 @@
+import pytest
+
+from health_coach.recommendations import RecommendationLedger, classify_topic, parse_recommendations
+
+
+@pytest.mark.parametrize("reply, expected", [
+    ("Nice work on the walks.\n\n**Recommendations for Tomorrow:**\n"
+     "- Aim for **7 hours of sleep**.\n- Swap the second diet soda for water.\n\nKeep it up!",
+     ["Aim for 7 hours of sleep.", "Swap the second diet soda for water."]),
+    ("### Overall Recommendations\n1. Walk 30 minutes after lunch.\n2) Stretch before bed.\n",
+     ["Walk 30 minutes after lunch.", "Stretch before bed."]),
+    ("Recommendations:\n* Book a check-up with your doctor.\nThat is all for today.\n- Not a recommendation.",
+     ["Book a check-up with your doctor."]),
+    ("Recommendation: Drink a glass of water with every coffee.",
+     ["Drink a glass of water with every coffee."]),
+    ("- **Recommendation:** Try a 10-minute breathing exercise tonight.\nGood night!",
+     ["Try a 10-minute breathing exercise tonight."]),
+    ("Recommendation: Eat protein at breakfast.\n\nRecommendations:\n- Walk after dinner.",
+     ["Eat protein at breakfast.", "Walk after dinner."]),
+])
+def test_parse_recommendations(reply, expected):
+    assert parse_recommendations(reply) == expected
+
+
+@pytest.mark.parametrize("reply", [
+    "Great job today! Keep walking.",
+    "- You walked 30 minutes.\n- You slept 7 hours.",
+    "",
+    None,
+])
+def test_replies_without_recommendations(reply):
+    assert parse_recommendations(reply) == []
+
+
+@pytest.mark.parametrize("text, topic", [
+    ("Aim for 7 hours of sleep and a fixed bed time.", "sleep"),
+    ("Swap the second diet soda for water.", "hydration"),
+    ("Book a check-up with your doctor.", "medical"),
+    ("Call a friend this weekend.", "general"),
+])
+def test_classify_topic(text, topic):
+    assert classify_topic(text) == topic
+
+
+def test_ledger_does_not_repeat_open_recommendations(tmp_path):
+    ledger = RecommendationLedger(tmp_path)
+    first = ledger.capture("Recommendation: Walk after dinner.", "2026-01-01 10:00:00", 1)
+    assert ledger.capture("Recommendation: walk after dinner.", "2026-01-02 10:00:00", 3) == []
+    ledger.set_status(first[0]["id"], "done")
+    assert len(ledger.capture("Recommendation: Walk after dinner.", "2026-01-03 10:00:00", 5)) == 1
+    assert [record["status"] for record in RecommendationLedger(tmp_path).query()] == ["open", "done"]
@@ -0,0 +1,42 @@
+import threading
+
+from health_coach import topics
+from health_coach.topics import GiveMeTheLatest
+from health_coach.usage_ledger import current_user, set_current_user
+
+
+def record_caller(monkeypatch):
+    calls = []
+
+    def cached_chat_completion(call_site, messages):
+        calls.append((current_user.get(), threading.current_thread().name))
+        return f"better {messages[1]['content']}"
+
+    monkeypatch.setattr(topics, "cached_chat_completion", cached_chat_completion)
+    return calls
+
+
+def run_as(user_id, function):
+    # a fresh thread starts with an empty context, like a Streamlit script run
+    result = []
+    thread = threading.Thread(target=lambda: (set_current_user(user_id), result.append(function())))
+    thread.start()
+    thread.join()
+    return result[0]
+
+
+def test_morphed_prompts_are_charged_to_the_calling_user(monkeypatch):
+    calls = record_caller(monkeypatch)
+    morpher = GiveMeTheLatest(max_concurrency=3)
+    results = run_as("alice", lambda: morpher.morph_prompt_list(["sleep", "", "walking", "water"], create_link=False))
+    assert results == ["better sleep", "better walking", "better water"]
+    assert {user for user, _ in calls} == {"alice"}
+    assert all(name.startswith("morph") for _, name in calls)
+
+
+def test_exploded_topics_are_charged_to_the_calling_user(monkeypatch, tmp_path):
+    calls = record_caller(monkeypatch)
+    morpher = GiveMeTheLatest(max_concurrency=2)
+    summary = run_as("bob", lambda: morpher.explode_topic_catalog(["sleep", "stress"], str(tmp_path / "out.jsonl")))
+    assert summary == {"skipped": 0, "completed": 2, "failed": 0}
+    assert [user for user, _ in calls] == ["bob", "bob"]
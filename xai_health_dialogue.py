@@ -7,12 +7,27 @@ from pathlib import Path
 
 import streamlit as st
 import os
-from dotenv import load_dotenv
 import json
 from datetime import datetime
-from openai import OpenAI
-import stripe
-import tweepy
+
+# importing the core package loads .env before any module reads its settings
+from health_coach.config import XAI_HEALTH_DIR
+from health_coach.context_builder import build_context, make_llm_summarizer
+from health_coach.entitlements import get_entitlement_store
+from health_coach.health_metrics import get_health_metric_store
+from health_coach.health_trends import get_trend_lines
+from health_coach.jobs import get_job_queue
+from health_coach.llm_cache import cached_chat_completion
+from health_coach.locking import ConflictError
+from health_coach.maintenance import record_activity, start_maintenance_scheduler
+from health_coach.metrics import observe, span, start_metrics_exporter, timed
+from health_coach.persona_registry import get_persona_registry
+from health_coach.recommendations import get_recommendation_ledger
+from health_coach.storage import get_storage
+from health_coach.token_validation import get_token_validation_cache
+from health_coach.usage_ledger import set_current_user
+from health_coach.user_state import get_user_state_cache
+from health_coach.xai_client import chat_completion, get_client, stream_chat_completion
 
 
 logging.basicConfig(level=logging.DEBUG)
@@ -33,26 +48,15 @@ def setup_logging():
 
 logger = setup_logging()
 
-# Load the .env file
-load_dotenv()
-
-XAI_HEALTH_DIR = os.getenv("XAI_HEALTH_DIR")
-print(XAI_HEALTH_DIR)
-st.title("xAI-powered Health Coach")
-
 ENVIRONMENT = os.getenv("ENVIRONMENT", "dev")
 
-XAI_API_KEY = os.getenv("XAI_API_KEY", "your_api_key_here")
-BASE_URL = "https://api.x.ai/v1"
-
-if not XAI_API_KEY or not XAI_API_KEY.startswith('xai-'):
-    raise ValueError("Invalid API key format")
-
-
-client = OpenAI(
-    api_key=XAI_API_KEY,
-    base_url="https://api.x.ai/v1",
-)
+# Render coach replies token by token; set STREAM_RESPONSES=false to wait for the full reply.
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "true").lower() in ("1", "true", "yes")
+# Run health updates and research on the job queue's worker pool; set USE_JOB_QUEUE=false
+# to call xAI from the script thread as before.
+USE_JOB_QUEUE = os.getenv("USE_JOB_QUEUE", "true").lower() in ("1", "true", "yes")
+# Seconds between job polls while a page waits for a result.
+JOB_PAGE_POLL_INTERVAL = float(os.getenv("JOB_PAGE_POLL_INTERVAL", "0.5"))
 
 def dialogue_tab(user_id):
     if not st.session_state.get('user_id'):
@@ -60,13 +64,20 @@ def dialogue_tab(user_id):
 
     get_system_message(user_id)
     user_provides_health_update(user_id)
+    open_recommendations(user_id)
     st.caption(f"User ID: {user_id}")
     review_your_relationship_with_user(user_id)
 
 def user_profile_tab(user_id):
     manage_user_profile(user_id)
 
+# User directories already created and chowned by this process; reruns skip the syscalls.
+_ensured_user_dirs = {}
+
 def ensure_user_directory(user_id):
+    if user_id in _ensured_user_dirs:
+        return _ensured_user_dirs[user_id]
+
     base_dir = Path(__file__).parent
     users_dir = base_dir / 'userdata'
 
@@ -92,86 +103,53 @@ def ensure_user_directory(user_id):
     except (ImportError, KeyError, PermissionError):
         logging.warning("Could not set directory ownership")
 
+    _ensured_user_dirs[user_id] = user_dir
     return user_dir
 
 
+@timed("save_session_state")
 def save_session_state(session_state):
     if 'user_id' not in st.session_state or not st.session_state.user_id:
         st.error("User ID not found. Please authenticate first.")
         return
 
     try:
-        user_dir = ensure_user_directory(st.session_state.user_id)
-        session_file = user_dir / 'session_state.json'
+        ensure_user_directory(st.session_state.user_id)
 
         auth_keys = ['auth_state', 'access_token', 'access_token_secret', 'request_token', 'request_token_secret', 'user_id']
         auth_data = {key: st.session_state.get(key) for key in auth_keys}
 
-        state_data = {
-            "conversation": session_state,
-            "authentication": auth_data
-        }
-
-        with open(session_file, 'w', encoding='utf-8') as f:
-            json.dump(state_data, f, indent=4)
-
-        logging.debug(f"Session state (including auth) saved to {session_file}: {auth_data}")
+        # write-through: also refreshes the copy later reruns are served from
+        get_user_state_cache().save(st.session_state.user_id, session_state, auth_data)
+        record_activity(st.session_state.user_id)
+        logging.debug(f"Session state (including auth) saved for {st.session_state.user_id}: {auth_data}")
 
     except Exception as e:
         logging.error(f"Error saving session state: {str(e)}")
         st.error(f"Error saving session state: {str(e)}")
 
+@timed("load_session_state")
 def load_session_state(user_id):
     try:
-        user_dir = ensure_user_directory(user_id)
-        session_file = user_dir / 'session_state.json'
-
-        if session_file.exists():
-            with open(session_file, 'r', encoding='utf-8') as f:
-                state_data = json.load(f)
-                conversation = state_data.get("conversation", []) if isinstance(state_data, dict) else []
-                auth_data = state_data.get("authentication", {}) if isinstance(state_data, dict) else {}
+        ensure_user_directory(user_id)
+        # served from the process-wide cache unless the stored conversation changed
+        conversation, auth_data = get_user_state_cache().load(user_id)
 
-                for key, value in auth_data.items():
-                    if value is not None and key not in st.session_state:
-                        st.session_state[key] = value
-                        logging.debug(f"Restored {key}: {value}")
+        for key, value in auth_data.items():
+            if value is not None and key not in st.session_state:
+                st.session_state[key] = value
+                logging.debug(f"Restored {key}: {value}")
 
-                if 'user_id' in auth_data and auth_data['user_id']:
-                    st.session_state.user_id = auth_data['user_id']
+        if 'user_id' in auth_data and auth_data['user_id']:
+            st.session_state.user_id = auth_data['user_id']
 
-                logging.debug(f"Loaded session state for user {user_id}")
-                return conversation
-        else:
-            logging.debug(f"No existing session state found for user {user_id}")
-            return []
+        logging.debug(f"Loaded session state for user {user_id}")
+        return conversation
 
     except Exception as e:
         logging.error(f"Error loading session state: {str(e)}")
         return []
 
-def cleanup_old_sessions(max_age_days=90):
-    try:
-        base_dir = Path(__file__).parent
-        users_dir = base_dir / 'users'
-        if not users_dir.exists():
-            return
-        current_time = time.time()
-        max_age_seconds = max_age_days * 24 * 60 * 60
-        for user_dir in users_dir.iterdir():
-            if user_dir.is_dir():
-                session_file = user_dir / 'session_state.json'
-                if session_file.exists():
-                    file_age = current_time - session_file.stat().st_mtime
-                    if file_age > max_age_seconds:
-                        session_file.unlink()
-                        logging.info(f"Removed old session file: {session_file}")
-                if not any(user_dir.iterdir()):
-                    user_dir.rmdir()
-                    logging.info(f"Removed empty user directory: {user_dir}")
-    except Exception as e:
-        logging.error(f"Error during session cleanup: {str(e)}")
-
 def user_provides_health_update(user_id):
     if not st.session_state.get('user_id'):
         st.session_state.user_id = user_id
@@ -179,40 +157,202 @@ def user_provides_health_update(user_id):
         logging.info("User not authenticated yet")
         return
 
+    job_key = f"health_job_{st.session_state.user_id}"
+    if USE_JOB_QUEUE and job_key not in st.session_state:
+        # a reply still being written for this user, e.g. before a reload or from another tab
+        st.session_state[job_key] = get_job_queue().active_job(st.session_state.user_id, "health_update")
+
     with st.form("health_update_form"):
         user_input = st.text_area(
             "How's your health today? Fill me in on sleep, nutrition, exercise, stress, and anything else that's on your mind.",
             key="health_input"
         )
-        submitted = st.form_submit_button("Submit")
+        submitted = st.form_submit_button("Submit", disabled=bool(st.session_state.get(job_key)))
 
-        if submitted:
+        if submitted and USE_JOB_QUEUE:
+            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            st.session_state.session_state.append(
+                {"role": "user", "content": user_input, "timestamp": current_time}
+            )
+            # the update is saved before the job runs, so a rerun cannot lose it
+            save_session_state(st.session_state.session_state)
+            try:
+                st.session_state[job_key] = get_job_queue().submit(
+                    "health_update", {"system_message": get_system_message(st.session_state.user_id)},
+                    user_id=st.session_state.user_id)
+            except Exception as e:
+                st.error(f"Error contacting AI service: {str(e)}")
+        elif submitted:
             current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             st.session_state.session_state.append(
                 {"role": "user", "content": user_input, "timestamp": current_time}
             )
             coach_info = get_system_message(st.session_state.user_id)
-            messages = [{"role": "system", "content": coach_info}] + st.session_state.session_state
+            with span("build_context"):
+                messages = build_context(
+                    coach_info,
+                    st.session_state.session_state,
+                    ensure_user_directory(st.session_state.user_id),
+                    make_llm_summarizer(),
+                )
 
             try:
-                response = client.chat.completions.create(model="grok-2-latest", messages=messages)
-                ai_response = response.choices[0].message.content
+                st.write("Feedback from AI:")
+                with span("grok_call"):
+                    if STREAM_RESPONSES:
+                        ai_response, time_to_first_token = stream_coach_response(messages)
+                    else:
+                        # no first token to time; the request latency goes to xai_health_llm_request_seconds
+                        response = chat_completion("dialogue", messages)
+                        ai_response = response.choices[0].message.content
+                        time_to_first_token = None
+                        st.write(ai_response)
+                if time_to_first_token is not None:
+                    observe("xai_health_time_to_first_token_seconds", time_to_first_token)
+                    st.session_state.last_time_to_first_token = time_to_first_token
+                    logging.info(f"Coach response time to first token: {time_to_first_token:.3f}s")
+                    st.caption(f"First token after {time_to_first_token:.2f}s")
+                # only a complete reply is persisted
                 st.session_state.session_state.append(
                     {"role": "assistant", "content": ai_response, "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
                 )
                 save_session_state(st.session_state.session_state)
-                st.write("Feedback from AI:")
-                st.write(ai_response)
-                recommendations = [line for line in ai_response.split("\n") if line.startswith("Recommendation: ")]
+                record_health_metrics(st.session_state.user_id, st.session_state.session_state)
+                recommendations = record_recommendations(st.session_state.user_id, st.session_state.session_state)
                 if recommendations:
                     st.write("Actionable Recommendations:")
                     for rec in recommendations:
-                        st.write(rec)
+                        st.write(f"{rec['topic'].capitalize()}: {rec['text']}")
             except Exception as e:
                 st.error(f"Error contacting AI service: {str(e)}")
 
+    if st.session_state.get(job_key):
+        poll_health_update_job(job_key)
+
+def wait_for_job(job_key, show_progress):
+    """
+    Polls a job until it finishes, redrawing only what show_progress draws.
+
+    Waiting in place instead of calling st.rerun() keeps the rest of the page
+    from being rebuilt, with its auth, storage and prompt work, every poll.
+
+    Returns:
+        dict: The finished job, or None when it no longer exists.
+    """
+    while True:
+        job = get_job_queue().get(st.session_state[job_key])
+        if job is None or job["status"] not in ("queued", "running"):
+            st.session_state[job_key] = None
+            return job
+        show_progress(job)
+        time.sleep(JOB_PAGE_POLL_INTERVAL)
+
+def poll_health_update_job(job_key):
+    """Shows the reply a worker is writing, and the finished reply once the job is done."""
+    st.write("Feedback from AI:")
+    placeholder = st.empty()
+
+    def show_progress(job):
+        if job["partial"]:
+            placeholder.markdown(job["partial"] + "▌")
+        else:
+            placeholder.info("Your coach is thinking..." if job["status"] == "running" else "Waiting for a free coach...")
+
+    job = wait_for_job(job_key, show_progress)
+    if job is None:
+        placeholder.empty()
+        return
+    if job["status"] == "failed":
+        placeholder.error(f"Error contacting AI service: {job['error']}")
+        return
+    result = job["result"]
+    # the worker saved the reply, possibly in another process; pick it up in this session's copy
+    get_user_state_cache().invalidate(st.session_state.user_id)
+    st.session_state.session_state = load_session_state(st.session_state.user_id)
+    placeholder.markdown(result["reply"])
+    time_to_first_token = result.get("time_to_first_token")
+    if time_to_first_token is not None:
+        st.session_state.last_time_to_first_token = time_to_first_token
+        st.caption(f"First token after {time_to_first_token:.2f}s")
+    if result.get("recommendations"):
+        st.write("Actionable Recommendations:")
+        for rec in result["recommendations"]:
+            st.write(f"{rec['topic'].capitalize()}: {rec['text']}")
+
+@timed("extract_metrics")
+def record_health_metrics(user_id, conversation):
+    """Extracts sleep, activity, beverage and other metrics from updates not yet processed."""
+    if not user_id:
+        return
+    try:
+        user_dir = ensure_user_directory(user_id)
+        if get_health_metric_store(user_dir).ingest(conversation):
+            # refresh the trends now so the next system message finds them cached
+            get_trend_lines(user_dir)
+    except Exception as e:
+        # the update is already saved; metrics are rebuilt from it on the next ingest
+        logging.error(f"Error extracting health metrics for {user_id}: {str(e)}")
+
+def record_recommendations(user_id, conversation):
+    """Adds the recommendations in the newest reply to the user's ledger and returns the new ones."""
+    if not user_id:
+        return []
+    reply = conversation[-1]
+    try:
+        return get_recommendation_ledger(ensure_user_directory(user_id)).capture(
+            reply["content"], reply.get("timestamp"), len(conversation) - 1)
+    except Exception as e:
+        logging.error(f"Error recording recommendations for {user_id}: {str(e)}")
+        return []
+
+def open_recommendations(user_id):
+    """Lets the user close the recommendations the coach is still following up on."""
+    if not user_id:
+        return
+    ledger = get_recommendation_ledger(ensure_user_directory(user_id))
+    records = ledger.query(status="open")
+    if not records:
+        return
+    with st.expander(f"Open recommendations ({len(records)})"):
+        for rec in records:
+            text_column, done_column, dismiss_column = st.columns([6, 1, 1])
+            text_column.write(f"{rec['created'][:10]} · {rec['topic']}: {rec['text']}")
+            if done_column.button("Done", key=f"rec_done_{rec['id']}"):
+                ledger.set_status(rec["id"], "done")
+                st.rerun()
+            if dismiss_column.button("Dismiss", key=f"rec_dismiss_{rec['id']}"):
+                ledger.set_status(rec["id"], "dismissed")
+                st.rerun()
+
+def stream_coach_response(messages):
+    """
+    Streams a coach reply into the page as tokens arrive.
+
+    If the stream fails or ends without a finish reason, the partial text is
+    discarded and the reply is fetched again without streaming, so callers
+    always get a complete message.
+
+    Returns:
+        tuple: (reply text, seconds to first token or None after a fallback).
+    """
+    placeholder = st.empty()
+    ai_response, time_to_first_token = stream_chat_completion(
+        "dialogue", messages,
+        on_text=lambda text: placeholder.markdown(text + "▌"),
+        on_fallback=lambda: placeholder.info("Connection hiccup, fetching the full reply..."),
+    )
+    placeholder.markdown(ai_response)
+    return ai_response, time_to_first_token
+
+# Messages rendered per "load older" step of the conversation history.
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "20"))
+
+def load_history_page(user_id, page_number, page_size=HISTORY_PAGE_SIZE):
+    """Returns one page of history, newest first, and the total number of messages."""
+    return get_storage().history_page(user_id, page_number, page_size)
+
 def show_history(user_id):
-    if st.session_state.session_state:
+    if user_id and st.session_state.session_state:
         with st.expander("💬 Conversation History", expanded=False):
             st.markdown("""
                 <style>
@@ -222,23 +362,29 @@ def show_history(user_id):
                 </style>
             """, unsafe_allow_html=True)
 
-            sorted_messages = sorted(
-                st.session_state.session_state,
-                key=lambda x: datetime.strptime(x["timestamp"], "%Y-%m-%d %H:%M:%S"),
-                reverse=True
-            )
+            pages_key = f"history_pages_{user_id}"
+            pages_shown = st.session_state.get(pages_key, 1)
 
             current_date = None
-            for message in sorted_messages:
-                message_date = message["timestamp"].split()[0]
-                if message_date != current_date:
-                    current_date = message_date
-                    st.markdown(f"#### {message_date}")
-                message_time = message["timestamp"].split()[1]
-                with st.chat_message(message["role"], avatar="👤" if message["role"] == "user" else "🤖"):
-                    st.write(f"{message_time}")
-                    st.write(message["content"])
-                st.markdown("<hr>", unsafe_allow_html=True)
+            shown = 0
+            total = 0
+            for page_number in range(pages_shown):
+                messages, total = load_history_page(user_id, page_number)
+                for message in messages:
+                    message_date, _, message_time = message["timestamp"].partition(" ")
+                    if message_date != current_date:
+                        current_date = message_date
+                        st.markdown(f"#### {message_date}")
+                    with st.chat_message(message["role"], avatar="👤" if message["role"] == "user" else "🤖"):
+                        st.write(f"{message_time}")
+                        st.write(message["content"])
+                    st.markdown("<hr>", unsafe_allow_html=True)
+                shown += len(messages)
+
+            if shown < total:
+                if st.button(f"Load older messages ({total - shown} more)", key=f"load_older_{user_id}"):
+                    st.session_state[pages_key] = pages_shown + 1
+                    st.rerun()
 
 def initialize_user(user_id):
     user_dir = ensure_user_directory(user_id)
@@ -250,28 +396,29 @@ def initialize_default_user():
     default_profile = {
         "profile_text": "Name: John Doe; Age: 30; Height: 180cm; Weight: 75kg; Diet: Vegetarian; Social Info: Loves hiking; Health: Hypertension"
     }
-    os.makedirs(XAI_HEALTH_DIR, exist_ok=True)
-    with open(f"{XAI_HEALTH_DIR}/userdata/{default_user_id}_profile.json", "w") as file:
-        json.dump(default_profile, file)
+    get_storage().save_profile(default_user_id, default_profile)
     print(f"Initialized default user profile for {default_user_id}")
 
 def manage_user_profile(user_id):
-    profile_filename = f"{XAI_HEALTH_DIR}/userdata/{user_id}_profile.json"
-    print(profile_filename)
-
-    if not os.path.exists(profile_filename):
+    storage = get_storage()
+    # the version this session last displayed; a save based on it fails if another session saved since
+    version_key = f"profile_version_{user_id}"
+    current_version = storage.profile_version(user_id)
+    base_version = st.session_state.get(version_key, current_version)
+    st.session_state[version_key] = current_version
+    profile = storage.load_profile(user_id)
+
+    if profile is None:
         st.warning("No profile found for this user.")
         with st.form("create_profile"):
             st.subheader("Create a New Profile")
             profile_text = st.text_area("Enter your profile information here:", height=300, help="Free text, any format.")
             submitted = st.form_submit_button("Create Profile")
             if submitted:
-                with open(profile_filename, "w") as file:
-                    json.dump({"profile_text": profile_text}, file)
-                    st.success(f"Profile saved for user ID: {user_id}")
+                storage.save_profile(user_id, {"profile_text": profile_text})
+                st.session_state[version_key] = storage.profile_version(user_id)
+                st.success(f"Profile saved for user ID: {user_id}")
     else:
-        with open(profile_filename, "r") as file:
-            profile = json.load(file)
         edit_profile = "Yes" # st.radio("Update?", ["Yes", "No"], horizontal=True)
         if edit_profile == "Yes" and st.session_state.get('auth_state') == 'authenticated':
             with st.form("edit_profile"):
@@ -279,26 +426,60 @@ def manage_user_profile(user_id):
                                             help="Update your health history here. Free text, any format.")
                 submitted = st.form_submit_button("Update")
                 if submitted:
-                    with open(profile_filename, "w") as file:
-                        json.dump({"profile_text": profile_text}, file)
+                    try:
+                        storage.save_profile(user_id, {"profile_text": profile_text}, expected_version=base_version)
+                        st.session_state[version_key] = storage.profile_version(user_id)
                         st.success(f"History saved for user ID: {user_id}")
+                    except ConflictError:
+                        st.warning("Your history was changed in another session since this page loaded. "
+                                   "Update again to replace it with the text above.")
         else:
             st.write(profile.get("profile_text", "No profile found."))
     st.caption(f"User ID: {user_id}")
 
+@timed("get_system_message")
 def get_system_message(user_id):
     base_system_message = "You are a personal health assistant providing feedback and recommendations based on user health updates. Your advice is tailored specifically for the user. In creating the advice you consider all the information in his user profile and his conversation history.\n\n"
+    base_system_message += "Put each new actionable recommendation on its own line starting with \"Recommendation: \".\n\n"
+    if not user_id:
+        # nobody logged in: no trends, recommendations or persona to look up
+        return base_system_message
+    # changes from turn to turn, so it stays out of the persona registry's memo
+    context = health_trends_message(user_id) + open_recommendations_message(user_id)
     coach = CoachProfile(user_id)
-    attributes = st.session_state.get(f"coach_attributes_{user_id}", coach.load_current_coach_attributes())
+    attributes = coach.current_coach_attributes()
     if attributes:
-        all_available_attributes = coach.load_all_available_attributes()
-        coach_additional_instructions = "As you formulate your response, consider the following additional attributes of your personality.\n\n"
-        for attribute in attributes:
-            coach_additional_instructions += f"{all_available_attributes.get(attribute, 'Unknown attribute')}\n"
-        return f"{base_system_message}\n{coach_additional_instructions}"
+        return coach.persona_registry.system_message(user_id, attributes, base_system_message, context)
     else:
         logging.warning(f"No coach attributes for {user_id}")
-        return base_system_message
+        return base_system_message + context
+
+def open_recommendations_message(user_id):
+    """The open recommendations to follow up on, so old replies need not be re-sent for them."""
+    if not user_id:
+        return ""
+    try:
+        records = get_recommendation_ledger(ensure_user_directory(user_id)).follow_up()
+    except Exception as e:
+        logging.error(f"Error loading recommendations for {user_id}: {str(e)}")
+        return ""
+    if not records:
+        return ""
+    lines = [f"- {rec['created'][:10]} ({rec['topic']}): {rec['text'][:240]}" for rec in records]
+    return "Open recommendations to follow up on, with the date they were given:\n" + "\n".join(lines) + "\n\n"
+
+def health_trends_message(user_id):
+    """A few lines of trends from the user's extracted metrics, or an empty string."""
+    if not user_id:
+        return ""
+    try:
+        lines = get_trend_lines(ensure_user_directory(user_id))
+    except Exception as e:
+        logging.error(f"Error computing health trends for {user_id}: {str(e)}")
+        return ""
+    if not lines:
+        return ""
+    return "Recent health metrics from the user's updates:\n" + "\n".join(f"- {line}" for line in lines) + "\n\n"
 
 def review_your_relationship_with_user(user_id="user_1"):
     review_prompts = {
@@ -306,22 +487,15 @@ def review_your_relationship_with_user(user_id="user_1"):
     }
     return
 
+@timed("check_stripe_subscription")
 def check_stripe_subscription(user_id):
-    stripe.api_key = st.secrets["stripe"]["api_key"]
+    if not user_id:
+        # nobody logged in yet: nothing to look up, and Stripe is not called
+        return False
     try:
-        customer_id_file = f"{XAI_HEALTH_DIR}/{user_id}_stripe_customer.json"
-        if os.path.exists(customer_id_file):
-            with open(customer_id_file, "r") as f:
-                customer_data = json.load(f)
-                customer_id = customer_data["customer_id"]
-        else:
-            customer = stripe.Customer.create(email=f"{user_id}@example.com")
-            customer_id = customer["id"]
-            with open(customer_id_file, "w") as f:
-                json.dump({"customer_id": customer_id}, f)
-
-        subscriptions = stripe.Subscription.list(customer=customer_id)
-        if subscriptions.data and subscriptions.data[0].status == "active":
+        # answered from the local entitlement store unless the cached status has expired
+        entitlement = get_entitlement_store().check(user_id, api_key=st.secrets["stripe"]["api_key"])
+        if entitlement["active"]:
             return True
         else:
             st.warning("Free during alpha test only.")
@@ -338,22 +512,54 @@ def give_me_the_latest_tab():
     st.write("Peer-reviewed recent research results, powered by Grok")
     for search_label, search_url in canned_searches.items():
         st.markdown(f"- [{search_label}]({search_url})")
+    if USE_JOB_QUEUE:
+        research_query_form()
+
+RESEARCHER_MESSAGE = "You are a health science expert who is thoroughly familiar with the scientific literature on every aspect of health."
+
+def research_messages(search_label):
+    return [
+        dict(role="system", content=RESEARCHER_MESSAGE),
+        dict(role="user", content=f"Give me the very latest research on {search_label}.")
+    ]
+
+def research_query_form():
+    """Asks about a research topic on the job queue and shows the answer when a worker has it."""
+    job_key = "research_job"
+    with st.form("research_query_form"):
+        search_label = st.text_input("Ask about the latest research on:")
+        submitted = st.form_submit_button("Ask", disabled=bool(st.session_state.get(job_key)))
+        if submitted and search_label:
+            try:
+                st.session_state[job_key] = get_job_queue().submit(
+                    "research", {"label": search_label, "messages": research_messages(search_label)},
+                    user_id=st.session_state.get("user_id"))
+            except Exception as e:
+                st.error(f"Error contacting AI service: {str(e)}")
+    if not st.session_state.get(job_key):
+        return
+    placeholder = st.empty()
+    job = wait_for_job(job_key, lambda job: placeholder.info(f"Researching {job['payload']['label']}..."))
+    placeholder.empty()
+    if job is None:
+        return
+    if job["status"] == "failed":
+        st.error(f"Error contacting AI service: {job['error']}")
+    else:
+        st.write(f"**{job['payload']['label']}**")
+        st.write(job["result"]["text"])
 
 def get_research_from_before_learning_cutoff(canned_searches):
-    researcher_message = "You are a health science expert who is thoroughly familiar with the scientific literature on every aspect of health."
     for search_label, search_url in canned_searches.items():
-        topic_message = f"Give me the very latest research on {search_label}."
-        messages = [
-            dict(role="system", content=researcher_message),
-            dict(role="user", content=topic_message)
-        ]
-        client = OpenAI(api_key=XAI_API_KEY, base_url="https://api.x.ai/v1")
-        response = client.chat.completions.create(model="grok-2-latest", messages=messages)
-        topic_response = response.choices[0].message.content
+        topic_response = cached_chat_completion("research", research_messages(search_label))
         st.write(f"**{search_label}**")
         st.write(topic_response)
 
+@timed("twitter_auth")
 def twitter_auth():
+    # tweepy is only needed on this code path; keep it off the import chain of every rerun
+    import tweepy
+
     logging.debug("Starting twitter_auth")
     logging.debug("Current session state: %s", st.session_state)
 
@@ -377,17 +583,26 @@ def twitter_auth():
             if key not in st.session_state:
                 st.session_state[key] = value
 
+    def fetch_username(access_token, access_token_secret):
+        client = tweepy.Client(
+            consumer_key=consumer_key,
+            consumer_secret=consumer_secret,
+            access_token=access_token,
+            access_token_secret=access_token_secret
+        )
+        me = client.get_me()
+        logging.info("Tokens validated successfully: user=%s", me.data.username)
+        return me.data.username
+
     def validate_tokens():
         if st.session_state.get('access_token') and st.session_state.get('access_token_secret'):
             try:
-                client = tweepy.Client(
-                    consumer_key=consumer_key,
-                    consumer_secret=consumer_secret,
-                    access_token=st.session_state.access_token,
-                    access_token_secret=st.session_state.access_token_secret
+                # usually an in-memory lookup; X is only asked once the cached validation ages out
+                get_token_validation_cache().validate(
+                    st.session_state.access_token,
+                    st.session_state.access_token_secret,
+                    fetch_username
                 )
-                me = client.get_me()
-                logging.info("Tokens validated successfully: user=%s", me.data.username)
                 return True
             except tweepy.TweepyException as e:
                 logging.error("Token validation failed: %s", str(e))
@@ -447,6 +662,7 @@ def twitter_auth():
             client = tweepy.Client(consumer_key=consumer_key, consumer_secret=consumer_secret,
                                    access_token=access_token, access_token_secret=access_token_secret)
             me = client.get_me()
+            get_token_validation_cache().prime(access_token, me.data.username)
             st.session_state.user_id = me.data.username
             logging.info("Authentication successful: user=%s, access_token=%s", me.data.username, access_token[:10] + "...")
             save_session_state(st.session_state.session_state)
@@ -476,9 +692,12 @@ def twitter_auth():
             st.error("Failed to start authentication process")
     return None
 
+@timed("page")
 def main():
     logging.basicConfig(level=logging.INFO)
-    load_dotenv()
+    st.title("xAI-powered Health Coach")
+    # fail fast on a malformed XAI_API_KEY and warm up the shared, pooled client
+    get_client()
 
     # Add this with your other session state initializations
     if 'auth_state' not in st.session_state:
@@ -488,12 +707,13 @@ def main():
         st.session_state.session_state = []
     if 'user_id' not in st.session_state:
         st.session_state.user_id = None
-    if 'last_cleanup' not in st.session_state:
-        st.session_state.last_cleanup = time.time()
-        cleanup_old_sessions()
-    elif time.time() - st.session_state.last_cleanup > 86400:
-        cleanup_old_sessions()
-        st.session_state.last_cleanup = time.time()
+    # retention and compaction run on a background thread, never on the page load
+    start_maintenance_scheduler()
+    # /metrics endpoint and/or metrics file, when METRICS_PORT / METRICS_FILE are set
+    start_metrics_exporter()
+    if USE_JOB_QUEUE:
+        # health updates and research run on these threads, not on the script thread
+        get_job_queue().start()
 
     # Load existing session state if available and no new auth
     if st.session_state.user_id and not ('oauth_verifier' in st.query_params and 'oauth_token' in st.query_params):
@@ -503,19 +723,19 @@ def main():
     if user_id and user_id != st.session_state.user_id:
         st.session_state.user_id = user_id
         initialize_user(user_id)
-        st.session_state.session_state = load_session_state(user_id)
         st.toast(f"Authenticated as @{user_id}!")
 
         coach = CoachProfile(user_id)
-        user_coach_file = os.path.join(XAI_HEALTH_DIR, f"{user_id}_coach_attributes.json")
         default_coach_attributes = CoachProfile.initialize_default_coach_attributes()
-        if not os.path.exists(user_coach_file):
+        if get_storage().load_coach_attributes(user_id) is None:
             coach.save_selected_attributes(default_coach_attributes)
         if f"coach_attributes_{user_id}" not in st.session_state:
             st.session_state[f"coach_attributes_{user_id}"] = coach.load_current_coach_attributes()
 
     # Use existing user_id if no new authentication
     current_user_id = st.session_state.user_id
+    # attributes every xAI call made on this session's thread in the usage ledger
+    set_current_user(current_user_id)
 
     st.image(os.path.join(XAI_HEALTH_DIR, "resources", "coach_cartoon.jpg"), width=300)
     with st.expander("Showcasing the Unique Advantages of the xAI API", expanded=False):
@@ -540,7 +760,9 @@ def main():
         user_profile_tab(current_user_id)
 
     with st.expander("Visit with Coach", expanded=True):
-        if check_stripe_subscription(current_user_id):
+        if not current_user_id:
+            st.write("Log in to talk to Coach!")
+        elif check_stripe_subscription(current_user_id):
             dialogue_tab(current_user_id)
         else:
             st.write("Subscribe to talk to Coach!")
@@ -563,8 +785,8 @@ class CoachProfile:
                  available_attributes_file_path=f"{XAI_HEALTH_DIR}/all_available_coach_attributes.json"):
         self.user_id = user_id
         self.available_attributes_file_path = available_attributes_file_path
-        self.coach_attributes_file_path = f"{XAI_HEALTH_DIR}/{self.user_id}_coach_attributes.json"
         self.selected_attributes = selected_attributes or st.session_state.get(f"coach_attributes_{user_id}", [])
+        self.persona_registry = get_persona_registry(available_attributes_file_path)
 
     def coach_tab(self):
         self.load_all_available_attributes()
@@ -572,50 +794,61 @@ class CoachProfile:
         self.modify_current_coach_attributes()
 
     def load_current_coach_attributes(self):
-        if os.path.exists(self.coach_attributes_file_path):
-            try:
-                with open(self.coach_attributes_file_path, "r") as file:
-                    data = json.load(file)
-                    attributes = data.get(self.user_id, [])
-                    st.session_state[f"coach_attributes_{self.user_id}"] = attributes
-                    logging.info(f"Loaded coach attributes for user {self.user_id}: {attributes}")
-                    return attributes
-            except json.JSONDecodeError:
-                logging.error(f"Corrupted JSON in {self.coach_attributes_file_path}, resetting")
-                attributes = self.initialize_default_coach_attributes()
-                self.save_selected_attributes(attributes)
-                return attributes
-        else:
-            logging.warning(f"No coach attributes file found at {self.coach_attributes_file_path}")
-            attributes = self.initialize_default_coach_attributes()
-            self.save_selected_attributes(attributes)
+        storage = get_storage()
+        version = storage.coach_attributes_version(self.user_id)
+        attributes = storage.load_coach_attributes(self.user_id)
+        if attributes is not None:
+            st.session_state[f"coach_attributes_{self.user_id}"] = attributes
+            st.session_state[f"coach_attributes_version_{self.user_id}"] = version
+            logging.debug(f"Loaded coach attributes for user {self.user_id}: {attributes}")
             return attributes
-
-    def save_selected_attributes(self, attributes=None):
+        logging.warning(f"No readable coach attributes for {self.user_id}, resetting to defaults")
+        attributes = self.initialize_default_coach_attributes()
+        self.save_selected_attributes(attributes)
+        return attributes
+
+    def save_selected_attributes(self, attributes=None, expected_version=None):
+        """
+        Args:
+            expected_version: Version the attributes were loaded at; the save is
+                refused if another session changed them since.
+
+        Returns:
+            bool: Whether the attributes were saved.
+        """
         attributes = attributes if attributes is not None else self.selected_attributes
+        storage = get_storage()
         try:
-            data = {self.user_id: attributes}
-            with open(self.coach_attributes_file_path, "w") as file:
-                json.dump(data, file, indent=4)
+            storage.save_coach_attributes(self.user_id, attributes, expected_version=expected_version)
             st.session_state[f"coach_attributes_{self.user_id}"] = attributes
+            st.session_state[f"coach_attributes_version_{self.user_id}"] = storage.coach_attributes_version(self.user_id)
             self.selected_attributes = attributes
-            logging.info(f"Saved coach attributes: {data}")
+            logging.info(f"Saved coach attributes for {self.user_id}: {attributes}")
+            return True
+        except ConflictError:
+            logging.warning(f"Coach attributes of {self.user_id} changed in another session, not saved")
+            self.load_current_coach_attributes()
+            st.warning("Your coach was changed in another session since this page loaded. "
+                       "Save again to replace it with your selection.")
         except Exception as e:
             logging.error(f"Error saving coach attributes: {e}")
             st.error(f"Error saving coach attributes: {e}")
+        return False
 
     def load_all_available_attributes(self):
-        if self.available_attributes_file_path and os.path.exists(self.available_attributes_file_path):
-            with open(self.available_attributes_file_path, "r") as file:
-                self.all_available_attributes = json.load(file)
-                logging.info(f"Available attributes loaded from {self.available_attributes_file_path}")
-        else:
-            self.all_available_attributes = {}
+        # served from the process-wide registry; the file is only re-read after it changes
+        self.all_available_attributes = self.persona_registry.available_attributes()
         return self.all_available_attributes
 
+    def current_coach_attributes(self):
+        attributes = st.session_state.get(f"coach_attributes_{self.user_id}")
+        if attributes is None:
+            attributes = self.load_current_coach_attributes()
+        return attributes
+
     def modify_current_coach_attributes(self):
         options = list(self.load_all_available_attributes().keys())
-        current_attributes = st.session_state.get(f"coach_attributes_{self.user_id}", self.load_current_coach_attributes())
+        current_attributes = self.current_coach_attributes()
         selected_attributes = st.multiselect(
             "Available Coach Attributes",
             options=options,
@@ -623,9 +856,10 @@ class CoachProfile:
             key=f"coach_attributes_selector_{self.user_id}"
         )
         if st.button("Save Selected Attributes"):
-            self.save_selected_attributes(selected_attributes)
-            logging.info(f"Selected attributes saved: {selected_attributes}")
-            st.success("Coach attributes updated!")
+            expected_version = st.session_state.get(f"coach_attributes_version_{self.user_id}")
+            if self.save_selected_attributes(selected_attributes, expected_version=expected_version):
+                logging.info(f"Selected attributes saved: {selected_attributes}")
+                st.success("Coach attributes updated!")
 
     @staticmethod
     def initialize_default_coach_attributes():
@@ -639,7 +873,7 @@ class CoachProfile:
         return default_attributes["default"]
 
     def display_current_coach_personality(self):
-        attributes = st.session_state.get(f"coach_attributes_{self.user_id}", self.load_current_coach_attributes())
+        attributes = self.current_coach_attributes()
         if attributes:
             st.subheader("Current Personality")
             for attribute in attributes:
@@ -1,14 +1,12 @@
-import json
+import argparse
 import logging
 import os
 import sys
-import urllib
-import argparse
-import json
 from pprint import pprint
 
-import streamlit as st
-from openai import OpenAI
+# the prompt pipeline lives in the importable core; re-exported for existing callers
+from health_coach.topics import (XAI_MAX_CONCURRENCY, XAI_STACKS_DIR, GiveMeTheLatest,  # noqa: F401
+                                 load_completed_topics, read_topic_catalog)
 
 
 def display_dictionary_attributes(self, attributes_dict, default_selected=[]):
@@ -21,6 +19,8 @@ def display_dictionary_attributes(self, attributes_dict, default_selected=[]):
     Returns:
         list: Selected attributes.
     """
+    import streamlit as st
+
     options = list(attributes_dict.keys())
     selected_attributes = st.multiselect("Select Attributes",
                                          options=options,
@@ -36,124 +36,16 @@ def display_dictionary_attributes(self, attributes_dict, default_selected=[]):
     return selected_attributes
 
 XAI_HEALTH_DIR = os.getenv("XAI_HEALTH_DIR")
-XAI_STACKS_DIR = 'xai_stacks'
-if not XAI_STACKS_DIR:
-    XAI_STACKS_DIR = os.getenv("XAI_STACKS_DIR")
 
-st.title("xAI Health Coach")
+
 def get_user_id(dummy_user="user_1"):
     if dummy_user:
         return dummy_user
     else:
+        import streamlit as st
         return st.session_state.user_id
 
 
-# Configuration for OpenAI API
-XAI_API_KEY = os.getenv("XAI_API_KEY", "your_api_key_here")
-BASE_URL = "https://api.x.ai/v1"
-
-client = OpenAI(
-    api_key=XAI_API_KEY,
-    base_url="https://api.x.ai/v1",
-)
-
-
-class GiveMeTheLatest:
-
-    def __init__(self, real_time_friendly_morpher=None,reformulater=None, morph_prompt=None, exploder_instruction=None, exploder_value=8):
-        self.morph_prompt = morph_prompt or "Optimize this prompt."
-        self.reformulater = f"{morph_prompt}. Return the revised prompt as plain text without pleasantries or explanations."
-        self.real_time_friendly_morpher = real_time_friendly_morpher or "You are a search assistant who is fully aware of all Grok's real-time information sources including but not limited to news, fresh X content, fresh web content, Arxiv and other pdfs, financial, sports, and location-based data. As you know, not all these sources are currently available via the xai API. To remedy this shortcoming, you will reformulate the following prompts to take full advantage of real-time results.  You must prioritize real-time information from peer-reviewed or highly credible sources."
-        self.exploder_value = exploder_value or 8
-        self.exploder_instruction = exploder_instruction or f"Your task is to 'explode' this prompt, which describes a particular substantive domain, into a set of {exploder_value} prompts that are subsets of or interestingly adjacent to this domain. Please provide those prompts as valid JSON."
-
-
-    def generate_real_time_friendly_topic_link_sets(self, prompts, exploder_value=8):
-        # generates real-time-friendly prompts for domain-specific publications
-        # prompts are high-level concepts like health, space warfare, etc.
-        # example prompts: ["xai Health Coach on fitness, nutrition, exercise, equipment", "UltraScale Aerospace publication"]
-        if isinstance(prompts,str):
-            prompts = [prompts]
-        all_new_link_sets = []
-        exploder_morph_prompt = self.real_time_friendly_morpher + '/n/n' + self.exploder_instruction
-        new_links = []
-        exploded_prompts_dict = {}
-        for prompt in prompts:
-            if prompt:
-                # add prompt to dict
-                exploded_prompts_dict[prompt] = prompt
-                new_link_set = self.morph_prompts(prompt, exploder_morph_prompt, create_link=True)
-                if new_link_set:
-                    all_new_link_sets.append(new_link_set)
-                    exploded_prompts_dict[prompt] = new_link_set
-        return exploded_prompts_dict
-
-    def save_exploded_prompts_dict(self, exploded_prompts_dict):
-        with open(f"{XAI_STACKS_DIR}/exploded_prompts_dict.json", "w") as file:
-            json.dump(exploded_prompts_dict, file, indent=4)
-
-
-    def morph_prompts(self, prompts, morph_prompt=None, create_link=True):
-        """
-        Processes single or multiple prompts, applies a morph prompt, and e
-        ither
-        fetches the result of the morphed prompt or creates a link to the Grok website.
-
-        Args:
-            prompts (str|list): A single prompt or a list of prompts.
-            morph_prompt (str): Instruction to optimize the prompt(s).
-            create_link (bool): If True, create a Grok website link for the morphed prompt(s).
-
-        Returns:
-            str|list: Morphed prompt(s) or a link to the Grok website.
-        """
-
-        if isinstance(prompts, str):
-            prompts = [prompts]  # Ensure prompts is a list
-
-        if not morph_prompt:
-            morph_prompt = "You are a search assistant who is fully aware of all Grok's real-time information sources including but not limited to news, fresh X content, fresh web content, Arxiv and other pdfs, financial, sports, and location-based data. As you know, not all these sources are currently available via the xai API. To remedy this shortcoming, you will be reformulating the prompts to take full advantage of real-time results.  You should prioritize real-time information from peer-reviewed or highly credible sources."
-
-        reformulate = f"{morph_prompt}. Return the revised prompt as plain text without pleasantries or explanations."
-
-        morphed_results = []
-
-        print(prompts, morph_prompt, create_link)
-
-        for prompt in prompts:
-            if prompt:
-
-                # Prepare messages for OpenAI API
-                messages = [
-                    dict(role="system", content=morph_prompt),
-                    dict(role="user", content=prompt),
-                    dict(role="assistant", content=reformulate)
-                ]
-
-                # Call OpenAI API
-                response = client.chat.completions.create(
-                    model="grok-2-latest", messages=messages
-                )
-                #print(messages)
-               # print(response)
-
-                # Get revised prompt
-                ai_response = response.choices[0].message.content
-                print(ai_response)
-                if ai_response:
-                    if create_link:
-                        encoded_prompt = urllib.parse.quote(ai_response)
-                        webgrok_link = f"https://grok.com/?q={encoded_prompt}"
-                        morphed_results.append(webgrok_link)
-                    else:
-                        morphed_results.append(ai_response)
-                else:
-                    morphed_results.append(None)
-
-        # Return single result if input was a single prompt
-        return morphed_results[0] if len(prompts) == 1 else morphed_results
-
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Process prompts using the latest data.')
 
@@ -161,14 +53,27 @@ if __name__ == "__main__":
     parser.add_argument('--morph_prompt', type=str, help='Instruction to optimize the prompt(s)')
     parser.add_argument('--create_link', action='store_true',
                         help='Create a Grok website link for the morphed prompt(s)')
+    parser.add_argument('--max_concurrency', type=int, default=XAI_MAX_CONCURRENCY,
+                        help='Maximum number of simultaneous API calls')
+    parser.add_argument('--catalog', type=str,
+                        help='Topic catalog to explode in batch mode, e.g. resources/healthprompts.csv')
+    parser.add_argument('--output', type=str, default=f"{XAI_STACKS_DIR}/exploded_prompts.jsonl",
+                        help='JSONL file for batch results; rerunning resumes from it')
 
     args = parser.parse_args()
 
+    if args.catalog:
+        logging.basicConfig(level=logging.INFO)
+        give_me_the_latest = GiveMeTheLatest(max_concurrency=args.max_concurrency)
+        summary = give_me_the_latest.explode_topic_catalog(read_topic_catalog(args.catalog), args.output)
+        print(summary)
+        sys.exit(1 if summary["failed"] else 0)
+
     prompts = args.prompts
     morph_prompt = args.morph_prompt
     create_link = args.create_link
 
-    give_me_the_latest = GiveMeTheLatest()
+    give_me_the_latest = GiveMeTheLatest(max_concurrency=args.max_concurrency)
     #print(prompts, morph_prompt, create_link)
     exploded_stacks = give_me_the_latest.generate_real_time_friendly_topic_link_sets(prompts=prompts, exploder_value=8)
     pprint(exploded_stacks)